@@ -0,0 +1,267 @@
+"""音声処理パイプラインのベンチマーク（Whisper APIは偽のクライアントに置き換える）
+
+合成した音声を、アップロードの一時ファイルへの保存から変換・分割・並列の文字起こし・
+書き出しまで実際のアプリと同じ経路で処理し、シナリオごとに以下を計測する。
+
+- 処理時間と処理速度（音声秒/秒）
+- 最大メモリ使用量（このプロセスとffmpegなどの子プロセス）
+- 一時ファイル・ジョブの保存に使った最大の容量
+- 音声1時間あたりのAPI呼び出し回数と送信量
+- 各形式の書き出しにかかった時間
+
+各シナリオは別のプロセスで実行するため、最大メモリ使用量は互いに影響しない。
+
+使い方:
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --duration 7200 --format wav --latency 1.0 --failure-rate 0.05
+    python benchmarks/bench_pipeline.py --scenario parallel --json bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 比較するシナリオ: 名前 → 処理設定
+SCENARIOS = {
+    "baseline": {"compress": False, "use_vad": False, "max_workers": 1, "overlap": 0},
+    "compress": {"compress": True, "use_vad": False, "max_workers": 1, "overlap": 0},
+    "compress_vad": {"compress": True, "use_vad": True, "max_workers": 1, "overlap": 0},
+    "parallel": {"compress": True, "use_vad": True, "max_workers": 4, "overlap": 0},
+    "overlap": {"compress": True, "use_vad": True, "max_workers": 4, "overlap": 5},
+    "refine": {"compress": True, "use_vad": True, "max_workers": 4, "overlap": 0, "context_mode": "refine"},
+    "chain": {"compress": True, "use_vad": True, "max_workers": 4, "overlap": 0, "context_mode": "chain"}
+}
+
+# 合成する音声の形式: 拡張子 → ffmpegの出力設定
+AUDIO_FORMATS = {
+    "mp3": {"acodec": "libmp3lame", "audio_bitrate": "64k"},
+    "m4a": {"acodec": "aac", "audio_bitrate": "64k"},
+    "wav": {"acodec": "pcm_s16le"},
+    "ogg": {"acodec": "libopus", "audio_bitrate": "32k"},
+    "flac": {"acodec": "flac"}
+}
+
+# 書き出しを計測する際のセグメントの間隔（秒、Whisperのセグメントのおおよその長さ）
+EXPORT_SEGMENT_SECONDS = 4
+
+def generate_audio(path, duration, audio_format, sample_rate=44100):
+    """話し声の代わりに、音程の変わる音と無音が交互に続く音声を作る
+    
+    パートの内容が互いに同じにならないように小さなノイズを加える
+    （同じ内容だとキャッシュが効いてAPI呼び出し回数が実際より少なくなるため）。
+    """
+    import ffmpeg
+    expression = r"(0.4*sin(2*PI*(180+20*mod(t\,11))*t)*lt(mod(t\,9)\,7)+0.002*(random(0)-0.5))"
+    source = ffmpeg.input(f"aevalsrc={expression}:s={sample_rate}:d={duration}", f="lavfi")
+    source.output(path, **AUDIO_FORMATS[audio_format]).overwrite_output().run(quiet=True)
+
+class FakeTranscriptions:
+    """client.audio.transcriptions の代わり（待ち時間と失敗率を指定できる）"""
+    
+    def __init__(self, latency, failure_rate, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.bytes_sent = 0
+    
+    def create(self, file, model, response_format="text", **kwargs):
+        import httpx
+        from openai import APIConnectionError
+        data = file[1] if isinstance(file, tuple) else file.read()
+        with self.lock:
+            self.calls += 1
+            self.bytes_sent += len(data)
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        time.sleep(self.latency)
+        if failed:
+            raise APIConnectionError(request=httpx.Request("POST", "http://fake/v1/audio/transcriptions"))
+        
+        # 文の途中で区切られたパートを再現するため、2回に1回は文の終わりの句点を付けない
+        text = f"パート{self.calls}の文字起こし結果です" + ("。" if self.calls % 2 else "")
+        if response_format == "verbose_json":
+            return {"text": text, "segments": [{"start": 0.0, "end": 5.0, "text": text}]}
+        return text
+
+class FakeClient:
+    def __init__(self, transcriptions):
+        self.audio = type("FakeAudio", (), {"transcriptions": transcriptions})()
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # 計測中に削除されたファイル
+    return total
+
+class PeakSizeMonitor:
+    """ディレクトリの合計サイズを定期的に調べ、最大値を記録する"""
+    
+    def __init__(self, paths, interval=0.05):
+        self.paths = paths
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, sum(directory_size(path) for path in self.paths))
+            self._stop.wait(self.interval)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def measure_exports(duration):
+    """音声の長さに相当する数のセグメントで、各形式の書き出し時間（ミリ秒）を計測する"""
+    from transcriber import Transcript, EXPORT_FORMATS
+    count = max(1, int(duration // EXPORT_SEGMENT_SECONDS))
+    segments = [
+        {"start": i * EXPORT_SEGMENT_SECONDS, "end": (i + 1) * EXPORT_SEGMENT_SECONDS, "text": f"セグメント{i}の文字起こし結果です。"}
+        for i in range(count)
+    ]
+    started = time.perf_counter()
+    transcript = Transcript.from_segments("".join(segment["text"] for segment in segments), segments)
+    timings = {"build": (time.perf_counter() - started) * 1000}
+    for name in EXPORT_FORMATS:
+        started = time.perf_counter()
+        transcript.export(name)
+        timings[name] = (time.perf_counter() - started) * 1000
+    return timings
+
+def run_scenario(name, source_path, args):
+    """1つのシナリオを実行して計測結果を返す（新しいプロセスの中で呼ばれる）"""
+    work_dir = tempfile.mkdtemp(prefix="whisper-bench-")
+    temp_dir = os.path.join(work_dir, "tmp")
+    cache_dir = os.path.join(work_dir, "cache")
+    os.makedirs(temp_dir)
+    # キャッシュ・ジョブの保存場所は読み込み時に決まるため、transcriber より先に設定する
+    os.environ["WHISPER_CACHE_DIR"] = cache_dir
+    tempfile.tempdir = temp_dir
+    
+    from transcriber import api, probe_audio, process_audio_file
+    transcriptions = FakeTranscriptions(args.latency, args.failure_rate, args.seed)
+    api.client = FakeClient(transcriptions)
+    api.rate_limiter = api.TokenBucket(args.rpm / 60, api.API_BURST)
+    api.API_BACKOFF_BASE = args.backoff
+    
+    options = SCENARIOS[name]
+    settings = {
+        "model": "whisper-1",
+        "with_timestamps": True,
+        "prompt": "",
+        "compress": options["compress"],
+        "max_duration": args.max_duration * 60,
+        "use_vad": options["use_vad"],
+        "drop_silence": False,
+        "overlap": options["overlap"],
+        "context_mode": options.get("context_mode", "none")
+    }
+    duration = probe_audio(source_path)["duration"]
+    
+    try:
+        with PeakSizeMonitor([temp_dir, cache_dir]) as monitor:
+            started = time.perf_counter()
+            # アップロードされたファイルを一時ファイルに保存する処理から計測する
+            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(source_path)[1]) as tmp_file:
+                with open(source_path, "rb") as f:
+                    shutil.copyfileobj(f, tmp_file, 1024 * 1024)
+                upload_path = tmp_file.name
+            result = process_audio_file(upload_path, os.path.basename(source_path), settings, options["max_workers"])
+            wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    audio_hours = duration / 3600
+    return {
+        "scenario": name,
+        "audio_seconds": duration,
+        "wall_seconds": wall,
+        "audio_seconds_per_second": duration / wall if wall > 0 else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "peak_temp_mb": monitor.peak / (1024 * 1024),
+        "parts": result["parts"],
+        "missing": result["missing"],
+        "api_calls": transcriptions.calls,
+        "api_failures": transcriptions.failures,
+        "api_calls_per_audio_hour": transcriptions.calls / audio_hours if audio_hours else 0.0,
+        "upload_mb_per_audio_hour": transcriptions.bytes_sent / (1024 * 1024) / audio_hours if audio_hours else 0.0,
+        "export_ms": measure_exports(duration)
+    }
+
+def print_report(results):
+    """結果を表にして表示する（列の見出しは幅を揃えるため英字）"""
+    print(f"{'scenario':<14}{'wall_s':>8}{'audio_s/s':>10}{'rss_mb':>8}{'child_mb':>9}{'temp_mb':>8}"
+          f"{'parts':>6}{'miss':>5}{'calls/h':>8}{'fail':>5}{'sent_mb/h':>10}{'srt_ms':>8}")
+    for r in results:
+        print(f"{r['scenario']:<14}{r['wall_seconds']:>8.2f}{r['audio_seconds_per_second']:>10.1f}"
+              f"{r['peak_rss_mb']:>8.1f}{r['peak_child_rss_mb']:>9.1f}{r['peak_temp_mb']:>8.1f}"
+              f"{r['parts']:>6}{r['missing']:>5}{r['api_calls_per_audio_hour']:>8.1f}{r['api_failures']:>5}"
+              f"{r['upload_mb_per_audio_hour']:>10.1f}{r['export_ms']['srt']:>8.1f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="音声処理パイプラインのベンチマーク")
+    parser.add_argument("--duration", type=float, default=3600, help="合成する音声の長さ（秒）")
+    parser.add_argument("--format", default="mp3", choices=sorted(AUDIO_FORMATS), help="合成する音声の形式")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="実行するシナリオ（複数指定可、省略時はすべて）")
+    parser.add_argument("--latency", type=float, default=0.2, help="偽のAPIの1回あたりの待ち時間（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="偽のAPIが一時的なエラーを返す割合")
+    parser.add_argument("--rpm", type=float, default=6000, help="1分あたりのリクエスト数の上限")
+    parser.add_argument("--backoff", type=float, default=0.05, help="再試行の待ち時間の基準（秒）")
+    parser.add_argument("--max-duration", type=float, default=10, help="分割する際の1パートの最大長（分）")
+    parser.add_argument("--seed", type=int, default=0, help="失敗を起こす乱数のシード")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = args.scenario or list(SCENARIOS)
+    
+    work_dir = tempfile.mkdtemp(prefix="whisper-bench-source-")
+    try:
+        source_path = os.path.join(work_dir, f"synthetic.{args.format}")
+        print(f"{args.duration:.0f}秒の音声を合成中（{args.format}）...", file=sys.stderr)
+        generate_audio(source_path, args.duration, args.format)
+        print(f"音声ファイル: {os.path.getsize(source_path) / (1024 * 1024):.1f} MB", file=sys.stderr)
+        
+        results = []
+        for name in scenarios:
+            print(f"{name} を実行中...", file=sys.stderr)
+            # 最大メモリ使用量をシナリオごとに計測するため、毎回新しいプロセスで実行する
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results.append(executor.submit(run_scenario, name, source_path, args).result())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Streamlitアプリの起動・再実行にかかる時間のベンチマーク
+
+Streamlitは操作のたびにスクリプトを先頭から実行し直すため、再実行1回あたりの時間が
+そのまま画面の反応の速さになる。新しいプロセスで次の時間を計測する。
+
+- transcriber パッケージの読み込み時間（コールドスタート）
+- 最初のスクリプトの実行時間（パッケージの読み込み・キャッシュするリソースの作成を含む）
+- 2回目以降の再実行の時間（中央値・90パーセンタイル）
+
+APIは呼び出さない（ダミーのAPIキーを使う）。履歴は一時的なフォルダに保存し、--history で件数を指定できる。
+
+使い方:
+    python benchmarks/bench_rerun.py
+    python benchmarks/bench_rerun.py --reruns 50 --history 300 --json rerun_output.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT_DIR, "streamlit_app.py")
+
+def measure_import(repeat):
+    """新しいPythonプロセスで transcriber を読み込む時間（ミリ秒）の中央値"""
+    code = "import time; t = time.perf_counter(); import transcriber; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        times.append(float(output.strip().splitlines()[-1]) * 1000)
+    return statistics.median(times)
+
+def run_app(reruns, history, cache_dir):
+    """新しいプロセスの中でアプリを実行し、最初の実行と再実行の時間（ミリ秒）を返す"""
+    os.environ["WHISPER_CACHE_DIR"] = cache_dir
+    sys.path.insert(0, ROOT_DIR)
+    from streamlit.testing.v1 import AppTest
+    
+    # 履歴は持ち主ごとに分かれているため、URLの持ち主のトークンと同じ持ち主として保存する
+    owner = "0" * 32
+    if history:
+        from transcriber import add_history
+        for i in range(history):
+            add_history(f"bench_{i}.mp3", "ベンチマーク用の文字起こし結果です。" * 50, [], owner)
+    
+    app = AppTest.from_file(APP_PATH, default_timeout=120)
+    app.secrets["OPENAI_API_KEY"] = "sk-bench"
+    app.query_params["owner"] = owner
+    
+    started = time.perf_counter()
+    app.run()
+    first_run = (time.perf_counter() - started) * 1000
+    if app.exception:
+        raise RuntimeError(f"アプリの実行に失敗しました: {app.exception[0].message}")
+    
+    times = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        times.append((time.perf_counter() - started) * 1000)
+    return first_run, times
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Streamlitアプリの起動・再実行にかかる時間のベンチマーク")
+    parser.add_argument("--reruns", type=int, default=20, help="再実行の回数")
+    parser.add_argument("--imports", type=int, default=5, help="パッケージの読み込み時間を計測する回数")
+    parser.add_argument("--history", type=int, default=0, help="あらかじめ保存しておく履歴の件数")
+    parser.add_argument("--json", help="結果をJSONで保存するファイル")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    import_ms = measure_import(args.imports)
+    
+    cache_dir = tempfile.mkdtemp(prefix="whisper-bench-rerun-")
+    try:
+        # 読み込み済みのモジュールの影響を受けないよう、新しいプロセスで実行する
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            first_run_ms, rerun_ms = executor.submit(run_app, args.reruns, args.history, cache_dir).result()
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    
+    result = {
+        "import_ms": import_ms,
+        "first_run_ms": first_run_ms,
+        "rerun_median_ms": statistics.median(rerun_ms),
+        "rerun_p90_ms": sorted(rerun_ms)[int(len(rerun_ms) * 0.9) - 1] if rerun_ms else 0.0
+    }
+    print(f"{'import_ms':>10}{'first_run_ms':>14}{'rerun_median_ms':>17}{'rerun_p90_ms':>14}")
+    print(f"{result['import_ms']:>10.1f}{result['first_run_ms']:>14.1f}"
+          f"{result['rerun_median_ms']:>17.1f}{result['rerun_p90_ms']:>14.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "result": result, "rerun_ms": rerun_ms}, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
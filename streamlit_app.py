@@ -1,19 +1,62 @@
 import time
 import streamlit as st
-from openai import OpenAI
 import tempfile
 import os
+import re
 from datetime import datetime
+import uuid
 import json
-import math
-from pydub import AudioSegment
+from transcriber import (
+    DEFAULT_MAX_WORKERS, CONTEXT_MODES, BACKGROUND_MAX_JOBS, JobQueue, configure_client, build_prompt,
+    EXPORT_FORMATS, Transcript, format_timestamp,
+    process_audio_file, process_audio_files, run_chunked_job, list_jobs, load_chunk_results, load_chunk_errors, delete_job,
+    count_history, list_history, load_history, delete_history, clear_history,
+    Trace, span, trace_to, prometheus_text, available_models, LIVE_IDLE_TIMEOUT, LIVE_WATCH_DIR,
+    LiveTranscriber, resolve_live_path, run_live_transcription, transcribe_recording
+)
 
-# OpenAIクライアントの初期化
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+# 履歴タブの1ページあたりの件数
+HISTORY_PAGE_SIZE = 10
 
-# セッション状態の初期化 - 履歴保存用
-if "transcription_history" not in st.session_state:
-    st.session_state.transcription_history = []
+# セグメントの表の高さ（ピクセル、表の中はスクロールして表示）
+SEGMENT_TABLE_HEIGHT = 400
+
+# 前のパートのテキストの引き継ぎ方の表示名
+CONTEXT_MODE_LABELS = {
+    "none": "引き継がない（最速）",
+    "refine": "文の途中で区切られたパートだけ送り直す",
+    "chain": "前のパートの完了を待って順に送る（グループごとに並列）"
+}
+
+@st.cache_resource
+def init_client(api_key, base_url):
+    """OpenAIクライアントの設定（プロセスで1回だけ行い、クライアントは最初のAPI呼び出しで作られる）"""
+    configure_client(api_key=api_key, base_url=base_url)
+
+# OpenAIクライアントの初期化（接続先はテスト用のモックサーバーなどに変更できる）
+init_client(st.secrets["OPENAI_API_KEY"], st.secrets.get("OPENAI_BASE_URL"))
+
+# 履歴の表示中のページと、本文・ダウンロードを表示する履歴のID
+if "history_page" not in st.session_state:
+    st.session_state.history_page = 0
+if "history_opened" not in st.session_state:
+    st.session_state.history_opened = set()
+
+# 表示中の結果（書き出した形式を保存しておき、再実行のたびに作り直さない）
+if "transcripts" not in st.session_state:
+    st.session_state.transcripts = {}
+
+# バックグラウンド処理・履歴・中断された処理の持ち主を表すトークン
+# （セッションは再読み込みや再接続で変わるため、URLのクエリパラメータに保存して同じブラウザーで使い続ける）
+if "owner" not in st.session_state:
+    owner_token = st.query_params.get("owner", "")
+    st.session_state.owner = owner_token if re.fullmatch(r"[0-9a-f]{32}", owner_token) else uuid.uuid4().hex
+if st.query_params.get("owner") != st.session_state.owner:
+    st.query_params["owner"] = st.session_state.owner
+
+# 結果を表示済みのバックグラウンド処理のID
+if "collected_jobs" not in st.session_state:
+    st.session_state.collected_jobs = set()
 
 # メインアプリのタイトル
 st.title("🎤 Whisper文字起こしアプリ")
@@ -24,156 +67,90 @@ st.info("📌 **注意**: OpenAI Whisper APIには以下の制限があります
         "- 音声の長さ: 最大25分（1500秒）\n\n"
         "※ 制限を超える場合は、自動分割処理を行います。")
 
-# タブ作成: 文字起こしと履歴
-tab1, tab2 = st.tabs(["文字起こし", "履歴"])
+# タブ作成: 文字起こし・ライブ文字起こし・履歴
+tab1, tab2, tab3 = st.tabs(["文字起こし", "ライブ文字起こし", "履歴"])
 
-# ユーティリティ関数 - 先に定義しておく
-def format_timestamp(seconds):
-    """秒数を MM:SS.MS 形式に変換"""
-    minutes = int(seconds // 60)
-    secs = int(seconds % 60)
-    millisecs = int((seconds % 1) * 1000)
-    return f"{minutes:02}:{secs:02}.{millisecs:03}"
+@st.cache_resource
+def get_job_queue():
+    """プロセスで1つだけのジョブキューを返す（スクリプトの再実行をまたいで共有）"""
+    return JobQueue(BACKGROUND_MAX_JOBS)
 
-def srt_timestamp(seconds):
-    """秒数をSRT形式のタイムスタンプに変換 (HH:MM:SS,MS)"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
-    millisecs = int((seconds % 1) * 1000)
-    
-    return f"{hours:02}:{minutes:02}:{secs:02},{millisecs:03}"
+def get_transcript(key, text, segments):
+    """結果を Transcript にして、セッションの間は同じものを使い回す"""
+    transcripts = st.session_state.transcripts
+    if key not in transcripts:
+        transcripts[key] = Transcript.from_segments(text, segments)
+    return transcripts[key]
 
-def create_timestamped_text(segments, time_offset=0):
-    """タイムスタンプ付きテキストを作成（オフセット付き）"""
-    timestamped_text = ""
-    
-    for segment in segments:
-        try:
-            # segment オブジェクトから直接属性にアクセス
-            if hasattr(segment, 'start') and hasattr(segment, 'end') and hasattr(segment, 'text'):
-                start_time = format_timestamp(segment.start + time_offset)
-                end_time = format_timestamp(segment.end + time_offset)
-                segment_text = segment.text
-            # dict の場合
-            elif isinstance(segment, dict):
-                start_time = format_timestamp(segment.get('start', 0) + time_offset)
-                end_time = format_timestamp(segment.get('end', 0) + time_offset)
-                segment_text = segment.get('text', '')
-            else:
-                start_time = "??:??"
-                end_time = "??:??"
-                segment_text = str(segment)
-                
-            timestamped_text += f"[{start_time} → {end_time}] {segment_text}\n\n"
-        except Exception as e:
-            timestamped_text += f"[エラー] セグメント処理エラー: {str(e)}\n\n"
-    
-    return timestamped_text
+def get_partial_transcript(job):
+    """処理中のジョブの途中までの結果を Transcript にする（途中の結果が更新されるまで使い回す）"""
+    key = f"partial_{job.id}"
+    partial = job.partial
+    cached = st.session_state.transcripts.get(key)
+    if cached is None or cached[0] is not partial:
+        cached = (partial, Transcript.from_segments(partial["text"], partial["segments"]))
+        st.session_state.transcripts[key] = cached
+    return cached[1]
 
-def convert_to_srt(segments, time_offset=0):
-    """Whisper APIの結果をSRT形式に変換（オフセット付き）"""
-    srt_content = ""
-    
-    for i, segment in enumerate(segments):
-        try:
-            # セグメントの開始・終了時間を取得
-            if hasattr(segment, 'start') and hasattr(segment, 'end') and hasattr(segment, 'text'):
-                start = segment.start + time_offset
-                end = segment.end + time_offset
-                text = segment.text
-            elif isinstance(segment, dict):
-                start = segment.get('start', 0) + time_offset
-                end = segment.get('end', 0) + time_offset
-                text = segment.get('text', '')
-            else:
-                continue  # 不明なセグメント形式はスキップ
-            
-            # SRT形式のタイムスタンプフォーマット (HH:MM:SS,MS)
-            start_time = srt_timestamp(start)
-            end_time = srt_timestamp(end)
-            
-            # SRTエントリーを追加
-            srt_content += f"{i+1}\n"
-            srt_content += f"{start_time} --> {end_time}\n"
-            srt_content += f"{text}\n\n"
-        except Exception as e:
-            # エラーが発生したセグメントはスキップ
-            continue
-    
-    return srt_content
+def show_segment_table(transcript):
+    """セグメントを表で表示する（表は見えている行だけを描画するため、数千件でも速く表示できる）"""
+    table = transcript.table()
+    st.dataframe(
+        {"開始": table["start"], "終了": table["end"], "テキスト": table["text"]},
+        hide_index=True,
+        use_container_width=True,
+        height=SEGMENT_TABLE_HEIGHT
+    )
 
-# 音声分割関数を追加
-def split_audio_file(file_path, max_duration=1440):
-    """音声ファイルを指定された最大長で分割する
-    
-    Args:
-        file_path: 音声ファイルのパス
-        max_duration: 最大分割長（秒）、デフォルトは24分
+def show_export_downloads(key, transcript, file_stem):
+    """ダウンロードボタンを表示する（テキスト以外の形式は選ばれてから作る）"""
+    col1, col2 = st.columns(2)
     
-    Returns:
-        分割されたファイルのパスのリスト
-    """
-    try:
-        # 音声を読み込む
-        st.info("音声ファイルの分割を準備中...")
-        audio = AudioSegment.from_file(file_path)
-        
-        # 総時間（ミリ秒）
-        total_duration_ms = len(audio)
-        total_duration_sec = total_duration_ms / 1000
-        
-        # 必要な分割数を計算
-        max_duration_ms = max_duration * 1000
-        num_parts = math.ceil(total_duration_ms / max_duration_ms)
-        
-        if num_parts <= 1:
-            # 分割の必要がない場合は元のファイルを返す
-            return [file_path]
-        
-        st.info(f"音声ファイルを{num_parts}個のパートに分割します（合計時間: {total_duration_sec:.1f}秒）")
-        
-        # 一時ファイルのパスのリスト
-        split_files = []
-        
-        # 分割して一時ファイルに保存
-        for i in range(num_parts):
-            start_ms = i * max_duration_ms
-            end_ms = min((i + 1) * max_duration_ms, total_duration_ms)
-            
-            # セグメント切り出し
-            segment = audio[start_ms:end_ms]
-            
-            # 一時ファイルに保存
-            format_ext = os.path.splitext(file_path)[1].lstrip('.')
-            if format_ext == '':
-                format_ext = 'mp3'  # デフォルトフォーマット
-                
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_ext}") as tmp_file:
-                segment_path = tmp_file.name
-                segment.export(segment_path, format=format_ext)
-                split_files.append(segment_path)
-            
-            st.info(f"パート {i+1}/{num_parts} を分割しました（{start_ms/1000:.1f}秒 → {end_ms/1000:.1f}秒）")
-        
-        return split_files
+    with col1:
+        # 通常テキストのダウンロード
+        st.download_button(
+            "テキストのみ (.txt)", 
+            transcript.export("txt"), 
+            file_name=f"{file_stem}.txt",
+            mime="text/plain",
+            key=f"{key}_txt"
+        )
     
-    except Exception as e:
-        st.error(f"音声ファイル分割エラー: {str(e)}")
-        import traceback
-        st.code(traceback.format_exc())
-        return [file_path]  # エラーの場合は元のファイルを返す
+    with col2:
+        # タイムスタンプ付きテキスト・字幕・JSON（字幕はセグメントがある場合のみ）
+        selected = st.selectbox(
+            "その他の形式",
+            [None] + [name for name in transcript.formats() if name != "txt"],
+            format_func=lambda name: "形式を選択..." if name is None else EXPORT_FORMATS[name][0],
+            key=f"{key}_format"
+        )
+        if selected:
+            label, ext, mime = EXPORT_FORMATS[selected]
+            suffix = "_タイムスタンプ付き" if selected == "timestamps" else ""
+            st.download_button(
+                f"{label}をダウンロード",
+                transcript.export(selected),
+                file_name=f"{file_stem}{suffix}{ext}",
+                mime=mime,
+                key=f"{key}_{selected}"
+            )
 
 # 文字起こしタブの内容
 with tab1:
-    # ファイルアップロード
-    audio = st.file_uploader(
+    # ファイルアップロード（複数のファイルをまとめて処理できる）
+    audio_files = st.file_uploader(
         "音声ファイルを選択", 
-        type=["mp3", "wav", "m4a", "mp4", "webm", "mpeg4"]
+        type=["mp3", "wav", "m4a", "mp4", "webm", "mpeg4"],
+        accept_multiple_files=True
     )
     
     # モデル選択
-    model = st.selectbox("モデルを選択", ["whisper-1", "gpt-4o-mini-transcribe"])
+    # faster-whisperがインストールされていれば、ローカルのCPUで動かすモデルも選べる
+    model = st.selectbox(
+        "モデルを選択",
+        available_models(),
+        help="faster-whisper- で始まるモデルは、音声をアップロードせずにこのサーバーのCPUで文字起こしします"
+    )
     
     # 詳細設定エリア
     with st.expander("詳細設定"):
@@ -182,10 +159,56 @@ with tab1:
         # 自動分割設定
         max_segment_duration = st.slider(
             "分割セグメントの最大長（分）", 
-            min_value=5, 
+            min_value=1, 
             max_value=24, 
             value=20,
-            help="制限を超える長い音声ファイルを分割する際の1セグメントあたりの最大長"
+            help="この長さを超える音声は分割し、パートを並列に文字起こしします"
+                 "（APIの制限の25分より短い音声も分割するため、短くするほど並列に処理できます）"
+        )
+        
+        # 並列処理設定
+        max_workers = st.slider(
+            "同時に処理するパート数",
+            min_value=1,
+            max_value=8,
+            value=DEFAULT_MAX_WORKERS,
+            help="分割したパートを並列でAPIに送信する数。大きくすると長い音声の処理が速くなります"
+        )
+        
+        # 送信前の変換設定
+        compress_audio = st.checkbox(
+            "送信前に音声を圧縮する",
+            value=True,
+            help="モノラル・16kHz・低ビットレートに変換してから送信します。アップロード量とAPI呼び出し回数が減ります"
+        )
+        
+        # 分割位置の設定
+        use_vad = st.checkbox(
+            "無音の位置で分割する",
+            value=True,
+            help="分割点を目標の長さ付近の無音区間に合わせ、単語の途中で切れるのを防ぎます"
+        )
+        drop_silence = st.checkbox(
+            "パート端の長い無音を送信しない",
+            value=False,
+            help="各パートの先頭・末尾にある長い無音を除外し、送信する音声の長さを減らします"
+        )
+        overlap_seconds = st.slider(
+            "パート間の重なり（秒）",
+            min_value=0,
+            max_value=10,
+            value=0,
+            help="隣り合うパートで音声を重ねて送信し、境界の前後の文脈を補います。重なった部分の重複は自動で取り除き、1つの文章につなぎます"
+        )
+        
+        # 前のパートのテキストをプロンプトに引き継ぐ方法（精度と処理時間のバランス）
+        context_mode = st.selectbox(
+            "前のパートの文脈の引き継ぎ",
+            CONTEXT_MODES,
+            format_func=CONTEXT_MODE_LABELS.get,
+            help="前のパートの末尾のテキストをプロンプトに加えると、パートの境界での書き起こしが自然になります。"
+                 "「送り直す」は並列に処理した後、文の途中で区切られたパートだけを引き継いで再送信します（API呼び出しが増えます）。"
+                 "「順に送る」はパートを同時に処理するパート数のグループに分け、グループの中では前のパートを待って送ります"
         )
         
         # 音声の種類
@@ -196,392 +219,455 @@ with tab1:
         
         # 固有名詞
         proper_nouns = st.text_input("固有名詞（カンマ区切り）", "")
+        
+        # 処理状況の表示
+        auto_refresh = st.checkbox("処理中は自動で表示を更新", value=True)
+        
+        # 段階ごとの処理時間などの表示
+        show_diagnostics = st.checkbox(
+            "診断情報を表示",
+            value=False,
+            help="読み込み・分割・変換・API呼び出し・統合・表示などの段階ごとに、処理時間・データ量・メモリ使用量の変化を表示します"
+        )
     
-    # 文字起こし関数の定義
-    def transcribe_audio(file_path, model_name, with_timestamps, context="", nouns=""):
-        try:
-            # プロンプト作成
-            prompt = ""
-            if context != "指定なし":
-                prompt += f"この音声は{context}です。"
-            
-            if nouns:
-                nouns_list = [n.strip() for n in nouns.replace("、", ",").split(",") if n.strip()]
-                if nouns_list:
-                    prompt += f" 次の固有名詞が含まれています: {', '.join(nouns_list)}。"
-            
-            # 進捗表示用のプレースホルダー
-            progress = st.progress(30, text="文字起こし中...")
-            
-            # 一時ファイルを開いてAPIに渡す
-            with open(file_path, "rb") as audio_file:
-                # APIオプション
-                options = {
-                    "model": model_name,
-                    "file": audio_file
-                }
-                
-                # タイムスタンプを追加（whisper-1でのみ使用可能）
-                if with_timestamps and model_name == "whisper-1":
-                    options["response_format"] = "verbose_json"
-                    options["timestamp_granularities"] = ["segment"]
-                else:
-                    options["response_format"] = "text"
-                
-                # プロンプトが指定されている場合は追加
-                if prompt:
-                    options["prompt"] = prompt
-                    st.info(f"使用するプロンプト: {prompt}")
-                
-                progress.progress(60, text="OpenAI APIに送信中...")
-                result = client.audio.transcriptions.create(**options)
-                
-            # 進捗を更新
-            progress.progress(100, text="完了!")
-            
-            return result
-        except Exception as e:
-            st.error(f"エラーが発生しました: {str(e)}")
-            import traceback
-            st.code(traceback.format_exc())
-            return None
+    # 文字起こしの設定（ライブ文字起こしでも同じ設定を使う）
+    settings = {
+        "model": model,
+        "with_timestamps": show_timestamps,
+        "prompt": build_prompt(audio_context, proper_nouns),
+        "compress": compress_audio,
+        "max_duration": max_segment_duration * 60,  # 分を秒に変換
+        "use_vad": use_vad,
+        "drop_silence": drop_silence,
+        "overlap": overlap_seconds,
+        "context_mode": context_mode
+    }
     
-    # 文字起こし実行ボタン
-    if audio and st.button("文字起こし開始"):
-        # ファイルサイズチェック - 25MB以上は警告表示
-        if audio.size > 25 * 1024 * 1024:  # 25MB
-            st.warning("⚠️ ファイルサイズが25MBを超えています。OpenAI APIの制限により処理できない可能性があります。")
-        
-        # ファイル情報表示
-        st.info(f"ファイル: {audio.name} ({audio.size} bytes)")
+    def show_transcription_result(key, result, file_stem=None):
+        """文字起こし結果を表示し、ダウンロードボタンを並べる（file_stem はダウンロードするファイル名）"""
+        plaintext = result["text"]
+        segments = result["segments"]
+        transcript = get_transcript(f"job_{key}", plaintext, segments)
         
-        # 一時ファイルに保存
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio.name)[1]) as tmp_file:
-            tmp_file.write(audio.getvalue())
-            tmp_file_path = tmp_file.name
+        if result["parts"] > 1:
+            st.subheader("文字起こし結果（複数パートを統合）")
+        else:
+            st.subheader("文字起こし結果")
         
-        # 音声の長さを取得して確認
-        try:
-            audio_segment = AudioSegment.from_file(tmp_file_path)
-            duration_seconds = len(audio_segment) / 1000
-            st.info(f"音声の長さ: {duration_seconds:.1f}秒（約{int(duration_seconds/60)}分{int(duration_seconds%60)}秒）")
-            
-            # APIの制限（1500秒 = 25分）を超える場合は分割処理
-            if duration_seconds > 1500:
-                st.warning(f"⚠️ 音声ファイルの長さがOpenAI APIの制限（25分）を超えています。自動分割処理を行います。")
-                
-                # 音声ファイルを分割（最大で指定された分数）
-                split_files = split_audio_file(
-                    tmp_file_path, 
-                    max_duration=max_segment_duration * 60  # 分を秒に変換
+        # 文字起こしできなかった区間（結果の中にも目印が入っている）
+        gaps = result.get("gaps", [])
+        if gaps:
+            st.warning(
+                f"⚠️ {len(gaps)}個の区間を文字起こしできませんでした"
+                + ("。「中断された処理」から、これらのパートだけを再実行できます。" if result["missing"] else "。")
+                + "\n\n" + "\n".join(
+                    f"- {format_timestamp(gap['start'])}〜{format_timestamp(gap['end'])}: {gap['error']}" for gap in gaps
                 )
-                
-                # 結果を保存するための変数
-                all_text = ""
-                all_segments = []
-                segment_offset = 0  # タイムスタンプオフセット（秒）
-                
-                # 各パートを処理
-                for i, part_file in enumerate(split_files):
-                    st.info(f"パート {i+1}/{len(split_files)} を処理中...")
-                    
-                    # 文字起こし実行
-                    result = transcribe_audio(
-                        file_path=part_file,
-                        model_name=model,
-                        with_timestamps=show_timestamps,
-                        context=audio_context,
-                        nouns=proper_nouns
+            )
+        elif result["missing"]:
+            st.warning(f"⚠️ {result['missing']}個のパートが未完了です。「中断された処理」から再開できます。")
+        
+        st.text_area("テキスト", plaintext, height=200 if segments else 300, key=f"result_text_{key}")
+        
+        # タイムスタンプ付きセグメント表示
+        if transcript.has_segments:
+            st.subheader("タイムスタンプ付きセグメント")
+            show_segment_table(transcript)
+        
+        # ダウンロードボタンエリア
+        st.subheader("結果のダウンロード")
+        show_export_downloads(
+            f"result_{key}",
+            transcript,
+            file_stem or f"文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        )
+    
+    # バックグラウンド処理のキュー（サーバー全体で共有）
+    job_queue = get_job_queue()
+    
+    # 中断された長い音声の処理（このブラウザーのもので、実行中でないもの）
+    unfinished_jobs = list_jobs(st.session_state.owner)
+    if unfinished_jobs:
+        with st.expander(f"中断された処理（{len(unfinished_jobs)}件）"):
+            for job in unfinished_jobs:
+                done_count = len(load_chunk_results(job["id"], len(job["chunks"])))
+                st.write(f"{job['created']} - {job['filename']}（{done_count}/{len(job['chunks'])} パート完了）")
+                # 前回失敗したパートの区間と理由
+                for index, error in load_chunk_errors(job["id"], len(job["chunks"])).items():
+                    chunk = job["chunks"][index]
+                    st.caption(
+                        f"❌ パート {index+1}（{format_timestamp(chunk.start)}〜{format_timestamp(chunk.end)}）: {error}"
                     )
-                    
-                    # 結果を蓄積
-                    if result:
-                        if isinstance(result, str):
-                            # テキスト形式の場合
-                            all_text += f"\n--- パート {i+1} ---\n\n" + result
-                        elif hasattr(result, 'text'):
-                            # verbose_json形式の場合
-                            all_text += f"\n--- パート {i+1} ---\n\n" + result.text
-                            
-                            # セグメント情報を保存（オフセット付き）
-                            if hasattr(result, 'segments'):
-                                # 各セグメントにオフセットを追加
-                                for segment in result.segments:
-                                    if hasattr(segment, 'start'):
-                                        # セグメントが直接属性を持つ場合
-                                        original_start = segment.start
-                                        original_end = segment.end
-                                        
-                                        # 今のところPythonでオブジェクトの属性を直接書き換えるのは難しいかもしれないので、
-                                        # 表示時にオフセットを考慮する方法を採用
-                                        all_segments.append({
-                                            'start': original_start + segment_offset,
-                                            'end': original_end + segment_offset,
-                                            'text': segment.text
-                                        })
-                                    elif isinstance(segment, dict):
-                                        # 辞書型の場合
-                                        segment_copy = segment.copy()
-                                        segment_copy['start'] = segment.get('start', 0) + segment_offset
-                                        segment_copy['end'] = segment.get('end', 0) + segment_offset
-                                        all_segments.append(segment_copy)
-                    
-                    # タイムスタンプオフセットを更新（次のパートのために）
-                    part_duration = len(AudioSegment.from_file(part_file)) / 1000
-                    segment_offset += part_duration
-                    
-                    # 一時ファイルを削除
-                    os.unlink(part_file)
-                
-                # 元の一時ファイルを削除
-                os.unlink(tmp_file_path)
-                
-                # 統合された結果を表示
-                st.subheader("文字起こし結果（複数パートを統合）")
-                st.text_area("テキスト", all_text, height=300)
-                
-                # タイムスタンプ付きセグメント表示
-                if show_timestamps and all_segments:
-                    st.subheader("タイムスタンプ付きセグメント")
-                    for segment in all_segments:
-                        try:
-                            if isinstance(segment, dict):
-                                start_time = format_timestamp(segment.get('start', 0))
-                                end_time = format_timestamp(segment.get('end', 0))
-                                segment_text = segment.get('text', '')
-                                st.markdown(f"**[{start_time} → {end_time}]** {segment_text}")
-                        except Exception as e:
-                            st.error(f"セグメント表示エラー: {str(e)}")
-                
-                # ダウンロードボタンエリア
-                st.subheader("結果のダウンロード")
-                col1, col2, col3 = st.columns(3)
-                
+                col1, col2 = st.columns(2)
                 with col1:
-                    # 通常テキストのダウンロード
-                    st.download_button(
-                        "テキストのみ (.txt)", 
-                        all_text, 
-                        file_name=f"文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                        mime="text/plain"
-                    )
-                
-                if all_segments:
-                    with col2:
-                        # タイムスタンプ付きテキストのダウンロード
-                        timestamped_text = ""
-                        for segment in all_segments:
-                            if isinstance(segment, dict):
-                                start = format_timestamp(segment.get('start', 0))
-                                end = format_timestamp(segment.get('end', 0))
-                                text = segment.get('text', '')
-                                timestamped_text += f"[{start} → {end}] {text}\n\n"
-                        
-                        st.download_button(
-                            "タイムスタンプ付きテキスト (.txt)",
-                            timestamped_text,
-                            file_name=f"文字起こし_タイムスタンプ付き_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                            mime="text/plain"
-                        )
-                    
-                    with col3:
-                        # SRT形式のダウンロード
-                        srt_content = ""
-                        for i, segment in enumerate(all_segments):
-                            if isinstance(segment, dict):
-                                start = srt_timestamp(segment.get('start', 0))
-                                end = srt_timestamp(segment.get('end', 0))
-                                text = segment.get('text', '')
-                                srt_content += f"{i+1}\n{start} --> {end}\n{text}\n\n"
-                        
-                        st.download_button(
-                            "字幕ファイル (.srt)",
-                            srt_content,
-                            file_name=f"文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}.srt",
-                            mime="text/plain"
+                    if st.button("再開", key=f"resume_{job['id']}"):
+                        job_queue.submit(
+                            st.session_state.owner,
+                            job["filename"],
+                            run_chunked_job,
+                            job,
+                            max_workers,
+                            incremental=True,
+                            history_owner=st.session_state.owner
                         )
-                
-                # 履歴に保存
-                st.session_state.transcription_history.append({
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "filename": audio.name,
-                    "text": all_text[:5000],  # 長すぎる場合は切り詰め
-                    "has_timestamps": bool(all_segments),
-                    "segments": all_segments if all_segments else []
-                })
-                st.success("結果を履歴に保存しました！")
-                
+                        st.success("バックグラウンドで再開しました。")
+                with col2:
+                    if st.button("削除", key=f"delete_job_{job['id']}"):
+                        delete_job(job["id"])
+                        st.rerun()
+    
+    # 文字起こし実行ボタン
+    if audio_files and st.button("文字起こし開始"):
+        # ファイル情報表示と一時ファイルへの保存
+        # アップロードされたバッファをコピーせずに（memoryview経由で）書き出す
+        trace = Trace()
+        uploaded = []
+        for audio in audio_files:
+            st.info(f"ファイル: {audio.name} ({audio.size} bytes)")
+            with trace_to(trace), span("upload", bytes=audio.size):
+                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio.name)[1]) as tmp_file:
+                    with audio.getbuffer() as view:
+                        tmp_file.write(view)
+                    uploaded.append((tmp_file.name, audio.name))
+        
+        # バックグラウンドで処理（処理中も画面の操作や他のファイルの追加ができる）
+        if len(uploaded) == 1:
+            tmp_file_path, filename = uploaded[0]
+            job_queue.submit(
+                st.session_state.owner,
+                filename,
+                process_audio_file,
+                tmp_file_path,
+                filename,
+                settings,
+                max_workers,
+                trace=trace,
+                incremental=True,
+                owner=st.session_state.owner,
+                history_owner=st.session_state.owner
+            )
+        else:
+            # 全ファイルのパートを1つのキューで処理し、同時に処理するパート数を使い切る
+            job_queue.submit(
+                st.session_state.owner,
+                f"{uploaded[0][1]} ほか{len(uploaded) - 1}件",
+                process_audio_files,
+                uploaded,
+                settings,
+                max_workers,
+                trace=trace,
+                incremental=True,
+                owner=st.session_state.owner,
+                history_owner=st.session_state.owner
+            )
+        st.success("バックグラウンドで文字起こしを開始しました。処理中も他の操作ができます。")
+    
+    # 処理状況
+    session_jobs = job_queue.jobs_for(st.session_state.owner)
+    if session_jobs:
+        st.header("処理状況")
+        if st.button("表示を更新"):
+            pass  # ボタンを押すとスクリプトが再実行され、最新の状況が表示される
+    
+    for job in session_jobs:
+        if job.status in ("queued", "running"):
+            status_text = job.messages[-1] if job.messages else "順番待ち..."
+            st.write(f"⏳ {job.filename}（{job.created}）")
+            if job.progress or job.partial is None:
+                st.progress(job.progress, text=status_text)
             else:
-                # APIの制限内の場合は通常処理
-                # 文字起こし実行
-                with st.spinner("文字起こし中..."):
-                    result = transcribe_audio(
-                        file_path=tmp_file_path,
-                        model_name=model,
-                        with_timestamps=show_timestamps,
-                        context=audio_context,
-                        nouns=proper_nouns
-                    )
-                
-                # 一時ファイルを削除
-                os.unlink(tmp_file_path)
-                
-                if result:
-                    # 結果表示（タイプによって分岐）
-                    has_segments = False
-                    segments = []
-                    
-                    if isinstance(result, str):
-                        # テキスト形式の場合
-                        st.subheader("文字起こし結果")
-                        st.text_area("テキスト", result, height=300)
-                        plaintext = result
-                    elif hasattr(result, 'text'):
-                        # verbose_json形式の場合
-                        st.subheader("文字起こし結果")
-                        st.text_area("テキスト", result.text, height=200)
-                        plaintext = result.text
-                        
-                        # タイムスタンプ付きセグメント表示
-                        if hasattr(result, 'segments'):
-                            has_segments = True
-                            segments = result.segments
-                            
-                            st.subheader("タイムスタンプ付きセグメント")
-                            for segment in segments:
-                                try:
-                                    start_time = format_timestamp(segment.start)
-                                    end_time = format_timestamp(segment.end)
-                                    st.markdown(f"**[{start_time} → {end_time}]** {segment.text}")
-                                except Exception as e:
-                                    st.error(f"セグメント表示エラー: {str(e)}")
-                    else:
-                        # その他の形式（JSON文字列など）
-                        st.subheader("文字起こし結果")
-                        if isinstance(result, dict) and 'text' in result:
-                            plaintext = result['text']
-                            # JSONからセグメント情報を取得
-                            if 'segments' in result:
-                                has_segments = True
-                                segments = result['segments']
-                        else:
-                            plaintext = str(result)
-                        st.text_area("テキスト", plaintext, height=300)
-                    
-                    # ダウンロードボタンエリア
-                    st.subheader("結果のダウンロード")
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        # 通常テキストのダウンロード
-                        st.download_button(
-                            "テキストのみ (.txt)", 
-                            plaintext, 
-                            file_name=f"文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                            mime="text/plain"
-                        )
-                    
-                    # タイムスタンプ付きテキストのダウンロード（セグメントがある場合のみ）
-                    if has_segments and segments:
-                        with col2:
-                            timestamped_text = create_timestamped_text(segments)
-                            st.download_button(
-                                "タイムスタンプ付きテキスト (.txt)",
-                                timestamped_text,
-                                file_name=f"文字起こし_タイムスタンプ付き_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                                mime="text/plain"
-                            )
-                        
-                        with col3:
-                            # SRT形式のダウンロード
-                            srt_content = convert_to_srt(segments)
-                            st.download_button(
-                                "字幕ファイル (.srt)",
-                                srt_content,
-                                file_name=f"文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}.srt",
-                                mime="text/plain"
+                st.caption(status_text)  # ライブ文字起こしは終わりが決まっていない
+            
+            # 完了したパート・ウィンドウまでの途中の結果を表示
+            # （key を付けたウィジェットは value の変更を反映しないため、表示する値は session_state に入れる）
+            if job.partial is not None:
+                if "files" in job.partial:
+                    # 複数のファイルはテキストだけを、結果が出始めたファイルから表示
+                    for n, file_partial in enumerate(job.partial["files"]):
+                        if file_partial["text"]:
+                            st.session_state[f"partial_text_{job.id}_{n}"] = file_partial["text"]
+                            st.text_area(
+                                f"途中までの結果（{file_partial['filename']}）",
+                                height=150,
+                                key=f"partial_text_{job.id}_{n}"
                             )
-                    
-                    # 履歴に保存
-                    st.session_state.transcription_history.append({
-                        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "filename": audio.name,
-                        "text": plaintext[:5000],  # 長すぎる場合は切り詰め
-                        "has_timestamps": has_segments,
-                        "segments": segments if has_segments else []
-                    })
-                    st.success("結果を履歴に保存しました！")
+                else:
+                    partial = get_partial_transcript(job)
+                    st.session_state[f"partial_text_{job.id}"] = partial.text
+                    st.text_area(f"途中までの結果（{job.filename}）", height=200, key=f"partial_text_{job.id}")
+                    if partial.has_segments:
+                        show_segment_table(partial)
+                if st.button("停止", key=f"stop_{job.id}"):
+                    job.stop()
+            continue
+        
+        job.collected = True  # 結果を表示したので、期限が来たらキューから取り除いてよい
+        if job.status == "failed":
+            st.error(f"❌ {job.filename}（{job.created}）: エラーが発生しました")
+            st.code(job.error)
+        else:
+            # 結果は処理したスレッドで履歴に保存済み（画面に表示されなくても失われない）
+            # 複数のファイルをまとめて処理した場合は、ファイルごとに表示する
+            if "files" in job.result:
+                file_results = [
+                    (f"{job.id}_{n}", result) for n, result in enumerate(job.result["files"])
+                    if result["error"] is None and not result["stopped"]
+                ]
+            else:
+                file_results = [(job.id, dict(job.result, filename=job.filename))]
+            
+            if job.id not in st.session_state.collected_jobs:
+                st.session_state.collected_jobs.add(job.id)
+                st.session_state.transcripts.pop(f"partial_{job.id}", None)
+            
+            for result in job.result.get("files", []):
+                if result["error"] is not None:
+                    st.error(f"❌ {result['filename']}: {result['error']}")
+                elif result["stopped"]:
+                    st.warning(f"⏹ {result['filename']}: 停止したため文字起こししませんでした")
+            
+            for key, result in file_results:
+                with st.expander(f"✅ {result['filename']}（{job.created}）", expanded=True):
+                    with trace_to(job.trace), span("render"):
+                        show_transcription_result(
+                            key,
+                            result,
+                            f"{os.path.splitext(result['filename'])[0]}_文字起こし" if "files" in job.result else None
+                        )
+                    if result.get("history_id") is not None:
+                        st.success("結果を履歴に保存しました！")
         
-        except Exception as e:
-            st.error(f"音声ファイルの長さ取得エラー: {str(e)}")
-            import traceback
-            st.code(traceback.format_exc())
+        with st.expander("処理ログ"):
+            st.text("\n".join(job.messages))
+        if show_diagnostics:
+            with st.expander("診断情報"):
+                st.table([
+                    {
+                        "段階": row["stage"],
+                        "回数": row["count"],
+                        "合計秒": round(row["seconds"], 3),
+                        "データ量 MB": round(row["bytes"] / (1024 * 1024), 2),
+                        "メモリ増減 MB": round(row["rss_delta_mb"], 1),
+                        "エラー": row["errors"]
+                    }
+                    for row in job.trace.summary()
+                ])
+                st.download_button(
+                    label="計測記録（JSON Lines）をダウンロード",
+                    data="".join(json.dumps(record, ensure_ascii=False) + "\n" for record in list(job.trace.spans)),
+                    file_name=f"trace_{job.id}.jsonl",
+                    mime="application/x-ndjson",
+                    key=f"trace_{job.id}"
+                )
+        if st.button("閉じる", key=f"dismiss_{job.id}"):
+            job_queue.remove(job.id)
+            for key in [key for key in st.session_state.transcripts if key.startswith((f"job_{job.id}", f"partial_{job.id}"))]:
+                st.session_state.transcripts.pop(key)
+            st.rerun()
+    
+    # サーバー全体の集計（Prometheusのテキスト形式）
+    if show_diagnostics:
+        with st.expander("サーバー全体の計測値（Prometheus形式）"):
+            st.code(prometheus_text())
+
+# ライブ文字起こしタブの内容
+mic_jobs = []
+with tab2:
+    st.header("ライブ文字起こし")
+    st.write("録音中の音声を発話の切れ目ごとに送信し、録音の終了を待たずに結果を追加していきます。"
+             "結果は履歴にも順に保存されます。モデルと詳細設定は「文字起こし」タブの設定を使います。")
+    
+    live_source = st.radio("音声の入力", ["マイク", "書き込み中のファイル"], horizontal=True)
+    
+    if live_source == "マイク":
+        if not hasattr(st, "audio_input"):
+            st.warning("マイクからの録音には、st.audio_input に対応したバージョンのStreamlitが必要です。")
+        else:
+            if "live_mic" not in st.session_state:
+                st.session_state.live_mic = None
+                st.session_state.live_mic_log = []
+                st.session_state.live_mic_recordings = set()
             
-            # エラーが発生しても通常処理を試みる
-            st.warning("音声ファイルの長さを取得できませんでしたが、処理を続行します。")
+            st.caption("録音を止めるたびに、その録音をこれまでの結果の続きとして文字起こしします。")
+            mic_session = f"{st.session_state.owner}:mic"  # 録音の処理は「処理状況」とは別に、ここで表示する
+            recording = st.audio_input("録音")
             
-            # 以下、通常の文字起こし処理（上記のコードと同様なので省略）
-            with st.spinner("文字起こし中..."):
-                result = transcribe_audio(
-                    file_path=tmp_file_path,
-                    model_name=model,
-                    with_timestamps=show_timestamps,
-                    context=audio_context,
-                    nouns=proper_nouns
+            # 新しい録音だけを、これまでの録音の続きとして処理
+            if recording is not None and recording.file_id not in st.session_state.live_mic_recordings:
+                st.session_state.live_mic_recordings.add(recording.file_id)
+                if st.session_state.live_mic is None:
+                    live_log = st.session_state.live_mic_log
+                    
+                    def report_live(message=None, progress=None):
+                        if message is not None:
+                            live_log.append(message)
+                    
+                    st.session_state.live_mic = LiveTranscriber(
+                        settings,
+                        history_filename=f"マイク録音_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+                        report=report_live,
+                        history_owner=st.session_state.owner
+                    )
+                with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(recording.name)[1] or ".wav") as tmp_file:
+                    with recording.getbuffer() as view:
+                        tmp_file.write(view)
+                    recording_path = tmp_file.name
+                # バックグラウンドで処理（録音した順に結果へ追加される）
+                job_queue.submit(
+                    mic_session,
+                    recording.name,
+                    transcribe_recording,
+                    st.session_state.live_mic,
+                    recording_path,
+                    st.session_state.live_mic.reserve_turn()
                 )
             
-            # 処理結果の表示（エラー処理のため省略）
-            # ...
+            # 録音の処理状況（終わったものはキューから取り除き、失敗したものだけを表示する）
+            mic_jobs = job_queue.jobs_for(mic_session)
+            for job in mic_jobs:
+                if job.status == "failed":
+                    st.error(f"録音の文字起こしに失敗しました: {job.error.splitlines()[0]}")
+                    with st.expander("詳細"):
+                        st.code(job.error)
+                    if st.button("閉じる", key=f"dismiss_{job.id}"):
+                        job_queue.remove(job.id)
+                        st.rerun()
+                elif job.status == "done":
+                    job_queue.remove(job.id)
+            if any(job.status in ("queued", "running") for job in mic_jobs):
+                st.info("⏳ 録音を文字起こししています...")
+                if st.button("表示を更新", key="refresh_live_mic"):
+                    pass  # ボタンを押すとスクリプトが再実行され、最新の結果が表示される
+            
+            live = st.session_state.live_mic
+            if live is not None:
+                st.subheader(f"文字起こし結果（{live.received / live.sample_rate:.1f}秒）")
+                # 結果は録音を追加したときだけ変わるため、その状態をキーに使い回す（前の状態の結果は捨てる）
+                live_key = (
+                    f"live_mic_{len(st.session_state.live_mic_recordings)}_{live.windows}_"
+                    f"{len(live.segments)}_{len(live.text)}"
+                )
+                if st.session_state.get("live_mic_key", live_key) != live_key:
+                    st.session_state.transcripts.pop(st.session_state.live_mic_key, None)
+                st.session_state.live_mic_key = live_key
+                live_transcript = get_transcript(live_key, live.text, live.segments)
+                st.text_area("テキスト", live.text, height=200 if live.segments else 300)
+                if live_transcript.has_segments:
+                    show_segment_table(live_transcript)
+                show_export_downloads(
+                    "live_mic",
+                    live_transcript,
+                    f"ライブ文字起こし_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                )
+                with st.expander("処理ログ"):
+                    st.text("\n".join(st.session_state.live_mic_log))
+                if st.button("新しい録音を始める"):
+                    st.session_state.live_mic = None
+                    st.session_state.live_mic_log = []
+                    st.rerun()
+    elif not LIVE_WATCH_DIR:
+        # 任意のパスを読めないように、録音用のディレクトリが設定されている場合だけ使える
+        st.info(
+            "書き込み中のファイルの文字起こしは、サーバーで環境変数 WHISPER_LIVE_DIR に録音用のディレクトリを"
+            "設定すると使えます。コマンドラインからは `python -m transcriber --follow` で使えます。"
+        )
+    else:
+        live_name_input = st.text_input(
+            "ファイル名",
+            help="サーバーの録音用のディレクトリで録音ソフトなどが書き込み中のファイル"
+                 "（mp3・ogg・webm・wav など先頭から順に読める形式）"
+        )
+        st.caption(f"ファイルが{LIVE_IDLE_TIMEOUT}秒間更新されないと、録音が終わったとみなして終了します。")
+        if live_name_input and st.button("ライブ文字起こし開始"):
+            try:
+                live_path = resolve_live_path(live_name_input)
+                if not os.path.isfile(live_path):
+                    raise ValueError("ファイルが見つかりません。")
+            except ValueError as e:
+                st.error(str(e))
+            else:
+                live_name = os.path.basename(live_path)
+                job_queue.submit(
+                    st.session_state.owner,
+                    live_name,
+                    run_live_transcription,
+                    live_path,
+                    live_name,
+                    settings,
+                    owner=st.session_state.owner,
+                    incremental=True
+                )
+                st.success("バックグラウンドで開始しました。結果は「文字起こし」タブの処理状況に順に表示されます。")
 
 # 履歴タブの内容
-with tab2:
+with tab3:
     st.header("文字起こし履歴")
     
-    if not st.session_state.transcription_history:
+    # 履歴はこのブラウザーのものだけを表示・操作する（他の利用者の履歴は見えない）
+    history_owner = st.session_state.owner
+    history_count = count_history(history_owner)
+    if not history_count:
         st.info("まだ履歴がありません。文字起こしを実行すると、ここに結果が表示されます。")
     else:
+        # ページ送り（1ページ分だけを読み込んで表示する）
+        num_pages = (history_count + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        page = min(st.session_state.history_page, num_pages - 1)
+        col1, col2, col3 = st.columns([1, 2, 1])
+        with col1:
+            if st.button("← 新しい履歴", disabled=page == 0):
+                st.session_state.history_page = page - 1
+                st.rerun()
+        with col2:
+            st.write(f"{page + 1} / {num_pages} ページ（全{history_count}件）")
+        with col3:
+            if st.button("古い履歴 →", disabled=page >= num_pages - 1):
+                st.session_state.history_page = page + 1
+                st.rerun()
+        
         # 履歴の表示（新しい順）
-        for i, item in enumerate(reversed(st.session_state.transcription_history)):
-            with st.expander(f"{item['timestamp']} - {item['filename']}"):
+        for entry in list_history(page * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE, history_owner):
+            history_id = entry["id"]
+            with st.expander(f"{entry['timestamp']} - {entry['filename']}（{entry['chars']}文字）"):
+                if history_id not in st.session_state.history_opened:
+                    # 本文は開くまで読み込まない
+                    st.write(entry["preview"] + ("…" if entry["chars"] > len(entry["preview"]) else ""))
+                    if st.button("全文とダウンロードを表示", key=f"open_history_{history_id}"):
+                        st.session_state.history_opened.add(history_id)
+                        st.rerun()
+                    continue
+                
+                item = load_history(history_id, history_owner)
+                if item is None:
+                    st.warning("この履歴は削除されました。")
+                    continue
+                
                 st.text_area(
                     "文字起こし結果", 
                     item["text"], 
                     height=200,
-                    key=f"history_{i}"
+                    key=f"history_{history_id}"
                 )
                 
                 # ダウンロードボタン - 履歴からも異なる形式でダウンロード可能に
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    st.download_button(
-                        "テキストを保存", 
-                        item["text"], 
-                        file_name=f"{item['filename']}_{item['timestamp']}.txt",
-                        key=f"download_txt_{i}"
-                    )
+                show_export_downloads(
+                    f"download_{history_id}",
+                    get_transcript(f"history_{history_id}", item["text"], item["segments"]),
+                    f"{item['filename']}_{item['timestamp']}"
+                )
                 
-                # タイムスタンプ情報がある場合は追加のダウンロードオプションを表示
-                if item.get("has_timestamps", False) and item.get("segments"):
-                    with col2:
-                        timestamped_text = create_timestamped_text(item["segments"])
-                        st.download_button(
-                            "タイムスタンプ付きテキスト",
-                            timestamped_text,
-                            file_name=f"{item['filename']}_{item['timestamp']}_timestamps.txt",
-                            key=f"download_timestamps_{i}"
-                        )
-                    
-                    with col3:
-                        srt_content = convert_to_srt(item["segments"])
-                        st.download_button(
-                            "字幕ファイル (.srt)",
-                            srt_content,
-                            file_name=f"{item['filename']}_{item['timestamp']}.srt",
-                            key=f"download_srt_{i}"
-                        )
+                if st.button("この履歴を削除", key=f"delete_history_{history_id}"):
+                    delete_history(history_id, history_owner)
+                    st.session_state.transcripts.pop(f"history_{history_id}", None)
+                    st.rerun()
         
         # 履歴クリアボタン
         if st.button("履歴をクリア"):
-            st.session_state.transcription_history = []
-            st.experimental_rerun()  # 画面を更新
+            clear_history(history_owner)
+            st.session_state.transcripts = {}
+            st.session_state.history_page = 0
+            st.rerun()  # 画面を更新
+
+# 処理中のバックグラウンド処理があれば、少し待ってから表示を更新
+if auto_refresh and any(job.status in ("queued", "running") for job in session_jobs + mic_jobs):
+    time.sleep(2)
+    st.rerun()
@@ -0,0 +1,113 @@
+"""API呼び出しの流量制限・再試行のテスト"""
+import time
+import pytest
+from transcriber import api
+from transcriber.api import TokenBucket
+
+@pytest.mark.parametrize("value, expected", [
+    (None, api.API_REQUESTS_PER_MINUTE_DEFAULT),
+    ("", api.API_REQUESTS_PER_MINUTE_DEFAULT),
+    ("120", 120),
+    ("0", 0),
+    ("-5", 0),
+])
+def test_requests_per_minute(value, expected):
+    assert api._requests_per_minute(value) == expected
+
+def test_requests_per_minute_warns_on_invalid_value():
+    with pytest.warns(UserWarning, match="WHISPER_API_RPM"):
+        assert api._requests_per_minute("fast") == api.API_REQUESTS_PER_MINUTE_DEFAULT
+
+def test_token_bucket_without_limit_does_not_wait():
+    bucket = TokenBucket(0, 1)
+    started = time.monotonic()
+    for _ in range(100):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.1
+
+def test_token_bucket_waits_after_burst():
+    # 2個まで続けて取れ、3個目は補充（20個/秒）を待つ
+    bucket = TokenBucket(20, 2)
+    started = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.04
+
+def status_error(status_code, headers=None):
+    """status_code の応答に対してOpenAIのクライアントが送出する例外"""
+    import httpx
+    from openai import APIStatusError, BadRequestError, InternalServerError, RateLimitError
+    
+    error_class = {400: BadRequestError, 429: RateLimitError, 500: InternalServerError}.get(status_code, APIStatusError)
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "http://localhost/"))
+    return error_class("error", response=response, body=None)
+
+def test_retryable_errors():
+    import httpx
+    from openai import APIConnectionError, APITimeoutError
+    
+    request = httpx.Request("POST", "http://localhost/")
+    assert api.is_retryable_error(status_error(429))
+    assert api.is_retryable_error(status_error(500))
+    assert api.is_retryable_error(status_error(503))
+    assert api.is_retryable_error(APIConnectionError(request=request))
+    assert api.is_retryable_error(APITimeoutError(request=request))
+    assert not api.is_retryable_error(status_error(400))
+    assert not api.is_retryable_error(ValueError("bad"))
+
+def test_retry_after_header():
+    assert api._retry_after(status_error(429, {"retry-after": "3"})) == 3.0
+    assert api._retry_after(status_error(429, {"retry-after": "soon"})) is None
+    assert api._retry_after(status_error(429)) is None
+    assert api._retry_after(ValueError("bad")) is None
+
+def test_backoff_delay_waits_at_least_retry_after():
+    for attempt in range(10):
+        delay = api.backoff_delay(attempt)
+        assert 0 <= delay <= min(api.API_BACKOFF_MAX, api.API_BACKOFF_BASE * 2 ** attempt)
+    assert api.backoff_delay(0, retry_after=7.5) >= 7.5
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """call_with_retries の待ち時間を記録して、実際には待たない"""
+    waited = []
+    monkeypatch.setattr(api.time, "sleep", waited.append)
+    monkeypatch.setattr(api, "rate_limiter", TokenBucket(0, 1))
+    return waited
+
+def test_call_with_retries_retries_transient_errors(sleeps):
+    errors = [status_error(429, {"retry-after": "2"}), status_error(500)]
+    
+    def call():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+    
+    assert api.call_with_retries(call, max_retries=3) == "ok"
+    assert len(sleeps) == 2 and sleeps[0] >= 2
+
+def test_call_with_retries_raises_permanent_errors_at_once(sleeps):
+    from openai import BadRequestError
+    
+    calls = []
+    
+    def call():
+        calls.append(1)
+        raise status_error(400)
+    
+    with pytest.raises(BadRequestError):
+        api.call_with_retries(call, max_retries=3)
+    assert len(calls) == 1 and sleeps == []
+
+def test_call_with_retries_gives_up_after_max_retries(sleeps):
+    from openai import RateLimitError
+    
+    calls = []
+    
+    def call():
+        calls.append(1)
+        raise status_error(429)
+    
+    with pytest.raises(RateLimitError):
+        api.call_with_retries(call, max_retries=2)
+    assert len(calls) == 3 and len(sleeps) == 2
@@ -0,0 +1,75 @@
+"""音声の分割計画（無音の位置での分割・サンプル数で表した計画）のテスト"""
+import numpy as np
+from transcriber import audio
+from transcriber.audio import AudioChunk, VAD_FRAME_SEC, add_chunk_overlap, plan_audio_chunks, plan_chunks_by_silence
+
+SAMPLE_RATE = 16000
+FRAMES_PER_SEC = round(1 / VAD_FRAME_SEC)
+
+def energy(seconds, silences=()):
+    """seconds 秒の音量（-20dB）のうち、silences の (開始秒, 終了秒) の区間を無音（-60dB）にしたもの"""
+    energy_db = np.full(seconds * FRAMES_PER_SEC, -20.0, dtype=np.float32)
+    for start, end in silences:
+        energy_db[round(start * FRAMES_PER_SEC):round(end * FRAMES_PER_SEC)] = -60.0
+    return energy_db
+
+def plan(energy_db, max_duration, **kwargs):
+    total_samples = round(len(energy_db) * VAD_FRAME_SEC * SAMPLE_RATE)
+    return plan_chunks_by_silence(energy_db, total_samples, SAMPLE_RATE, max_duration, **kwargs)
+
+def test_cut_is_placed_in_middle_of_silence():
+    chunks = plan(energy(25, silences=[(8.0, 8.6), (17.0, 17.6)]), max_duration=10)
+    assert [round(chunk.end, 1) for chunk in chunks[:-1]] == [8.3, 17.3]
+    assert all(chunk.duration <= 10 for chunk in chunks)
+
+def test_cut_prefers_silence_closest_to_target():
+    # 探す範囲に同じくらい静かな無音が2つあれば、目標位置（10秒）に近い方で区切る
+    chunks = plan(energy(15, silences=[(6.0, 6.6), (9.0, 9.6)]), max_duration=10)
+    assert round(chunks[0].end, 1) == 9.3
+
+def test_cut_at_max_duration_without_silence():
+    chunks = plan(energy(25), max_duration=10)
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(0.0, 10.0), (10.0, 20.0), (20.0, 25.0)]
+
+def test_drop_silence_trims_long_silence_and_skips_silent_parts():
+    # 長い無音は前後に余白（0.2秒）を残して外し、全体が無音のパートは送らない
+    chunks = plan(energy(30, silences=[(0.0, 3.0), (9.8, 20.2)]), max_duration=10, drop_silence=True)
+    assert [round(chunk.start, 2) for chunk in chunks[:2]] == [2.8, 20.0]
+    assert round(chunks[0].end, 2) == 9.95
+
+def test_empty_energy_is_single_part():
+    chunks = plan_chunks_by_silence(np.zeros(0, dtype=np.float32), 16000, SAMPLE_RATE, 10)
+    assert [(chunk.start_sample, chunk.end_sample) for chunk in chunks] == [(0, 16000)]
+
+def test_plan_covers_every_sample():
+    # 44.1kHzのように1フレームが整数のサンプル数にならなくても、隙間なく最後のサンプルまで区切る
+    energy_db = energy(25, silences=[(8.0, 8.6)])
+    total_samples = 25 * 44100 + 7
+    chunks = plan_chunks_by_silence(energy_db, total_samples, 44100, max_duration=10)
+    assert chunks[0].start_sample == 0 and chunks[-1].end_sample == total_samples
+    assert all(prev.end_sample == chunk.start_sample for prev, chunk in zip(chunks, chunks[1:]))
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+
+def test_audio_chunk_round_trip():
+    chunk = AudioChunk(2, 441000, 882000, 44100, source="part.ogg")
+    assert (chunk.start, chunk.end, chunk.duration) == (10.0, 20.0, 10.0)
+    # ジョブには音声を含めずに保存する
+    assert AudioChunk.from_dict(chunk.to_dict()) == chunk._replace(source=None)
+
+def test_overlap_extends_start_except_after_dropped_silence():
+    chunks = [AudioChunk(0, 0, 160000, 16000), AudioChunk(1, 160000, 320000, 16000), AudioChunk(2, 400000, 480000, 16000)]
+    overlapped = add_chunk_overlap(chunks, 2)
+    assert [chunk.start_sample for chunk in overlapped] == [0, 128000, 400000]
+    assert [chunk.end_sample for chunk in overlapped] == [160000, 320000, 480000]
+
+def test_fixed_length_plan_is_sample_exact(monkeypatch):
+    monkeypatch.setattr(audio, "probe_audio", lambda path: {"duration": 25.5, "sample_rate": 44100, "channels": 2})
+    chunks = plan_audio_chunks("audio.wav", max_duration=10, use_vad=False, max_bytes=None, bytes_per_second=3000)
+    assert [(chunk.start_sample, chunk.end_sample) for chunk in chunks] == [
+        (0, 441000), (441000, 882000), (882000, 1124550)
+    ]
+
+def test_short_audio_is_single_part(monkeypatch):
+    monkeypatch.setattr(audio, "probe_audio", lambda path: {"duration": 5.0, "sample_rate": 16000, "channels": 1})
+    chunks = plan_audio_chunks("audio.wav", max_duration=10, max_bytes=None, bytes_per_second=3000)
+    assert chunks == [AudioChunk(0, 0, 80000, 16000)]
@@ -0,0 +1,86 @@
+"""文字起こし結果のキャッシュのテスト"""
+import sqlite3
+import pytest
+from transcriber import cache
+from transcriber.cache import cache_get, cache_put, cached_transcription, transcription_cache_key
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(cache, "CACHE_DB_PATH", str(tmp_path / "transcriptions.sqlite3"))
+    return tmp_path
+
+@pytest.fixture
+def clock(monkeypatch):
+    """cache の time.time() を1秒ずつ進む時計に置き換える"""
+    now = [1000.0]
+    
+    def tick():
+        now[0] += 1
+        return now[0]
+    monkeypatch.setattr(cache.time, "time", tick)
+
+def test_cache_key_depends_on_every_part():
+    key = transcription_cache_key("audio", "whisper-1", "text", "会議")
+    assert key == transcription_cache_key("audio", "whisper-1", "text", "会議")
+    assert len({
+        key,
+        transcription_cache_key("other", "whisper-1", "text", "会議"),
+        transcription_cache_key("audio", "gpt-4o-transcribe", "text", "会議"),
+        transcription_cache_key("audio", "whisper-1", "verbose_json", "会議"),
+        transcription_cache_key("audio", "whisper-1", "text", ""),
+    }) == 5
+
+def test_cache_round_trip(cache_dir):
+    assert cache_get("missing") is None
+    cache_put("key", {"text": "こんにちは", "segments": []})
+    assert cache_get("key") == {"text": "こんにちは", "segments": []}
+
+def test_cache_evicts_least_recently_used(cache_dir, clock):
+    value = {"text": "x" * 100, "segments": []}
+    size = len(cache.json.dumps(value, ensure_ascii=False))
+    cache_put("a", value, max_bytes=size * 2)
+    cache_put("b", value, max_bytes=size * 2)
+    # a を使うと、最後に使われたのが最も古い b が削除される
+    assert cache_get("a") is not None
+    cache_put("c", value, max_bytes=size * 2)
+    assert cache_get("b") is None
+    assert cache_get("a") is not None and cache_get("c") is not None
+
+def test_cache_connections_are_closed(cache_dir, monkeypatch):
+    connections = []
+    connect = sqlite3.connect
+    
+    def recording_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        connections.append(conn)
+        return conn
+    monkeypatch.setattr(cache.sqlite3, "connect", recording_connect)
+    
+    cache_put("key", {"text": "", "segments": []})
+    cache_get("key")
+    assert len(connections) == 2
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+
+def test_cached_transcription_reuses_result(cache_dir, monkeypatch):
+    calls = []
+    
+    class Engine:
+        remote = True
+        
+        def response_format(self, model_name, with_timestamps):
+            return "text"
+        
+        def transcribe(self, source, model_name, with_timestamps, prompt=""):
+            calls.append(source)
+            return "こんにちは"
+    monkeypatch.setattr(cache, "get_engine", lambda model_name: Engine())
+    
+    source = ("part.mp3", b"audio")
+    assert cached_transcription(source, "whisper-1", False) == {"text": "こんにちは", "segments": [], "cached": False}
+    assert cached_transcription(source, "whisper-1", False) == {"text": "こんにちは", "segments": [], "cached": True}
+    # プロンプトが異なれば送り直す
+    assert cached_transcription(source, "whisper-1", False, "会議")["cached"] is False
+    assert len(calls) == 2
@@ -0,0 +1,60 @@
+"""文字起こし結果の書き出し（Transcript）のテスト"""
+import json
+from types import SimpleNamespace
+from transcriber.export import Transcript, create_timestamped_text, convert_to_srt, srt_timestamp, vtt_timestamp
+
+SEGMENTS = [
+    {"start": 0.0, "end": 1.5, "text": " こんにちは。"},
+    {"start": 3661.25, "end": 3662.0, "text": " さようなら。"},
+]
+
+def transcript():
+    return Transcript.from_segments("こんにちは。さようなら。", SEGMENTS)
+
+def test_timestamps():
+    assert srt_timestamp(3661.25) == "01:01:01,250"
+    assert vtt_timestamp(3661.25) == "01:01:01.250"
+
+def test_srt():
+    assert transcript().export("srt") == (
+        "1\n00:00:00,000 --> 00:00:01,500\n こんにちは。\n\n"
+        "2\n01:01:01,250 --> 01:01:02,000\n さようなら。\n\n"
+    )
+
+def test_vtt():
+    assert transcript().export("vtt") == (
+        "WEBVTT\n\n"
+        "00:00:00.000 --> 00:00:01.500\nこんにちは。\n\n"
+        "01:01:01.250 --> 01:01:02.000\nさようなら。\n\n"
+    )
+
+def test_json():
+    assert json.loads(transcript().export("json")) == {"text": "こんにちは。さようなら。", "segments": SEGMENTS}
+
+def test_timestamped_text():
+    assert transcript().export("timestamps") == (
+        "[00:00.000 → 00:01.500]  こんにちは。\n\n"
+        "[61:01.250 → 61:02.000]  さようなら。\n\n"
+    )
+
+def test_export_is_made_once():
+    result = transcript()
+    assert result.export("srt") is result.export("srt")
+
+def test_formats_without_segments():
+    result = Transcript("テキストだけ")
+    assert not result.has_segments
+    assert result.formats() == ["txt", "json"]
+    assert result.export("txt") == "テキストだけ"
+
+def test_from_segments_accepts_objects_and_offset():
+    segments = [SimpleNamespace(start=0.0, end=1.0, text="一。"), {"start": 1.0, "end": 2.0, "text": "二。"}, "不明"]
+    result = Transcript.from_segments("一。二。", segments, time_offset=10)
+    assert result.segments() == [
+        {"start": 10.0, "end": 11.0, "text": "一。"}, {"start": 11.0, "end": 12.0, "text": "二。"}
+    ]
+    assert result.table()["start"] == ["00:10.000", "00:11.000"]
+
+def test_legacy_helpers_use_transcript():
+    assert convert_to_srt(SEGMENTS[:1], time_offset=1) == "1\n00:00:01,000 --> 00:00:02,500\n こんにちは。\n\n"
+    assert create_timestamped_text(SEGMENTS[:1]) == "[00:00.000 → 00:01.500]  こんにちは。\n\n"
@@ -0,0 +1,85 @@
+"""文字起こし履歴の保存のテスト"""
+import zlib
+import sqlite3
+import pytest
+from transcriber import history
+from transcriber.history import (
+    add_history, update_history, count_history, list_history, load_history, delete_history, clear_history
+)
+
+@pytest.fixture(autouse=True)
+def history_db(monkeypatch, tmp_path):
+    monkeypatch.setattr(history, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(history, "HISTORY_DB_PATH", str(tmp_path / "history.sqlite3"))
+    return tmp_path / "history.sqlite3"
+
+def segment(start, end, text):
+    return {"start": start, "end": end, "text": text}
+
+def test_round_trip_keeps_text_and_segments():
+    segments = [segment(0.0, 1.2345, "こんにちは。"), segment(1.2345, 2.5, "さようなら。")]
+    history_id = add_history("会議.mp3", "こんにちは。さようなら。", segments, owner="a")
+    item = load_history(history_id, owner="a")
+    assert item["filename"] == "会議.mp3"
+    assert item["text"] == "こんにちは。さようなら。"
+    assert item["has_timestamps"]
+    # 時刻はミリ秒単位に丸めて保存する
+    assert item["segments"] == [segment(0.0, 1.234, "こんにちは。"), segment(1.234, 2.5, "さようなら。")]
+
+def test_history_is_scoped_by_owner():
+    history_id = add_history("a.mp3", "Aの結果", [], owner="a")
+    add_history("b.mp3", "Bの結果", [], owner="b")
+    assert count_history("a") == 1
+    assert [item["filename"] for item in list_history(owner="a")] == ["a.mp3"]
+    # 他の持ち主の履歴は読めず、書き換えも削除もできない
+    assert load_history(history_id, owner="b") is None
+    assert not update_history(history_id, "上書き", [], owner="b")
+    delete_history(history_id, owner="b")
+    clear_history("b")
+    assert load_history(history_id, owner="a")["text"] == "Aの結果"
+    assert count_history("b") == 0
+
+def test_update_history_rewrites_text():
+    history_id = add_history("live", "途中", [], owner="a")
+    assert update_history(history_id, "途中まで伸びた結果", [segment(0.0, 1.0, "途中まで伸びた結果")], owner="a")
+    item = load_history(history_id, owner="a")
+    assert item["text"] == "途中まで伸びた結果" and item["has_timestamps"]
+    assert list_history(owner="a")[0]["chars"] == len("途中まで伸びた結果")
+
+def test_items_over_limit_are_deleted_per_owner(monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_MAX_ITEMS", 2)
+    other = add_history("other.mp3", "他の人", [], owner="b")
+    ids = [add_history(f"{n}.mp3", f"結果{n}", [], owner="a") for n in range(3)]
+    assert [item["id"] for item in list_history(owner="a")] == [ids[2], ids[1]]
+    assert load_history(other, owner="b") is not None
+
+def test_total_size_limit_deletes_oldest_of_any_owner(monkeypatch):
+    text = "あ" * 1000
+    size = len(zlib.compress(text.encode("utf-8"))) + len(history._pack_segments([]))
+    monkeypatch.setattr(history, "HISTORY_TOTAL_MAX_BYTES", size * 2)
+    first = add_history("1.mp3", text, [], owner="a")
+    second = add_history("2.mp3", text, [], owner="b")
+    third = add_history("3.mp3", text, [], owner="c")
+    assert load_history(first, owner="a") is None
+    assert load_history(second, owner="b") is not None and load_history(third, owner="c") is not None
+
+def test_history_without_owner_column_is_migrated(history_db):
+    # 持ち主の列が無い以前の形式の履歴は、持ち主が空の履歴として読める
+    with sqlite3.connect(history_db) as conn:
+        conn.execute(
+            "CREATE TABLE history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created TEXT NOT NULL, filename TEXT NOT NULL, "
+            "preview TEXT NOT NULL, chars INTEGER NOT NULL, num_segments INTEGER NOT NULL, "
+            "text BLOB NOT NULL, segments BLOB NOT NULL, size INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO history (created, filename, preview, chars, num_segments, text, segments, size) "
+            "VALUES ('2024-01-01 00:00:00', 'old.mp3', '以前の結果', 5, 0, ?, ?, 0)",
+            (zlib.compress("以前の結果".encode("utf-8")), history._pack_segments([]))
+        )
+    conn.close()
+    assert count_history("") == 1
+    assert load_history(list_history(owner="")[0]["id"], owner="")["text"] == "以前の結果"
+    assert count_history("a") == 0
+    add_history("new.mp3", "新しい結果", [], owner="a")
+    assert count_history("a") == 1
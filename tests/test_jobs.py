@@ -0,0 +1,132 @@
+"""長い音声の処理状況（ジョブ）の保存・再開・実行中の登録のテスト"""
+import os
+import time
+import pytest
+from types import SimpleNamespace
+from transcriber import jobs, pipeline
+from transcriber.audio import AudioChunk
+from transcriber.jobs import (
+    make_job_id, claim_job, is_job_active, create_job, load_job, list_jobs, set_job_owner,
+    save_chunk_result, save_chunk_error, load_chunk_results, load_chunk_errors
+)
+from transcriber.pipeline import run_chunked_job
+
+SETTINGS = {
+    "model": "whisper-1", "with_timestamps": False, "prompt": "", "compress": False,
+    "max_duration": 10, "use_vad": False, "drop_silence": False, "overlap": 0, "context_mode": "none"
+}
+
+@pytest.fixture(autouse=True)
+def jobs_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path / "jobs"))
+    return tmp_path / "jobs"
+
+def plan(num_chunks):
+    return [AudioChunk(i, i * 160000, (i + 1) * 160000, 16000) for i in range(num_chunks)]
+
+def new_job(tmp_path, job_id="job1", num_chunks=3, owner="a"):
+    source = tmp_path / f"{job_id}.mp3"
+    source.write_bytes(b"audio")
+    return create_job(job_id, str(source), "会議.mp3", SETTINGS, plan(num_chunks), owner=owner)
+
+def test_job_id_depends_on_audio_and_settings():
+    assert make_job_id("audio", SETTINGS) == make_job_id("audio", dict(reversed(list(SETTINGS.items()))))
+    assert make_job_id("audio", SETTINGS) != make_job_id("other", SETTINGS)
+    assert make_job_id("audio", SETTINGS) != make_job_id("audio", dict(SETTINGS, max_duration=20))
+
+def test_created_job_is_loaded_with_plan(tmp_path):
+    job = new_job(tmp_path)
+    # 音声はジョブのディレクトリへ移して、中断後も使えるようにする
+    assert not (tmp_path / "job1.mp3").exists() and os.path.isfile(job["source"])
+    loaded = load_job("job1")
+    assert loaded["chunks"] == plan(3)
+    assert loaded["settings"] == SETTINGS and loaded["owner"] == "a"
+    assert load_job("missing") is None
+
+def test_chunk_results_and_errors_are_checkpointed(tmp_path):
+    new_job(tmp_path)
+    save_chunk_error("job1", 1, "タイムアウト")
+    save_chunk_result("job1", 0, "一。", [])
+    assert load_chunk_results("job1", 3) == {0: ("一。", [])}
+    assert load_chunk_errors("job1", 3) == {1: "タイムアウト"}
+    # 後で完了したパートのエラーは消す
+    save_chunk_result("job1", 1, "二。", [])
+    assert load_chunk_errors("job1", 3) == {}
+
+def test_list_jobs_returns_owner_jobs_that_are_not_running(tmp_path):
+    new_job(tmp_path, "job1", owner="a")
+    new_job(tmp_path, "job2", owner="b")
+    assert [job["id"] for job in list_jobs("a")] == ["job1"]
+    with claim_job("job1"):
+        assert list_jobs("a") == []
+    set_job_owner("job2", "a")
+    assert sorted(job["id"] for job in list_jobs("a")) == ["job1", "job2"]
+
+def test_list_jobs_deletes_old_jobs(tmp_path, jobs_dir):
+    new_job(tmp_path, "old")
+    new_job(tmp_path, "new")
+    expired = time.time() - (jobs.JOBS_MAX_AGE_DAYS + 1) * 24 * 3600
+    os.utime(jobs_dir / "old", (expired, expired))
+    assert [job["id"] for job in list_jobs("a")] == ["new"]
+    assert load_job("old") is None
+
+def test_claim_job_refuses_second_run():
+    with claim_job("job1"):
+        assert is_job_active("job1")
+        with pytest.raises(RuntimeError):
+            with claim_job("job1"):
+                pass
+    assert not is_job_active("job1")
+
+@pytest.fixture
+def sent(monkeypatch):
+    """送ったパートの記録（calls: 送ったパートの名前、failing: 失敗させるパートの名前）
+    
+    パートの音声は番号から作った名前（p0 など）で、名前に「。」を付けたテキストを返す。
+    """
+    record = SimpleNamespace(calls=[], failing=set())
+    
+    def cached_transcription(source, model_name, with_timestamps, prompt=""):
+        record.calls.append(source)
+        if source in record.failing:
+            raise RuntimeError(f"{source} の送信に失敗しました")
+        return f"{source}。"
+    
+    monkeypatch.setattr(
+        pipeline, "split_audio_file", lambda path, plan, **kwargs: [c._replace(source=f"p{c.index}") for c in plan]
+    )
+    monkeypatch.setattr(pipeline, "cached_transcription", cached_transcription)
+    return record
+
+def test_resume_sends_only_unfinished_parts(tmp_path, sent):
+    job = new_job(tmp_path)
+    save_chunk_result("job1", 0, "p0。", [])
+    result = run_chunked_job(load_job("job1"), max_workers=2)
+    assert sorted(sent.calls) == ["p1", "p2"]
+    assert result["missing"] == 0 and result["gaps"] == []
+    # 前回完了したパートの結果も含めて、パートの順につなぐ
+    assert [line for line in result["text"].splitlines() if line.endswith("。")] == ["p0。", "p1。", "p2。"]
+    # 全パートが完了したらジョブを削除する
+    assert load_job(job["id"]) is None
+
+def test_failed_parts_are_kept_for_resume(tmp_path, sent):
+    new_job(tmp_path)
+    sent.failing.add("p1")
+    result = run_chunked_job(load_job("job1"), max_workers=2)
+    assert result["missing"] == 1 and [gap["part"] for gap in result["gaps"]] == [2]
+    assert set(load_chunk_results("job1", 3)) == {0, 2}
+    assert "p1" in load_chunk_errors("job1", 3)[1]
+    
+    # 再開すると失敗したパートだけを送る
+    sent.calls.clear()
+    sent.failing.clear()
+    result = run_chunked_job(load_job("job1"), max_workers=2)
+    assert sent.calls == ["p1"] and result["missing"] == 0
+    assert load_job("job1") is None
+
+def test_running_job_cannot_be_resumed_twice(tmp_path, sent):
+    job = new_job(tmp_path)
+    with claim_job(job["id"]):
+        with pytest.raises(RuntimeError):
+            run_chunked_job(load_job("job1"))
+    assert sent.calls == []
@@ -0,0 +1,146 @@
+"""録音中の音声の逐次文字起こし（LiveTranscriber）のテスト"""
+import os
+import time
+import shutil
+import threading
+import numpy as np
+import pytest
+from transcriber import live as live_module
+from transcriber.live import LiveTranscriber
+from transcriber.pipeline import gap_line
+
+SETTINGS = {
+    "model": "whisper-1", "with_timestamps": False, "prompt": "", "compress": False,
+    "use_vad": True, "drop_silence": False, "overlap": 0, "context_mode": "none"
+}
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg が必要")
+def test_follow_file_reports_ffmpeg_error_when_decoder_exits(tmp_path):
+    # 読めない音声でffmpegが途中で終了しても BrokenPipeError ではなく、ffmpegのエラー出力を含めて失敗する
+    path = tmp_path / "broken.mp3"
+    path.write_bytes(os.urandom(8 * 1024 * 1024))
+    transcriber = LiveTranscriber(SETTINGS)
+    with pytest.raises(RuntimeError, match="ffmpegによる音声のデコードに失敗しました: .+"):
+        transcriber.follow_file(str(path), idle_timeout=1)
+
+def feed_in_threads(monkeypatch, live, paths, delays=None, failing=()):
+    """paths の録音を受け取った順に順番を取り、別々のスレッドで feed_file する（追加した録音の順を返す）"""
+    delays = delays or {}
+    
+    def decode_pcm(file_path, sample_rate):
+        time.sleep(delays.get(file_path, 0))
+        if file_path in failing:
+            raise RuntimeError(f"{file_path} をデコードできません")
+        return file_path
+    
+    fed = []
+    monkeypatch.setattr(live_module, "decode_pcm", decode_pcm)
+    monkeypatch.setattr(live, "feed_pcm", fed.append)
+    monkeypatch.setattr(live, "flush", lambda: None)
+    
+    def feed(path, turn):
+        try:
+            live.feed_file(path, turn)
+        except RuntimeError:
+            pass
+    
+    threads = [threading.Thread(target=feed, args=(path, live.reserve_turn())) for path in paths]
+    for thread in reversed(threads):
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    return fed
+
+def test_recordings_are_fed_in_turn_order(monkeypatch):
+    # 先に受け取った録音のデコードが遅くても、受け取った順に追加する
+    live = LiveTranscriber(SETTINGS)
+    fed = feed_in_threads(monkeypatch, live, ["first", "second", "third"], delays={"first": 0.2})
+    assert fed == ["first", "second", "third"]
+
+def test_failed_recording_passes_its_turn(monkeypatch):
+    live = LiveTranscriber(SETTINGS)
+    fed = feed_in_threads(monkeypatch, live, ["first", "second"], failing={"first"})
+    assert fed == ["second"]
+
+def speech(seconds, rate=16000):
+    """発話の代わりの音（-20dB程度のノイズ）"""
+    return (np.random.default_rng(0).standard_normal(int(seconds * rate)) * 3000).astype(np.int16)
+
+def silence(seconds, rate=16000):
+    return np.zeros(int(seconds * rate), dtype=np.int16)
+
+@pytest.fixture
+def windows(monkeypatch):
+    """送ったウィンドウの (開始秒, 長さ秒) の一覧（各ウィンドウはその全体を1つのセグメントとして返す）"""
+    sent = []
+    
+    def encode_pcm(samples, sample_rate, compress=True, name="window"):
+        return name, len(samples) / sample_rate
+    
+    def cached_transcription(source, model_name, with_timestamps, prompt=""):
+        duration = source[1]
+        sent.append(duration)
+        text = ["一つ目の発話。", "次は違う話題です。", "最後にもう一言。"][len(sent) - 1]
+        return {"text": text, "segments": [{"start": 0.0, "end": duration, "text": text}]}
+    
+    monkeypatch.setattr(live_module, "encode_pcm", encode_pcm)
+    monkeypatch.setattr(live_module, "cached_transcription", cached_transcription)
+    return sent
+
+def test_window_is_cut_in_pause(windows):
+    # 12秒話して1秒止まると、無音の中央（12.5秒）で区切って送り、残りは flush で送る
+    live = LiveTranscriber(dict(SETTINGS, with_timestamps=True))
+    live.feed_pcm(np.concatenate([speech(12), silence(1), speech(12)]))
+    assert windows == [12.5]
+    live.flush()
+    assert windows == [12.5, 12.5]
+    assert [(s["start"], s["end"]) for s in live.segments] == [(0.0, 12.5), (12.5, 25.0)]
+    assert live.result()["duration"] == 25.0
+
+def test_short_audio_waits_for_more(windows):
+    live = LiveTranscriber(SETTINGS)
+    live.feed_pcm(speech(4))
+    assert windows == []
+    live.feed_pcm(speech(4))
+    assert windows == []  # 発話の切れ目が無ければ最大長まで待つ
+    live.flush()
+    assert windows == [8.0] and live.windows == 1
+
+def test_long_speech_is_cut_at_max_window_with_overlap(windows):
+    # 切れ目が無いまま最大長（30秒）に達したら区切り、次のウィンドウは重ねる分（2秒）だけ前から始める
+    live = LiveTranscriber(dict(SETTINGS, with_timestamps=True, overlap=2))
+    live.feed_pcm(speech(45))
+    assert windows == [30.0]
+    live.flush()
+    assert windows == [30.0, 17.0]
+    assert live.segments[0]["end"] == 30.0 and live.segments[-1]["end"] == 45.0
+
+def test_pieces_fed_separately_are_cut_in_pause(windows):
+    # 少しずつ受け取る場合は、無音が区切りの長さ（0.5秒）に達した時点でその中で区切る
+    live = LiveTranscriber(SETTINGS)
+    audio = np.concatenate([speech(12), silence(1), speech(12)])
+    for start in range(0, len(audio), 16000 // 2):
+        live.feed_pcm(audio[start:start + 16000 // 2])
+    live.flush()
+    assert len(windows) == 2 and 12.0 <= windows[0] <= 13.0
+    assert sum(windows) == 25.0
+
+def test_failed_window_leaves_gap(monkeypatch):
+    # 送り直しても失敗したウィンドウは目印の行を入れ、次のウィンドウから続ける
+    calls = []
+    
+    def cached_transcription(source, model_name, with_timestamps, prompt=""):
+        calls.append(source[0])
+        if source[0] == "live1":
+            raise RuntimeError("タイムアウト")
+        return "続きの発話。"
+    
+    monkeypatch.setattr(live_module, "encode_pcm", lambda samples, sample_rate, compress=True, name="window": (name, b""))
+    monkeypatch.setattr(live_module, "cached_transcription", cached_transcription)
+    live = LiveTranscriber(SETTINGS)
+    live.feed_pcm(np.concatenate([speech(12), silence(1), speech(12)]))
+    live.flush()
+    assert calls.count("live1") == live_module.CHUNK_MAX_ATTEMPTS
+    result = live.result()
+    assert result["text"] == f"{gap_line(0.0, 12.5)}\n続きの発話。"
+    assert [(gap["start"], gap["end"], gap["error"]) for gap in result["gaps"]] == [(0.0, 12.5, "タイムアウト")]
@@ -0,0 +1,29 @@
+"""処理の段階ごとの計測（JSONログ）のテスト"""
+import json
+import pytest
+from transcriber import metrics
+from transcriber.metrics import set_json_log, span
+
+@pytest.fixture(autouse=True)
+def no_json_log():
+    yield
+    set_json_log(None)
+
+def test_json_log_is_written_per_record(tmp_path):
+    path = tmp_path / "metrics.log"
+    set_json_log(str(path))
+    with span("encode", part=1) as record:
+        record["bytes"] = 10
+    # 閉じる前でも1行ずつ書き出されている
+    line = json.loads(path.read_text(encoding="utf-8"))
+    assert line["stage"] == "encode" and line["bytes"] == 10 and line["part"] == 1
+
+def test_replacing_json_log_closes_previous_file(tmp_path):
+    set_json_log(str(tmp_path / "first.log"))
+    first = metrics._json_log
+    set_json_log(str(tmp_path / "second.log"))
+    assert first.closed
+    with span("merge"):
+        pass
+    assert (tmp_path / "first.log").read_text(encoding="utf-8") == ""
+    assert json.loads((tmp_path / "second.log").read_text(encoding="utf-8"))["stage"] == "merge"
@@ -0,0 +1,272 @@
+"""パートの並列の文字起こし（transcribe_chunks_parallel）と結果のつなぎ合わせのテスト
+
+APIの代わりに、音声の名前ごとに決めた結果を返す FakeTranscription を使う。
+"""
+import time
+import threading
+import pytest
+from transcriber import jobs, pipeline
+from transcriber.api import carryover_prompt
+from transcriber.audio import AudioChunk
+from transcriber.pipeline import (
+    TranscriptionStopped, transcribe_chunks_parallel, stitch_segments, stitch_text, stitch_chunk_results,
+    merge_chunk_results, chunk_gaps, gap_line, prepare_audio_file
+)
+
+class FakeTranscription:
+    """cached_transcription の代わりに、音声の名前（パートの音声として渡す文字列）ごとの結果を返す
+    
+    Args:
+        texts: 音声の名前 → テキスト
+        failures: 音声の名前 → 失敗させる送信の回目（1から数える）の集合
+        delays: 音声の名前 → 返すまでの秒数
+        on_call: 呼ばれるたびに音声の名前で呼ばれる関数
+    """
+    
+    def __init__(self, texts, failures=None, delays=None, on_call=None):
+        self.texts = texts
+        self.failures = failures or {}
+        self.delays = delays or {}
+        self.on_call = on_call
+        self.calls = []  # (音声の名前, プロンプト)
+        self._lock = threading.Lock()
+    
+    def __call__(self, source, model_name, with_timestamps, prompt=""):
+        with self._lock:
+            self.calls.append((source, prompt))
+            failing = len(self.prompts(source)) in self.failures.get(source, ())
+        if self.on_call:
+            self.on_call(source)
+        time.sleep(self.delays.get(source, 0))
+        if failing:
+            raise RuntimeError(f"{source} の送信に失敗しました")
+        return self.texts[source]
+    
+    def prompts(self, source):
+        """source を送ったときのプロンプト（送った順）"""
+        return [prompt for name, prompt in self.calls if name == source]
+
+@pytest.fixture
+def fake(monkeypatch):
+    """texts などを渡すと FakeTranscription を作って cached_transcription と置き換える関数"""
+    def install(texts, **kwargs):
+        transcription = FakeTranscription(texts, **kwargs)
+        monkeypatch.setattr(pipeline, "cached_transcription", transcription)
+        return transcription
+    return install
+
+def run(sources, **kwargs):
+    """各パートを10秒ずつとして transcribe_chunks_parallel を実行する"""
+    kwargs.setdefault("max_workers", 2)
+    return transcribe_chunks_parallel(
+        sources, [10.0 * k for k in range(len(sources))], "whisper-1", False, **kwargs
+    )
+
+def test_results_keep_part_order(fake):
+    # 先頭のパートが最後に終わっても、結果はパートの順に並ぶ
+    fake({"p0": "一。", "p1": "二。", "p2": "三。"}, delays={"p0": 0.2})
+    finished = []
+    results = run(["p0", "p1", "p2"], on_chunk_done=lambda k, done, total, result, error: finished.append(k))
+    assert results == [("一。", []), ("二。", []), ("三。", [])]
+    assert finished[-1] == 0
+
+def test_none_mode_sends_shared_prompt(fake):
+    transcription = fake({"p0": "途中", "p1": "続き", "p2": "終わり。"})
+    run(["p0", "p1", "p2"], prompt="会議", context_mode="none")
+    assert sorted(transcription.calls) == [("p0", "会議"), ("p1", "会議"), ("p2", "会議")]
+
+def test_refine_mode_resends_parts_after_unfinished_sentence(fake):
+    # p0 が文の途中で終わるため p1 だけを p0 の末尾を引き継いで送り直す（p1 は文末で終わるので p2 は送り直さない）
+    transcription = fake({"p0": "文の途中", "p1": "続きです。", "p2": "次の文です。"})
+    results = run(["p0", "p1", "p2"], prompt="会議", context_mode="refine")
+    assert transcription.prompts("p0") == ["会議"]
+    assert transcription.prompts("p1") == ["会議", carryover_prompt("会議", "文の途中")]
+    assert transcription.prompts("p2") == ["会議"]
+    assert [result[0] for result in results] == ["文の途中", "続きです。", "次の文です。"]
+
+def test_refine_mode_keeps_first_result_when_resend_fails(fake):
+    # 2回目の送信が失敗しても、1回目の結果を使う
+    transcription = fake({"p0": "文の途中", "p1": "続きです。"}, failures={"p1": {2}})
+    results = run(["p0", "p1"], context_mode="refine")
+    assert len(transcription.prompts("p1")) == 2
+    assert results[1] == ("続きです。", [])
+
+def test_chain_mode_carries_text_within_groups(fake):
+    # 4パートを2つのグループに分け、グループの先頭（p0・p2）以外は前のパートの末尾を引き継ぐ
+    transcription = fake({"p0": "一。", "p1": "二。", "p2": "三。", "p3": "四。"})
+    run(["p0", "p1", "p2", "p3"], prompt="会議", context_mode="chain", max_workers=2)
+    assert transcription.prompts("p0") == ["会議"]
+    assert transcription.prompts("p1") == [carryover_prompt("会議", "一。")]
+    assert transcription.prompts("p2") == ["会議"]
+    assert transcription.prompts("p3") == [carryover_prompt("会議", "三。")]
+
+def test_chain_mode_groups_each_file_separately(fake):
+    # ファイルAの4パートは、他のファイルのパート数によらず2つのグループ（a0・a2 が先頭）に分ける
+    transcription = fake({"a0": "一。", "a1": "二。", "a2": "三。", "a3": "四。", "b0": "別。"})
+    run(
+        ["a0", "a1", "a2", "a3", "b0"], context_mode="chain", max_workers=2,
+        previous=[None, 0, 1, 2, None], files=[0, 0, 0, 0, 1]
+    )
+    assert transcription.prompts("a2") == [""]
+    assert transcription.prompts("a3") == [carryover_prompt("", "三。")]
+    assert transcription.prompts("b0") == [""]
+
+def test_chain_mode_carries_finished_previous_result(fake):
+    # 前回までに完了したパートの結果を previous で渡すと、先頭のパートもその末尾を引き継ぐ
+    transcription = fake({"p1": "二。", "p2": "三。"})
+    run(["p1", "p2"], context_mode="chain", max_workers=1, previous=[("一。", []), 0])
+    assert transcription.prompts("p1") == ["一。"]
+    assert transcription.prompts("p2") == ["二。"]
+
+def test_failed_part_is_retried_after_others(fake):
+    transcription = fake({"p0": "一。", "p1": "二。", "p2": "三。"}, failures={"p1": {1}})
+    retries = []
+    results = run(["p0", "p1", "p2"], max_workers=1, on_retry=lambda k, attempt, error: retries.append((k, attempt)))
+    assert results[1] == ("二。", [])
+    assert retries == [(1, 1)]
+    # 送り直しはキューの最後に入る
+    assert [name for name, _ in transcription.calls] == ["p0", "p1", "p2", "p1"]
+
+def test_part_is_given_up_after_max_attempts(fake):
+    transcription = fake({"p0": "一。", "p1": "二。"}, failures={"p1": {1, 2, 3, 4}})
+    errors = {}
+    
+    def on_chunk_done(k, done, total, result, error):
+        errors[k] = error
+    
+    results = run(["p0", "p1"], max_attempts=3, on_chunk_done=on_chunk_done)
+    assert results == [("一。", []), None]
+    assert errors[0] is None and isinstance(errors[1], RuntimeError)
+    assert len(transcription.prompts("p1")) == 3
+
+def test_stop_leaves_unstarted_parts(fake):
+    # p0 の処理中に停止を求めると、まだ始めていない p1・p2 は送らずに TranscriptionStopped で終わる
+    stop = threading.Event()
+    transcription = fake({"p0": "一。", "p1": "二。", "p2": "三。"}, on_call=lambda source: stop.set())
+    errors = {}
+    
+    def on_chunk_done(k, done, total, result, error):
+        errors[k] = error
+    
+    results = run(["p0", "p1", "p2"], max_workers=1, stop=stop, on_chunk_done=on_chunk_done)
+    assert results == [("一。", []), None, None]
+    assert [name for name, _ in transcription.calls] == ["p0"]
+    assert errors[0] is None
+    assert isinstance(errors[1], TranscriptionStopped) and isinstance(errors[2], TranscriptionStopped)
+
+def test_stopped_parts_are_not_retried(fake):
+    stop = threading.Event()
+    stop.set()
+    transcription = fake({"p0": "一。"})
+    retries = []
+    results = run(["p0"], stop=stop, on_retry=lambda k, attempt, error: retries.append(k))
+    assert results == [None]
+    assert transcription.calls == [] and retries == []
+
+def segment(start, end, text):
+    return {"start": start, "end": end, "text": text}
+
+def test_stitch_segments_drops_duplicated_utterance():
+    # 重なり（20〜25秒）の中央より後ろは次のパートのセグメントを使い、境界をまたいで重複した発話は長い方だけを残す
+    segments = [segment(0.0, 12.0, "一つ目の文です。"), segment(12.0, 21.0, "二つ目の文です。"), segment(21.0, 25.0, "三つ目の")]
+    next_segments = [segment(20.0, 21.5, "の文です。"), segment(21.0, 28.0, "三つ目の文です。"), segment(28.0, 35.0, "四つ目。")]
+    added = stitch_segments(segments, next_segments, 20.0, 25.0)
+    assert [s["text"] for s in segments + added] == ["一つ目の文です。", "二つ目の文です。", "三つ目の文です。", "四つ目。"]
+
+def test_stitch_text_joins_at_matching_overlap():
+    assert stitch_text("今日は晴れです。明日は雨が降る", "明日は雨が降るでしょう。", 20) == "今日は晴れです。明日は雨が降るでしょう。"
+
+def test_stitch_text_falls_back_to_newline():
+    assert stitch_text("前のパート。", "次のパート。", 20) == "前のパート。\n次のパート。"
+
+def chunk(index, start, end):
+    return AudioChunk(index, int(start * 16000), int(end * 16000), 16000)
+
+def test_stitch_chunk_results_with_segments_and_gap():
+    chunks = [chunk(0, 0.0, 25.0), chunk(1, 20.0, 45.0), chunk(2, 40.0, 60.0)]
+    results = {
+        0: ("", [segment(0.0, 10.0, "一つ目。"), segment(10.0, 21.0, "二つ目。")]),
+        1: ("", [segment(20.0, 21.0, "二つ目。"), segment(21.0, 40.0, "三つ目。")]),
+    }
+    text, segments = stitch_chunk_results(chunks, results, gaps=[2])
+    assert [s["text"].strip() for s in segments] == ["一つ目。", "二つ目。", "三つ目。", pipeline.GAP_TEXT]
+    assert text == f"一つ目。二つ目。三つ目。 {pipeline.GAP_TEXT}"
+
+def test_stitch_chunk_results_without_segments():
+    chunks = [chunk(0, 0.0, 25.0), chunk(1, 20.0, 45.0), chunk(2, 50.0, 60.0)]
+    results = {
+        0: ("今日は晴れです。明日は雨が降る", []),
+        1: ("明日は雨が降るでしょう。", []),
+        2: ("別の話題です。", []),
+    }
+    text, segments = stitch_chunk_results(chunks, results)
+    assert segments == []
+    assert text == "今日は晴れです。明日は雨が降るでしょう。\n別の話題です。"
+
+def test_text_is_not_stitched_across_gap():
+    # 欠けたパートの前後は重なっていても一致を探さず、目印の行を挟んでつなぐ
+    chunks = [chunk(0, 0.0, 25.0), chunk(1, 20.0, 45.0), chunk(2, 40.0, 60.0)]
+    results = {0: ("今日は晴れです。明日は雨", []), 2: ("明日は雨でしょう。", [])}
+    text, segments = stitch_chunk_results(chunks, results, gaps=[1])
+    assert segments == []
+    assert text == f"今日は晴れです。明日は雨\n{gap_line(20.0, 45.0)}\n明日は雨でしょう。"
+
+def test_gap_segment_keeps_neighbouring_text_separated():
+    chunks = [chunk(0, 0.0, 25.0), chunk(1, 20.0, 45.0), chunk(2, 40.0, 60.0)]
+    results = {0: ("", [segment(0.0, 20.0, "前の文。")]), 2: ("", [segment(45.0, 60.0, "後の文。")])}
+    text, segments = stitch_chunk_results(chunks, results, gaps=[1])
+    assert [(s["start"], s["end"]) for s in segments] == [(0.0, 20.0), (20.0, 45.0), (45.0, 60.0)]
+    assert text == f"前の文。 {pipeline.GAP_TEXT} 後の文。"
+
+def test_unfinished_parts_without_gap_are_left_out():
+    # 処理中の途中の結果では、まだ順番が来ていないパートには目印を入れない
+    chunks = [chunk(0, 0.0, 10.0), chunk(1, 10.0, 20.0)]
+    text, _ = merge_chunk_results(chunks, {0: ("一。", [])})
+    assert text == "\n--- パート 1 ---\n\n一。"
+    text, _ = merge_chunk_results(chunks, {0: ("一。", [])}, gaps=[1])
+    assert text.endswith(f"\n--- パート 2 ---\n\n{gap_line(10.0, 20.0)}")
+
+def test_chunk_gaps_reports_errors_and_stopped_parts():
+    chunks = [chunk(0, 0.0, 10.0), chunk(1, 10.0, 20.0), chunk(2, 20.0, 30.0)]
+    gaps = chunk_gaps(chunks, {0: ("一。", [])}, {1: "タイムアウト"})
+    assert gaps == [
+        {"part": 2, "start": 10.0, "end": 20.0, "error": "タイムアウト"},
+        {"part": 3, "start": 20.0, "end": 30.0, "error": pipeline.STOPPED_GAP_ERROR},
+    ]
+
+@pytest.fixture
+def planned(monkeypatch, tmp_path):
+    """長さを指定した音声で prepare_audio_file を実行し、分割計画を作る際の1パートの最大長を返す関数"""
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path / "jobs"))
+    
+    def prepare(duration, max_duration):
+        plans = []
+        
+        def plan_audio_chunks(file_path, max_duration, **kwargs):
+            plans.append(max_duration)
+            return [chunk(0, 0.0, max_duration), chunk(1, max_duration, duration)]
+        
+        monkeypatch.setattr(
+            pipeline, "probe_audio", lambda path: {"duration": duration, "sample_rate": 16000, "channels": 1}
+        )
+        monkeypatch.setattr(pipeline, "plan_audio_chunks", plan_audio_chunks)
+        audio = tmp_path / f"audio_{duration}_{max_duration}.wav"
+        audio.write_bytes(b"audio")
+        settings = {
+            "model": "whisper-1", "with_timestamps": False, "prompt": "", "compress": False,
+            "max_duration": max_duration, "use_vad": True, "drop_silence": False, "overlap": 0
+        }
+        _, job = prepare_audio_file(str(audio), audio.name, settings, keep_source=True)
+        return plans[0] if job else None
+    return prepare
+
+def test_audio_longer_than_part_length_is_split_below_api_limit(planned):
+    # APIの制限（25分）より短くても、1パートの最大長を超えれば分割する
+    assert planned(duration=600, max_duration=300) == 300
+
+def test_audio_within_part_length_is_sent_whole(planned):
+    assert planned(duration=200, max_duration=300) is None
+
+def test_part_length_is_capped_by_api_limit(planned):
+    assert planned(duration=3000, max_duration=1800) == 1500
+
@@ -0,0 +1,30 @@
+"""Whisper文字起こしアプリの処理部分（Streamlitに依存しないため、コマンドラインなどからも使える）"""
+from .export import (
+    EXPORT_FORMATS, Transcript, format_timestamp, srt_timestamp, vtt_timestamp, create_timestamped_text, convert_to_srt
+)
+from .audio import (
+    API_MAX_BYTES, API_MAX_DURATION, AudioChunk, probe_audio, probe_duration, transcode_for_speech,
+    plan_audio_chunks, split_audio_file
+)
+from .api import (
+    configure_client, get_client, set_max_concurrency, build_prompt, carryover_prompt, response_format_for,
+    request_transcription, call_with_retries, extract_text_and_segments
+)
+from .engines import (
+    TranscriptionEngine, OpenAIEngine, FasterWhisperEngine, get_engine, available_models, all_models
+)
+from .cache import cached_transcription
+from .history import (
+    add_history, update_history, count_history, list_history, load_history, delete_history, clear_history
+)
+from .jobs import create_job, load_job, list_jobs, is_job_active, load_chunk_results, load_chunk_errors, delete_job
+from .pipeline import (
+    DEFAULT_MAX_WORKERS, CONTEXT_MODES, GAP_TEXT, TranscriptionStopped, transcribe_chunks_parallel, chunk_gaps,
+    stitch_chunk_results, merge_chunk_results,
+    run_chunked_job, prepare_audio_file, process_audio_file, process_audio_files
+)
+from .live import (
+    LIVE_IDLE_TIMEOUT, LIVE_WATCH_DIR, LiveTranscriber, resolve_live_path, run_live_transcription, transcribe_recording
+)
+from .background import BACKGROUND_MAX_JOBS, BackgroundJob, JobQueue
+from .metrics import Trace, span, trace_to, set_json_log, prometheus_text
@@ -0,0 +1,275 @@
+"""OpenAI APIの呼び出し（流量制限・再試行・接続の使い回し）
+
+openai・httpx は読み込みに時間がかかるため、最初にクライアントを使うときに読み込む
+（アップロードしないセッションやローカルのエンジンだけを使う場合は読み込まない）。
+"""
+import os
+import time
+import random
+import threading
+import warnings
+import contextlib
+from .metrics import span
+
+# API呼び出しのタイムアウト・再試行・流量制限の設定
+API_TIMEOUT = 300               # 1リクエストの最大時間（秒、25MBのアップロードを含む）
+API_CONNECT_TIMEOUT = 10        # 接続の確立にかける最大時間（秒）
+API_MAX_RETRIES = 5             # 429・タイムアウト・5xxの場合に再試行する回数
+API_BACKOFF_BASE = 1.0          # 再試行の待ち時間の基準（秒、試行ごとに2倍）
+API_BACKOFF_MAX = 60.0          # 再試行の待ち時間の上限（秒）
+API_REQUESTS_PER_MINUTE_DEFAULT = 50  # 1分あたりのリクエスト数の上限の既定値（環境変数 WHISPER_API_RPM で変更）
+API_BURST = 8                   # 連続して送信できるリクエスト数
+HTTP_MAX_CONNECTIONS = 16       # 使い回すHTTP接続の数
+PROMPT_CARRYOVER_CHARS = 120    # 前のパートから引き継ぐテキストの文字数（Whisperはプロンプトの末尾224トークンのみ使う）
+
+def _requests_per_minute(value):
+    """環境変数 WHISPER_API_RPM の値を1分あたりのリクエスト数の上限にする（0以下は無制限）
+    
+    整数でない値は警告を出して既定値を使う（読み込み時に例外で止めない）。
+    """
+    if value is None or not value.strip():
+        return API_REQUESTS_PER_MINUTE_DEFAULT
+    try:
+        return max(0, int(value))
+    except ValueError:
+        warnings.warn(
+            f"WHISPER_API_RPM には整数を指定してください（{value!r}）。"
+            f"既定値の {API_REQUESTS_PER_MINUTE_DEFAULT} を使います。"
+        )
+        return API_REQUESTS_PER_MINUTE_DEFAULT
+
+API_REQUESTS_PER_MINUTE = _requests_per_minute(os.environ.get("WHISPER_API_RPM"))  # 1分あたりのリクエスト数の上限（0は無制限）
+
+class TokenBucket:
+    """トークンバケット方式の流量制限（スレッドセーフ）
+    
+    rate 個/秒 の速さでトークンが補充され、最大 capacity 個まで貯まる。
+    acquire はトークンが取れるまで待つので、並列に送信しても平均の送信数は rate を超えない。
+    rate が0以下の場合は制限せず、acquire はすぐに戻る。
+    """
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# プロセス全体で共有するHTTPクライアント（接続を使い回す、最初に使うときに作成）と流量制限
+http_client = None
+rate_limiter = TokenBucket(API_REQUESTS_PER_MINUTE / 60, API_BURST)
+
+# 同時に実行するAPI呼び出しの上限（set_max_concurrency で設定、None は無制限）
+_concurrency = None
+
+# OpenAIクライアント（configure_client の設定で、最初に使うときに作成）
+client = None
+_client_options = {"api_key": None, "base_url": None}
+_client_lock = threading.Lock()
+
+def configure_client(api_key=None, base_url=None):
+    """APIキーと接続先を設定する（クライアントは最初に使うときに作る）
+    
+    省略した値は環境変数 OPENAI_API_KEY・OPENAI_BASE_URL から読み込む
+    （接続先にテスト用のモックサーバーなどを指定できる）。
+    設定が前回と同じ場合は、作成済みのクライアントをそのまま使う。
+    """
+    global client, _client_options
+    options = {"api_key": api_key, "base_url": base_url}
+    with _client_lock:
+        if options != _client_options:
+            _client_options = options
+            client = None
+
+def get_client():
+    """設定済みのクライアント（最初に呼ばれたときに作成する）
+    
+    再試行は call_with_retries で行うため、クライアント側の再試行は無効にする。
+    """
+    global client, http_client
+    if client is not None:
+        return client
+    with _client_lock:
+        if client is None:
+            import httpx
+            from openai import OpenAI
+            
+            timeout = httpx.Timeout(API_TIMEOUT, connect=API_CONNECT_TIMEOUT)
+            if http_client is None:
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+                    timeout=timeout
+                )
+            client = OpenAI(
+                api_key=_client_options["api_key"],
+                base_url=_client_options["base_url"] or os.environ.get("OPENAI_BASE_URL"),
+                http_client=http_client,
+                timeout=timeout,
+                max_retries=0
+            )
+        return client
+
+def set_max_concurrency(max_concurrency):
+    """プロセス全体で同時に実行するAPI呼び出しの数を制限する（None で無制限）"""
+    global _concurrency
+    _concurrency = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+def build_prompt(context="", nouns=""):
+    """音声の種類と固有名詞からWhisper用のプロンプトを作成"""
+    prompt = ""
+    if context and context != "指定なし":
+        prompt += f"この音声は{context}です。"
+    
+    if nouns:
+        nouns_list = [n.strip() for n in nouns.replace("、", ",").split(",") if n.strip()]
+        if nouns_list:
+            prompt += f" 次の固有名詞が含まれています: {', '.join(nouns_list)}。"
+    
+    return prompt
+
+def carryover_prompt(prompt, previous_text, max_chars=PROMPT_CARRYOVER_CHARS):
+    """前のパートのテキストの末尾を続けたプロンプトを作る（直前の文章の続きとして書き起こされる）
+    
+    音声の種類・固有名詞のプロンプトを先に置き、その後ろに前のパートの末尾 max_chars 文字を続ける。
+    """
+    tail = previous_text.strip()[-max_chars:]
+    if not tail:
+        return prompt
+    return f"{prompt} {tail}" if prompt else tail
+
+def response_format_for(model_name, with_timestamps):
+    """モデルとタイムスタンプ設定からAPIの出力形式を決める（タイムスタンプはwhisper-1でのみ使用可能）"""
+    if with_timestamps and model_name == "whisper-1":
+        return "verbose_json"
+    return "text"
+
+def request_transcription(source, model_name, with_timestamps, prompt=""):
+    """OpenAI APIで1つの音声を文字起こしする（Streamlitの表示は行わない）
+    
+    ワーカースレッドからも呼び出せるように、st.* は一切使わずに
+    例外はそのまま呼び出し元へ送出する。
+    
+    Args:
+        source: 音声ファイルのパス、またはメモリ上の音声 (ファイル名, バイト列)
+    """
+    # APIオプション
+    options = {
+        "model": model_name,
+        "response_format": response_format_for(model_name, with_timestamps)
+    }
+    
+    # タイムスタンプを追加
+    if options["response_format"] == "verbose_json":
+        options["timestamp_granularities"] = ["segment"]
+    
+    # プロンプトが指定されている場合は追加
+    if prompt:
+        options["prompt"] = prompt
+    
+    size = len(source[1]) if isinstance(source, tuple) else os.path.getsize(source)
+    
+    def send():
+        # 送信とAPIの処理時間（再試行する場合は1回ごと）を計測する
+        with span("api", bytes=size, model=model_name):
+            if isinstance(source, tuple):
+                # メモリ上の音声はそのまま渡す（一時ファイルを経由しない）
+                return get_client().audio.transcriptions.create(file=source, **options)
+            
+            # 再試行のたびにファイルを先頭から読み直す
+            with open(source, "rb") as audio_file:
+                return get_client().audio.transcriptions.create(file=audio_file, **options)
+    
+    return call_with_retries(send)
+
+def _retry_after(error):
+    """429・503の応答の Retry-After ヘッダーの秒数（無ければNone）"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """再試行までの待ち時間（指数バックオフ + フルジッター）
+    
+    同時に失敗した並列のリクエストが同じタイミングで再送しないように、
+    上限までの範囲でランダムに待つ。サーバーが Retry-After を返した場合はそれ以上待つ。
+    """
+    delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def is_retryable_error(error):
+    """一時的なエラー（429・タイムアウト・接続エラー・5xx）か"""
+    from openai import APIConnectionError, APIStatusError, InternalServerError, RateLimitError
+    
+    if isinstance(error, (RateLimitError, InternalServerError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+def call_with_retries(func, max_retries=API_MAX_RETRIES):
+    """流量制限に従ってAPIを呼び出し、一時的なエラーは待ってから再試行する
+    
+    再試行しても失敗した場合と、再試行しても結果が変わらないエラー（400など）は
+    そのまま呼び出し元へ送出する。
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        try:
+            with _concurrency or contextlib.nullcontext():
+                return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_error(e):
+                raise
+            time.sleep(backoff_delay(attempt, _retry_after(e)))
+
+def extract_text_and_segments(result, time_offset=0):
+    """APIの結果からテキストとオフセット適用済みセグメント（dictのリスト）を取り出す"""
+    if isinstance(result, str):
+        # テキスト形式の場合
+        return result, []
+    
+    if isinstance(result, dict):
+        text = result.get('text', '')
+        raw_segments = result.get('segments') or []
+    elif hasattr(result, 'text'):
+        # verbose_json形式の場合
+        text = result.text
+        raw_segments = getattr(result, 'segments', None) or []
+    else:
+        return str(result), []
+    
+    segments = []
+    for segment in raw_segments:
+        if hasattr(segment, 'start'):
+            # セグメントが直接属性を持つ場合
+            segments.append({
+                'start': segment.start + time_offset,
+                'end': segment.end + time_offset,
+                'text': segment.text
+            })
+        elif isinstance(segment, dict):
+            # 辞書型の場合
+            segment_copy = segment.copy()
+            segment_copy['start'] = segment.get('start', 0) + time_offset
+            segment_copy['end'] = segment.get('end', 0) + time_offset
+            segments.append(segment_copy)
+    
+    return text, segments
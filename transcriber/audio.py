@@ -0,0 +1,500 @@
+"""音声の解析・分割・送信用の変換（ffmpegを使用）"""
+import os
+import re
+import math
+import tempfile
+import functools
+import subprocess
+from collections import namedtuple
+import ffmpeg
+import numpy as np
+from .metrics import span
+
+# OpenAI APIの制限
+API_MAX_BYTES = 25 * 1024 * 1024   # 1リクエストあたりの最大ファイルサイズ
+API_MAX_DURATION = 1500            # 1リクエストあたりの最大長（秒）
+API_SIZE_MARGIN = 0.9              # ビットレートの揺らぎを考慮したサイズの安全率
+
+# 送信前に変換する音声のプロファイル（音声認識に十分な品質で最小のサイズ）
+SPEECH_PROFILE = {"ac": 1, "ar": 16000, "acodec": "libopus", "audio_bitrate": "24k"}
+SPEECH_PROFILE_EXT = ".ogg"
+SPEECH_PROFILE_FORMAT = "ogg"
+SPEECH_PROFILE_BYTES_PER_SEC = 24000 / 8
+
+# 圧縮しない場合のパートの形式（可逆圧縮なので音質は変わらない）とサイズの見積もり
+LOSSLESS_PROFILE = {"acodec": "flac"}
+LOSSLESS_PROFILE_EXT = ".flac"
+LOSSLESS_PROFILE_FORMAT = "flac"
+LOSSLESS_RATIO = 0.7  # 16bit PCMに対するFLACのサイズ比の見積もり（安全側）
+
+# 無音検出（VAD）の設定
+VAD_SAMPLE_RATE = 8000      # 解析用にダウンサンプルするサンプルレート
+VAD_FRAME_SEC = 0.05        # エネルギーを計算するフレーム長（秒）
+VAD_SEARCH_WINDOW = 60      # 分割点を探す範囲（目標位置から遡る秒数）
+VAD_MIN_SILENCE = 0.3       # 分割点として扱う無音の最小長（秒）
+VAD_DROP_SILENCE = 2.0      # 送信を省略する無音の最小長（秒）
+VAD_SILENCE_PADDING = 0.2   # 無音を省略する際に残す余白（秒）
+
+def _ignore_log(message=None, progress=None):
+    pass
+
+class AudioChunk(namedtuple("AudioChunk", ["index", "start_sample", "end_sample", "sample_rate", "source"],
+                            defaults=(None,))):
+    """分割計画の1パート
+    
+    位置は元の音声のサンプル数で保持するため、オフセットはサンプル単位で正確で、
+    秒への変換を繰り返しても誤差が積み重ならない。
+    source は切り出した音声（ファイルのパス、(ファイル名, バイト列)、またはそれを返す関数）で、
+    計画の段階では None。
+    """
+    __slots__ = ()
+    
+    @property
+    def start(self):
+        """開始位置（秒）"""
+        return self.start_sample / self.sample_rate
+    
+    @property
+    def end(self):
+        """終了位置（秒）"""
+        return self.end_sample / self.sample_rate
+    
+    @property
+    def duration(self):
+        """長さ（秒）"""
+        return (self.end_sample - self.start_sample) / self.sample_rate
+    
+    def to_dict(self):
+        """ジョブに保存するための辞書（source は保存しない）"""
+        return {
+            "index": self.index,
+            "start_sample": self.start_sample,
+            "end_sample": self.end_sample,
+            "sample_rate": self.sample_rate
+        }
+    
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value["index"], value["start_sample"], value["end_sample"], value["sample_rate"])
+
+def probe_audio(file_path):
+    """コンテナのメタデータから音声の長さ（秒）とサンプルレートを取得する
+    
+    ffprobeでヘッダだけを読むため、ファイル全体をデコードしない。
+    メタデータに長さが無い場合（MediaRecorderのwebmなど）のみ、
+    ffmpegでストリームを読み捨てて長さを求める（メモリ使用量は一定）。
+    
+    Returns:
+        {"duration": 長さ（秒）, "sample_rate": サンプルレート, "channels": チャンネル数}
+    """
+    with span("probe"):
+        info = ffmpeg.probe(file_path)
+        
+        audio_stream = next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"), None)
+        if audio_stream is None:
+            raise ValueError("音声ストリームが見つかりませんでした")
+        
+        sample_rate = int(audio_stream.get("sample_rate") or 0) or 48000
+        channels = int(audio_stream.get("channels") or 1)
+        
+        duration = info.get("format", {}).get("duration") or audio_stream.get("duration")
+        if duration is not None:
+            return {"duration": float(duration), "sample_rate": sample_rate, "channels": channels}
+        
+        # メタデータに長さが無い場合はnullマクサーに流して最後の時刻を読む
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-i", file_path, "-vn", "-f", "null", "-"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True
+        )
+        times = re.findall(rb"time=(\d+):(\d+):(\d+(?:\.\d+)?)", proc.stderr)
+        if not times:
+            raise ValueError("音声の長さを取得できませんでした")
+        hours, minutes, secs = times[-1]
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+        return {"duration": duration, "sample_rate": sample_rate, "channels": channels}
+
+def probe_duration(file_path):
+    """コンテナのメタデータから音声の長さ（秒）を取得する（デコードは行わない）"""
+    return probe_audio(file_path)["duration"]
+
+def _part_output_args(compress):
+    """パートの書き出し形式（拡張子, ffmpegのフォーマット, 出力オプション）"""
+    bitexact = {"fflags": "+bitexact", "flags:a": "+bitexact"}
+    if compress:
+        return SPEECH_PROFILE_EXT, SPEECH_PROFILE_FORMAT, dict(SPEECH_PROFILE, **bitexact)
+    return LOSSLESS_PROFILE_EXT, LOSSLESS_PROFILE_FORMAT, dict(LOSSLESS_PROFILE, **bitexact)
+
+def _segment_input(file_path, chunk):
+    """パートの範囲をサンプル単位で正確に切り出す入力
+    
+    入力側の -ss でシークしてからデコードし、指定位置より前のサンプルを捨てるため、
+    ストリームコピーのようにパケット境界へ丸められることがない。
+    """
+    return ffmpeg.input(file_path, ss=f"{chunk.start:.6f}", t=f"{chunk.duration:.6f}")
+
+def extract_segment(file_path, chunk, output_path, compress=True):
+    """音声の一部をffmpegでファイルに切り出す
+    
+    ffmpegがストリーミング処理するため、メモリ使用量は入力の長さに依存しない。
+    同じ入力からは同じバイト列が得られるよう bitexact で書き出す（キャッシュのキーに使うため）。
+    
+    Args:
+        chunk: 切り出す範囲（AudioChunk）
+        compress: 送信用のコンパクトな形式にするか（False の場合はFLAC）
+    """
+    _, _, output_args = _part_output_args(compress)
+    with span("encode", part=chunk.index + 1) as record:
+        (
+            _segment_input(file_path, chunk)
+            .output(output_path, vn=None, **output_args)
+            .overwrite_output()
+            .run(quiet=True)
+        )
+        record["bytes"] = os.path.getsize(output_path)
+    return output_path
+
+def extract_segment_bytes(file_path, chunk, compress=True):
+    """音声の一部をffmpegで切り出し、一時ファイルを作らずにメモリ上のバイト列として返す
+    
+    メモリに載るのは切り出した1パート分（APIの制限により最大25MB）だけ。
+    
+    Returns:
+        (ファイル名, バイト列) のタプル（そのままAPIの file に渡せる）
+    """
+    ext, pipe_format, output_args = _part_output_args(compress)
+    with span("encode", part=chunk.index + 1) as record:
+        data, _ = (
+            _segment_input(file_path, chunk)
+            .output("pipe:", format=pipe_format, vn=None, **output_args)
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        record["bytes"] = len(data)
+    return f"part{chunk.index + 1}{ext}", data
+
+def transcode_for_speech(file_path):
+    """音声を送信用のコンパクトな形式（モノラル・16kHz・低ビットレートOpus）に変換する
+    
+    ffmpegがストリーミングで変換するため、メモリ使用量は入力の長さに依存しない。
+    
+    Returns:
+        変換後の一時ファイルのパス
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=SPEECH_PROFILE_EXT) as tmp_file:
+        output_path = tmp_file.name
+    
+    try:
+        with span("encode") as record:
+            (
+                ffmpeg
+                .input(file_path)
+                .output(output_path, vn=None, fflags="+bitexact", **SPEECH_PROFILE, **{"flags:a": "+bitexact"})
+                .overwrite_output()
+                .run(quiet=True)
+            )
+            record["bytes"] = os.path.getsize(output_path)
+    except Exception:
+        os.unlink(output_path)
+        raise
+    
+    return output_path
+
+def compute_frame_energy(file_path, sample_rate=VAD_SAMPLE_RATE, frame_sec=VAD_FRAME_SEC):
+    """音声をモノラル・低サンプルレートのPCMとしてストリームで読み、フレームごとの音量（dBFS）を返す
+    
+    ffmpegの出力をブロック単位で読み、NumPyでまとめてRMSを計算するため、
+    メモリに載るのはフレームごとの音量の配列だけになる。
+    """
+    frame_len = int(sample_rate * frame_sec)
+    block_bytes = frame_len * 2 * 2000  # 16bit × 2000フレーム（約100秒分）
+    
+    with span("decode", bytes=0) as record:
+        process = (
+            ffmpeg
+            .input(file_path)
+            .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=sample_rate)
+            .global_args("-loglevel", "error", "-nostdin")
+            .run_async(pipe_stdout=True, pipe_stderr=True)
+        )
+        
+        energies = []
+        remainder = b""
+        try:
+            while True:
+                data = process.stdout.read(block_bytes)
+                if not data:
+                    break
+                record["bytes"] += len(data)
+                data = remainder + data
+                usable = len(data) - len(data) % (frame_len * 2)
+                remainder = data[usable:]
+                if usable == 0:
+                    continue
+                energies.append(frame_energy_db(np.frombuffer(data[:usable], dtype=np.int16), frame_len))
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            returncode = process.wait()
+    
+    if returncode != 0:
+        raise RuntimeError(f"ffmpegによる音声解析に失敗しました: {stderr.decode(errors='ignore')}")
+    
+    if not energies:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(energies)
+
+def frame_energy_db(samples, frame_len):
+    """16bit PCMのサンプル（NumPy配列）からフレームごとの音量（dBFS）を求める（端数のサンプルは無視）"""
+    usable = len(samples) - len(samples) % frame_len
+    frames = samples[:usable].astype(np.float32).reshape(-1, frame_len)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20 * np.log10(rms / 32768 + 1e-10)
+
+def silence_threshold(energy_db):
+    """背景ノイズから相対的に無音の閾値を決める（音量の変化が小さい音声では無音とみなさない）"""
+    return min(np.percentile(energy_db, 15) + 8, np.median(energy_db) - 10)
+
+def decode_pcm(file_path, sample_rate=VAD_SAMPLE_RATE):
+    """音声全体をモノラルの16bit PCM（NumPy配列）にデコードする（録音したての短い音声向け）"""
+    with span("decode") as record:
+        data, _ = (
+            ffmpeg
+            .input(file_path)
+            .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=sample_rate)
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        record["bytes"] = len(data)
+    return np.frombuffer(data, dtype=np.int16)
+
+def open_pcm_decoder(sample_rate=VAD_SAMPLE_RATE):
+    """標準入力に書き込んだ音声を、モノラルの16bit PCMにデコードして標準出力に流すffmpegを起動する
+    
+    書き込み中のファイルを少しずつ読みながらデコードするために使う（mp3・ogg・webm など
+    先頭から順に読めるコンテナのみ。moovが末尾にあるmp4は読めない）。
+    """
+    return (
+        ffmpeg
+        .input("pipe:")
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=sample_rate)
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+    )
+
+def encode_pcm(samples, sample_rate, compress=True, name="window"):
+    """モノラルの16bit PCMを送信用の形式に変換し、(ファイル名, バイト列) を返す"""
+    ext, pipe_format, output_args = _part_output_args(compress)
+    with span("encode") as record:
+        data, _ = (
+            ffmpeg
+            .input("pipe:", format="s16le", ac=1, ar=sample_rate)
+            .output("pipe:", format=pipe_format, **output_args)
+            .run(input=samples.astype(np.int16).tobytes(), capture_stdout=True, capture_stderr=True)
+        )
+        record["bytes"] = len(data)
+    return f"{name}{ext}", data
+
+def plan_chunks_by_silence(energy_db, total_samples, sample_rate, max_duration, frame_sec=VAD_FRAME_SEC,
+                           search_window=VAD_SEARCH_WINDOW, drop_silence=False):
+    """フレームごとの音量から、無音の位置で区切った分割計画を作成する
+    
+    各パートは max_duration を超えない範囲で、目標位置から search_window 秒以内にある
+    最も静かな区間の中央で区切る。drop_silence が True の場合、各パートの先頭・末尾に
+    ある VAD_DROP_SILENCE 秒以上の無音は送信対象から外す（全体が無音のパートは除外）。
+    
+    Returns:
+        AudioChunk のリスト（位置は元の音声のサンプル数）
+    """
+    num_frames = len(energy_db)
+    if num_frames == 0:
+        return [AudioChunk(0, 0, total_samples, sample_rate)]
+    
+    max_frames = max(1, int(max_duration / frame_sec))
+    window_frames = max(1, int(search_window / frame_sec))
+    
+    silent = energy_db < silence_threshold(energy_db)
+    
+    # 短い無音の揺らぎで区切らないよう、移動平均した音量で最も静かな位置を探す
+    smooth_frames = max(1, int(VAD_MIN_SILENCE / frame_sec))
+    smoothed = np.convolve(energy_db, np.ones(smooth_frames) / smooth_frames, mode="same")
+    
+    bounds = []
+    start = 0
+    while num_frames - start > max_frames:
+        target = start + max_frames
+        lo = max(start + max_frames // 2, target - window_frames)
+        if silent[lo:target].any():
+            # 最も静かな音量に近いフレームのうち目標に最も近い無音区間の中央で区切る
+            window = smoothed[lo:target]
+            quiet = np.flatnonzero(window <= window.min() + 1.0)
+            breaks = np.flatnonzero(np.diff(quiet) > 1)
+            run = quiet[breaks[-1] + 1:] if len(breaks) else quiet
+            cut = lo + int(run[0] + run[-1] + 1) // 2
+        else:
+            # 無音が無い場合は目標位置で区切る
+            cut = target
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, num_frames))
+    
+    if drop_silence:
+        drop_frames = int(VAD_DROP_SILENCE / frame_sec)
+        pad_frames = int(VAD_SILENCE_PADDING / frame_sec)
+        voiced = np.flatnonzero(~silent)
+        trimmed = []
+        for start, end in bounds:
+            inside = voiced[(voiced >= start) & (voiced < end)]
+            if len(inside) == 0:
+                continue  # 全体が無音のパートは送信しない
+            first, last = int(inside[0]), int(inside[-1]) + 1
+            if first - start >= drop_frames:
+                start = max(start, first - pad_frames)
+            if end - last >= drop_frames:
+                end = min(end, last + pad_frames)
+            trimmed.append((start, end))
+        bounds = trimmed or bounds
+    
+    # フレーム番号を元の音声のサンプル数に変換（最後のパートは音声の終わりまで）
+    samples_per_frame = frame_sec * sample_rate
+    plan = []
+    for index, (start, end) in enumerate(bounds):
+        start_sample = min(round(start * samples_per_frame), total_samples)
+        end_sample = total_samples if end >= num_frames else min(round(end * samples_per_frame), total_samples)
+        plan.append(AudioChunk(index, start_sample, end_sample, sample_rate))
+    return plan
+
+def add_chunk_overlap(plan, overlap):
+    """2つ目以降のパートの開始位置を overlap 秒だけ前に広げ、前のパートと音声を重ねる
+    
+    無音を省略して前のパートとの間が空いている場合は、境界で言葉が切れていないので広げない。
+    """
+    if overlap <= 0:
+        return plan
+    
+    chunks = plan[:1]
+    for prev, chunk in zip(plan, plan[1:]):
+        if chunk.start_sample <= prev.end_sample:
+            start_sample = max(prev.start_sample, chunk.start_sample - round(overlap * chunk.sample_rate))
+            chunk = chunk._replace(start_sample=start_sample)
+        chunks.append(chunk)
+    return chunks
+
+def plan_audio_chunks(file_path, max_duration=1440, use_vad=True, drop_silence=False, max_bytes=API_MAX_BYTES,
+                      bytes_per_second=None, overlap=0, log=None):
+    """音声ファイルの分割計画を作成する
+    
+    1パートの長さは max_duration と、パートのビットレートから求めた
+    max_bytes に収まる長さのうち短い方に制限する。
+    use_vad が True の場合は無音位置で区切り、解析に失敗した場合や
+    use_vad が False の場合は固定長で区切る。
+    
+    Args:
+        max_bytes: 1パートの最大バイト数（None の場合はサイズで制限しない）
+        bytes_per_second: 書き出すパートの1秒あたりのバイト数（省略時はファイルの平均ビットレート）
+        overlap: 隣り合うパートで重ねる長さ（秒）。重ねた分を含めても上限に収まるように区切る
+        log: 警告メッセージの出力先
+    
+    Returns:
+        AudioChunk のリスト（位置は元の音声のサンプル数）
+    """
+    log = log or _ignore_log
+    info = probe_audio(file_path)
+    total_duration = info["duration"]
+    sample_rate = info["sample_rate"]
+    total_samples = round(total_duration * sample_rate)
+    
+    # サイズ制限から1パートの最大長を求める
+    if bytes_per_second is None and total_duration > 0:
+        bytes_per_second = os.path.getsize(file_path) / total_duration
+    if bytes_per_second and max_bytes:
+        max_duration = min(max_duration, max_bytes * API_SIZE_MARGIN / bytes_per_second)
+    
+    if total_duration <= max_duration and not drop_silence:
+        return [AudioChunk(0, 0, total_samples, sample_rate)]
+    
+    # 重ねる分を差し引いた長さで区切る
+    max_duration = max(1.0, max_duration - overlap)
+    
+    if use_vad:
+        try:
+            energy_db = compute_frame_energy(file_path)
+            with span("split"):
+                plan = plan_chunks_by_silence(energy_db, total_samples, sample_rate, max_duration, drop_silence=drop_silence)
+            return add_chunk_overlap(plan, overlap)
+        except Exception as e:
+            log(f"無音検出に失敗したため固定長で分割します: {str(e)}")
+    
+    max_samples = int(max_duration * sample_rate)
+    num_parts = max(1, math.ceil(total_samples / max_samples))
+    plan = [
+        AudioChunk(i, i * max_samples, min((i + 1) * max_samples, total_samples), sample_rate)
+        for i in range(num_parts)
+    ]
+    return add_chunk_overlap(plan, overlap)
+
+# 音声分割関数を追加
+def split_audio_file(file_path, max_duration=1440, use_vad=True, drop_silence=False, plan=None, log=None,
+                     in_memory=False, compress=True):
+    """音声ファイルを指定された最大長で分割する
+    
+    ファイル全体をメモリに読み込まず、ffmpegでパートごとにサンプル単位で正確に切り出す。
+    in_memory が True の場合は一時ファイルを作らず、各パートに「呼び出すとメモリ上に
+    切り出す関数」を持たせる（パートを送信する直前まで切り出しを遅らせる）。
+    
+    Args:
+        file_path: 音声ファイルのパス
+        max_duration: 最大分割長（秒）、デフォルトは24分
+        use_vad: 無音の位置で区切るか
+        drop_silence: パート端の長い無音を送信対象から外すか
+        plan: 作成済みの分割計画（指定した場合はこの計画の通りに切り出す）
+        log: 進捗メッセージの出力先
+        in_memory: 一時ファイルの代わりにメモリ上で切り出すか
+        compress: パートを送信用のコンパクトな形式にするか（False の場合はFLAC）
+    
+    Returns:
+        source に音声（パス、または in_memory の場合は (ファイル名, バイト列) を返す関数）を
+        設定した AudioChunk のリスト
+    """
+    log = log or _ignore_log
+    try:
+        # 分割計画を作成
+        if plan is None:
+            log("音声ファイルの分割を準備中...")
+            plan = plan_audio_chunks(
+                file_path,
+                max_duration,
+                use_vad=use_vad,
+                drop_silence=drop_silence,
+                bytes_per_second=SPEECH_PROFILE_BYTES_PER_SEC if compress else None,
+                log=log
+            )
+        num_parts = len(plan)
+        
+        sent_duration = sum(chunk.duration for chunk in plan)
+        log(f"音声ファイルを{num_parts}個のパートに分割します（送信する合計時間: {sent_duration:.1f}秒）")
+        
+        if in_memory:
+            # 送信直前にメモリ上で切り出す
+            return [
+                chunk._replace(source=functools.partial(extract_segment_bytes, file_path, chunk, compress))
+                for chunk in plan
+            ]
+        
+        # 分割して一時ファイルに保存
+        ext, _, _ = _part_output_args(compress)
+        chunks = []
+        for i, chunk in enumerate(plan):
+            with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_file:
+                segment_path = tmp_file.name
+            
+            extract_segment(file_path, chunk, segment_path, compress)
+            chunks.append(chunk._replace(source=segment_path))
+            
+            log(f"パート {i+1}/{num_parts} を分割しました（{chunk.start:.1f}秒 → {chunk.end:.1f}秒）")
+        
+        return chunks
+    
+    except Exception as e:
+        log(f"音声ファイル分割エラー: {str(e)}")
+        raise
@@ -0,0 +1,117 @@
+"""バックグラウンドで文字起こしを実行するジョブキュー"""
+import time
+import uuid
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import Trace, trace_to
+
+# サーバー全体で同時にバックグラウンド実行する文字起こし処理の数
+BACKGROUND_MAX_JOBS = 2
+
+# 結果を表示した後の処理を画面に残しておく期間と数（閉じられずに残った結果でメモリが増え続けないように）
+BACKGROUND_FINISHED_TTL = 60 * 60  # 終わってからの秒数
+BACKGROUND_MAX_FINISHED = 50       # サーバー全体で残しておく、結果を表示した後の処理の数
+
+class BackgroundJob:
+    """バックグラウンドで実行する文字起こし処理の状態"""
+    
+    def __init__(self, session_id, filename, trace=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.session_id = session_id
+        self.filename = filename
+        self.created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.status = "queued"  # queued / running / done / failed
+        self.progress = 0.0
+        self.messages = []
+        self.result = None
+        self.partial = None  # 処理中に途中まで得られた結果（ライブ文字起こしなど）
+        self.error = None
+        self.finished = None  # 終わった時刻（time.monotonic()、処理中は None）
+        self.collected = False  # 結果を画面に表示したか（表示するまでは取り除かない）
+        self.trace = trace or Trace()  # 段階ごとの計測結果（診断情報として表示する）
+        self.stop_event = threading.Event()
+    
+    def report(self, message=None, progress=None):
+        """処理側から進捗を通知する（ワーカースレッドから呼ばれる）"""
+        if message is not None:
+            self.messages.append(message)
+        if progress is not None:
+            self.progress = min(max(progress, 0.0), 1.0)
+    
+    def update(self, result):
+        """処理側から途中までの結果を通知する（ワーカースレッドから呼ばれる）"""
+        self.partial = result
+    
+    def stop(self):
+        """処理に停止を求める（停止の合図を受け取る処理のみ。途中までの結果を返して終わる）"""
+        self.stop_event.set()
+
+class JobQueue:
+    """サーバープロセス全体で共有する文字起こし処理のキュー
+    
+    処理はスレッドプールで実行し、UIは状態をポーリングして表示する。
+    そのため処理中もスクリプトのスレッドは塞がらず、画面操作による再実行でも処理は止まらない。
+    終わって結果を表示した処理は、finished_ttl 秒経つか max_finished 個を超えると古いものから取り除く。
+    結果をまだ表示していない処理は、持ち主が戻ってくるまで残しておく。
+    """
+    
+    def __init__(self, max_jobs=BACKGROUND_MAX_JOBS, finished_ttl=BACKGROUND_FINISHED_TTL,
+                 max_finished=BACKGROUND_MAX_FINISHED):
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="transcription")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._finished_ttl = finished_ttl
+        self._max_finished = max_finished
+    
+    def submit(self, session_id, filename, func, *args, trace=None, incremental=False, **kwargs):
+        """処理をキューに追加する。func は report キーワード引数で進捗を通知し、結果を返す関数
+        
+        trace を渡すと、キューに追加する前に計測した段階（アップロードなど）も同じ診断情報にまとめる。
+        incremental が True の場合は、func に途中結果の通知先 update と停止の合図 stop も渡す。
+        """
+        job = BackgroundJob(session_id, filename, trace)
+        if incremental:
+            kwargs = dict(kwargs, update=job.update, stop=job.stop_event)
+        with self._lock:
+            self._evict()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+    
+    def _run(self, job, func, args, kwargs):
+        job.status = "running"
+        try:
+            with trace_to(job.trace):
+                job.result = func(*args, report=job.report, **kwargs)
+            job.progress = 1.0
+            job.status = "done"
+        except Exception as e:
+            job.error = f"{str(e)}\n\n{traceback.format_exc()}"
+            job.status = "failed"
+        finally:
+            job.finished = time.monotonic()
+    
+    def _evict(self):
+        # 結果を表示した処理のうち、期限を過ぎた・数の上限を超えたものを取り除く（self._lock を取得して呼ぶ）
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished is not None and job.collected),
+            key=lambda job: job.finished
+        )
+        expire = time.monotonic() - self._finished_ttl
+        excess = len(finished) - self._max_finished
+        for n, job in enumerate(finished):
+            if n < excess or job.finished < expire:
+                del self._jobs[job.id]
+    
+    def jobs_for(self, session_id):
+        """セッションの処理を新しい順に返す"""
+        with self._lock:
+            self._evict()
+            jobs = [job for job in self._jobs.values() if job.session_id == session_id]
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+    
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
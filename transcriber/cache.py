@@ -0,0 +1,104 @@
+"""文字起こし結果のキャッシュ（音声の内容・モデル・出力形式・プロンプトが同じなら再利用）"""
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import contextlib
+from .api import extract_text_and_segments
+from .engines import get_engine
+
+# キャッシュの保存場所と上限（超えた分は古いものから削除）
+CACHE_DIR = os.environ.get("WHISPER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "whisper-streamlit"))
+CACHE_DB_PATH = os.path.join(CACHE_DIR, "transcriptions.sqlite3")
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    """ファイルの内容のSHA-256をブロック単位で計算する"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_sha256(source):
+    """音声（ファイルパスまたは (ファイル名, バイト列)）の内容のSHA-256を計算する"""
+    if isinstance(source, tuple):
+        return hashlib.sha256(source[1]).hexdigest()
+    return file_sha256(source)
+
+def transcription_cache_key(audio_hash, model_name, response_format, prompt):
+    """キャッシュのキー（音声の内容・モデル・出力形式・プロンプトのハッシュ）を作る"""
+    payload = json.dumps([audio_hash, model_name, response_format, prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+@contextlib.contextmanager
+def _open_cache():
+    """キャッシュのデータベースに接続する（抜けるときにコミットし、例外ならロールバックして、接続を閉じる）"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with contextlib.closing(sqlite3.connect(CACHE_DB_PATH, timeout=30)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS transcriptions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        yield conn
+
+def cache_get(key):
+    """キャッシュから結果を取得する（無ければNone）"""
+    try:
+        with _open_cache() as conn:
+            row = conn.execute("SELECT value FROM transcriptions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE transcriptions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+    except sqlite3.Error:
+        return None
+
+def cache_put(key, value, max_bytes=CACHE_MAX_BYTES):
+    """結果をキャッシュに保存し、上限を超えた分を最後に使われた時刻が古い順に削除する"""
+    data = json.dumps(value, ensure_ascii=False)
+    try:
+        with _open_cache() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO transcriptions (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data.encode("utf-8")), time.time())
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM transcriptions").fetchone()[0]
+            if total > max_bytes:
+                rows = conn.execute("SELECT key, size FROM transcriptions ORDER BY last_used").fetchall()
+                for old_key, size in rows:
+                    if total <= max_bytes:
+                        break
+                    conn.execute("DELETE FROM transcriptions WHERE key = ?", (old_key,))
+                    total -= size
+    except sqlite3.Error:
+        pass  # キャッシュに保存できなくても文字起こし自体は成功させる
+
+def cached_transcription(source, model_name, with_timestamps, prompt=""):
+    """キャッシュを確認してから、モデルに対応するエンジンで文字起こしする
+    
+    Args:
+        source: 音声ファイルのパス、またはメモリ上の音声 (ファイル名, バイト列)
+    
+    Returns:
+        {"text": テキスト, "segments": セグメントのリスト, "cached": キャッシュから取得したか}
+    """
+    engine = get_engine(model_name)
+    key = transcription_cache_key(
+        source_sha256(source),
+        model_name,
+        engine.response_format(model_name, with_timestamps),
+        prompt
+    )
+    
+    value = cache_get(key)
+    if value is not None:
+        return dict(value, cached=True)
+    
+    text, segments = extract_text_and_segments(
+        engine.transcribe(source, model_name, with_timestamps, prompt)
+    )
+    value = {"text": text, "segments": segments}
+    cache_put(key, value)
+    return dict(value, cached=False)
@@ -0,0 +1,284 @@
+"""複数の音声ファイルをまとめて文字起こしするコマンドラインツール
+
+使い方:
+    python -m transcriber 録音フォルダ/
+    python -m transcriber --manifest files.txt --jobs 4 --concurrency 8 --formats txt,json
+    python -m transcriber 録音フォルダ/ --metrics-log stderr --metrics metrics.prom
+    python -m transcriber --follow 録音中.webm
+
+各入力ファイルと同じ場所に、同じ名前で .txt / .srt / .vtt / .json の結果を書き出す。
+--follow では書き込み中の1つのファイルを追いかけ、得られた結果を順に表示してから書き出す。
+APIキーと接続先は環境変数 OPENAI_API_KEY・OPENAI_BASE_URL から読み込む。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .export import Transcript, format_timestamp
+from .audio import probe_audio
+from .api import configure_client, get_client, set_max_concurrency, build_prompt
+from .pipeline import DEFAULT_MAX_WORKERS, CONTEXT_MODES, process_audio_file
+from .engines import get_engine, all_models
+from .live import LIVE_IDLE_TIMEOUT, LiveTranscriber
+from .background import BACKGROUND_MAX_JOBS
+from .metrics import set_json_log, prometheus_text
+
+# フォルダから探す音声ファイルの拡張子
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".mp4", ".webm", ".mpeg4", ".ogg", ".flac")
+
+# 書き出せる結果の形式
+OUTPUT_FORMATS = ("txt", "srt", "vtt", "json")
+
+_print_lock = threading.Lock()
+
+def log(message):
+    """複数のスレッドから出力が混ざらないように表示する"""
+    with _print_lock:
+        print(message, file=sys.stderr, flush=True)
+
+def find_audio_files(paths, recursive=False):
+    """指定されたファイル・フォルダから音声ファイルの一覧を作る"""
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+        elif os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.lower().endswith(AUDIO_EXTENSIONS)
+                )
+                if not recursive:
+                    break
+                dirs.sort()
+        else:
+            log(f"見つかりません: {path}")
+    return files
+
+def read_manifest(manifest_path):
+    """1行に1ファイルを書いた一覧を読み込む（空行と # から始まる行は無視、相対パスは一覧の場所から）"""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base_dir, line) for line in lines if line and not line.startswith("#")]
+
+def output_paths(file_path, formats):
+    """入力ファイルと同じ場所に書き出す結果のパス"""
+    base = os.path.splitext(file_path)[0]
+    return {output_format: f"{base}.{output_format}" for output_format in formats}
+
+def write_outputs(file_path, result, formats, model):
+    """結果を指定された形式で入力ファイルの隣に書き出す"""
+    transcript = Transcript.from_segments(result["text"], result["segments"])
+    paths = output_paths(file_path, formats)
+    written = []
+    for output_format, path in paths.items():
+        if output_format not in transcript.formats():
+            continue  # タイムスタンプが無い場合は字幕を作れない
+        if output_format == "json":
+            content = json.dumps(dict(
+                {"file": os.path.basename(file_path), "model": model},
+                **transcript.to_dict(),
+                parts=result["parts"],
+                missing=result["missing"],
+                gaps=result.get("gaps", [])
+            ), ensure_ascii=False, indent=2)
+        else:
+            content = transcript.export(output_format)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        written.append(path)
+    return written
+
+def transcribe_file(file_path, settings, formats, max_workers):
+    """1つのファイルを文字起こしして結果を書き出し、集計用の情報を返す"""
+    name = os.path.basename(file_path)
+    
+    def report(message=None, progress=None):
+        if message is not None:
+            log(f"[{name}] {message}")
+    
+    try:
+        duration = probe_audio(file_path)["duration"]
+    except Exception:
+        duration = 0.0
+    
+    started = time.perf_counter()
+    try:
+        result = process_audio_file(file_path, name, settings, max_workers, report=report, keep_source=True)
+        written = write_outputs(file_path, result, formats, settings["model"])
+        error = None
+        if result["missing"]:
+            # 文字起こしできなかった区間（結果のファイルにも目印が入っている）
+            error = f"{result['missing']}個のパートが未完了です（" + "、".join(
+                f"{format_timestamp(gap['start'])}〜{format_timestamp(gap['end'])}" for gap in result["gaps"]
+            ) + "）"
+        report(f"完了: {', '.join(os.path.basename(path) for path in written)}")
+    except Exception as e:
+        error = str(e)
+        report(f"エラー: {error}")
+    
+    return {"file": file_path, "duration": duration, "elapsed": time.perf_counter() - started, "error": error}
+
+def follow_file(file_path, settings, formats, idle_timeout=LIVE_IDLE_TIMEOUT):
+    """書き込み中のファイルを追いかけて文字起こしし、得られた結果を順に表示してから書き出す
+    
+    ファイルが idle_timeout 秒更新されないか、Ctrl+C で止めると、残りの音声を送って終わる。
+    """
+    name = os.path.basename(file_path)
+    printed = {"segments": 0, "text": ""}
+    
+    def report(message=None, progress=None):
+        if message is not None:
+            log(f"[{name}] {message}")
+    
+    def show(result):
+        # 前回までに表示した分より後だけを表示する
+        if result["segments"]:
+            for segment in result["segments"][printed["segments"]:]:
+                start_time = format_timestamp(segment["start"])
+                end_time = format_timestamp(segment["end"])
+                print(f"[{start_time} → {end_time}] {segment['text'].strip()}", flush=True)
+            printed["segments"] = len(result["segments"])
+        else:
+            text = result["text"]
+            print(text[len(printed["text"]):].strip() if text.startswith(printed["text"]) else text, flush=True)
+            printed["text"] = text
+    
+    live = LiveTranscriber(settings, on_update=show, report=report)
+    stop = threading.Event()
+    errors = []
+    
+    def run():
+        try:
+            live.follow_file(file_path, stop, idle_timeout)
+        except Exception as e:
+            errors.append(e)
+    
+    # Ctrl+C を受け取れるよう、文字起こしは別スレッドで行う
+    worker = threading.Thread(target=run)
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+    except KeyboardInterrupt:
+        log("停止しています（残りの音声を送信中）...")
+        stop.set()
+        worker.join()
+    
+    if errors:
+        report(f"エラー: {str(errors[0])}")
+        return 1
+    written = write_outputs(file_path, live.result(), formats, settings["model"])
+    report(f"完了: {', '.join(os.path.basename(path) for path in written)}")
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m transcriber",
+        description="音声ファイルをまとめて文字起こしし、各ファイルの隣に結果を書き出します。"
+    )
+    parser.add_argument("paths", nargs="*", help="音声ファイルまたはフォルダ")
+    parser.add_argument("--manifest", help="処理するファイルを1行に1つ書いた一覧")
+    parser.add_argument("--recursive", action="store_true", help="フォルダの中のフォルダも探す")
+    parser.add_argument("--model", default="whisper-1", choices=all_models(),
+                        help="faster-whisper- で始まるモデルはローカルのCPUで文字起こしする（faster-whisperが必要）")
+    parser.add_argument("--formats", default="txt,srt,json", help="書き出す形式（カンマ区切り、txt,srt,vtt,json）")
+    parser.add_argument("--no-timestamps", action="store_true", help="タイムスタンプを取得しない")
+    parser.add_argument("--jobs", type=int, default=BACKGROUND_MAX_JOBS, help="同時に処理するファイル数")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="全ファイルで同時に実行するAPI呼び出しの上限")
+    parser.add_argument("--max-duration", type=float, default=20, help="分割する際の1パートの最大長（分）")
+    parser.add_argument("--overlap", type=float, default=0, help="パート間で重ねる長さ（秒）")
+    parser.add_argument("--no-vad", action="store_true", help="無音の位置ではなく固定長で分割する")
+    parser.add_argument("--drop-silence", action="store_true", help="パート端の長い無音を送信しない")
+    parser.add_argument("--no-compress", action="store_true", help="送信前に音声を圧縮しない")
+    parser.add_argument("--context-mode", default="none", choices=CONTEXT_MODES,
+                        help="前のパートのテキストをプロンプトに引き継ぐ方法（refine: 文の途中で区切られたパートだけ送り直す、"
+                             "chain: --concurrency 個のグループに分けて順に送る）")
+    parser.add_argument("--context", default="", help="音声の内容（例: 会議/ミーティング）")
+    parser.add_argument("--nouns", default="", help="固有名詞（カンマ区切り）")
+    parser.add_argument("--skip-existing", action="store_true", help="結果がすべて書き出し済みのファイルを飛ばす")
+    parser.add_argument("--follow", action="store_true", help="書き込み中のファイルを追いかけて逐次文字起こしする（1ファイルのみ）")
+    parser.add_argument("--metrics-log", metavar="DEST", help="段階ごとの計測をJSONログとして書き出す先（stderr またはファイル）")
+    parser.add_argument("--metrics", metavar="FILE", help="終了時に段階ごとの集計をPrometheusのテキスト形式で書き出すファイル")
+    args = parser.parse_args(argv)
+    
+    args.formats = [value.strip() for value in args.formats.split(",") if value.strip()]
+    unknown = [value for value in args.formats if value not in OUTPUT_FORMATS]
+    if unknown:
+        parser.error(f"不明な形式です: {', '.join(unknown)}")
+    if not args.paths and not args.manifest:
+        parser.error("音声ファイル・フォルダまたは --manifest を指定してください")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    files = find_audio_files(args.paths, args.recursive)
+    if args.manifest:
+        files.extend(read_manifest(args.manifest))
+    if args.skip_existing:
+        files = [
+            path for path in files
+            if not all(os.path.exists(output) for output in output_paths(path, args.formats).values())
+        ]
+    if not files:
+        log("処理するファイルがありません")
+        return 0
+    
+    settings = {
+        "model": args.model,
+        "with_timestamps": not args.no_timestamps,
+        "prompt": build_prompt(args.context, args.nouns),
+        "compress": not args.no_compress,
+        "max_duration": args.max_duration * 60,  # 分を秒に変換
+        "use_vad": not args.no_vad,
+        "drop_silence": args.drop_silence,
+        "overlap": args.overlap,
+        "context_mode": args.context_mode
+    }
+    
+    if args.metrics_log:
+        set_json_log(args.metrics_log)
+    if get_engine(args.model).remote:
+        configure_client()
+        get_client()  # APIキーが無い場合は処理を始める前にエラーにする
+    # ファイルを並列に処理しても、API呼び出しの数は全体でこの上限に収める
+    set_max_concurrency(args.concurrency)
+    
+    if args.follow:
+        if len(files) != 1:
+            log("--follow では1つのファイルを指定してください")
+            return 2
+        return follow_file(files[0], settings, args.formats)
+    
+    log(f"{len(files)}個のファイルを最大{args.jobs}ファイル並列で処理します...")
+    started = time.perf_counter()
+    summaries = []
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [
+            executor.submit(transcribe_file, path, settings, args.formats, args.concurrency)
+            for path in files
+        ]
+        for future in as_completed(futures):
+            summaries.append(future.result())
+    elapsed = time.perf_counter() - started
+    
+    # 処理速度の集計（音声の秒数 / 実際にかかった秒数）
+    failed = [summary for summary in summaries if summary["error"]]
+    audio_seconds = sum(summary["duration"] for summary in summaries if not summary["error"])
+    print(f"ファイル数: {len(summaries)}（成功 {len(summaries) - len(failed)} / 失敗 {len(failed)}）")
+    print(f"音声の合計: {audio_seconds:.1f}秒 / 処理時間: {elapsed:.1f}秒")
+    print(f"処理速度: {audio_seconds / elapsed if elapsed > 0 else 0.0:.2f} 音声秒/秒")
+    for summary in failed:
+        print(f"失敗: {summary['file']}: {summary['error']}")
+    
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(prometheus_text())
+    
+    return 1 if failed else 0
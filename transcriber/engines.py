@@ -0,0 +1,167 @@
+"""文字起こしエンジン（OpenAI API・ローカルのCPUで動かすfaster-whisper）
+
+モデル名からエンジンを選ぶ。どのエンジンも transcribe の結果はOpenAI APIと同じ形
+（テキスト、または "text"・"segments" を持つ辞書）で返すため、キャッシュや結果の統合は共通。
+"""
+import io
+import os
+import abc
+import threading
+import importlib.util
+from .audio import API_MAX_BYTES, API_MAX_DURATION
+from .api import response_format_for, request_transcription
+from .metrics import span
+
+# OpenAI APIのモデル
+OPENAI_MODELS = ("whisper-1", "gpt-4o-mini-transcribe")
+
+# ローカルで動かすモデル（"faster-whisper-" の後ろがfaster-whisperのモデル名）
+LOCAL_MODEL_PREFIX = "faster-whisper-"
+LOCAL_MODELS = tuple(
+    LOCAL_MODEL_PREFIX + size
+    for size in os.environ.get("WHISPER_LOCAL_MODELS", "small,medium,large-v3").split(",")
+    if size.strip()
+)
+
+# ローカルのエンジンの設定
+LOCAL_DEVICE = os.environ.get("WHISPER_LOCAL_DEVICE", "cpu")
+LOCAL_COMPUTE_TYPE = os.environ.get("WHISPER_LOCAL_COMPUTE_TYPE", "int8")            # CPUではint8に量子化して高速化
+LOCAL_WORKERS = int(os.environ.get("WHISPER_LOCAL_WORKERS", str(max(1, (os.cpu_count() or 1) // 2))))  # 同時に処理するパートの数
+LOCAL_BATCH_SIZE = int(os.environ.get("WHISPER_LOCAL_BATCH_SIZE", "8"))              # 1パートの中でまとめて推論する区間の数
+LOCAL_BEAM_SIZE = 5
+
+class TranscriptionEngine(abc.ABC):
+    """文字起こしエンジンの共通のインターフェース
+    
+    max_bytes・max_duration は1回の transcribe に渡せる音声の上限（None は上限なし）。
+    remote が True のエンジンには音声をアップロードするため、送信前の圧縮が効く。
+    """
+    name = ""
+    models = ()
+    max_bytes = None
+    max_duration = None
+    remote = False
+    
+    def response_format(self, model_name, with_timestamps):
+        """結果の形式（キャッシュのキーに使う）"""
+        return "verbose_json" if with_timestamps else "text"
+    
+    @abc.abstractmethod
+    def transcribe(self, source, model_name, with_timestamps, prompt=""):
+        """1つの音声を文字起こしする
+        
+        Args:
+            source: 音声ファイルのパス、またはメモリ上の音声 (ファイル名, バイト列)
+        
+        Returns:
+            テキスト、または "text"・"segments" を持つ辞書（extract_text_and_segments で読める形）
+        """
+    
+    def available(self):
+        """このエンジンを使えるか（必要なパッケージがインストールされているか）"""
+        return True
+
+class OpenAIEngine(TranscriptionEngine):
+    """OpenAI APIで文字起こしする（流量制限・再試行は api モジュールで行う）"""
+    name = "openai"
+    models = OPENAI_MODELS
+    max_bytes = API_MAX_BYTES
+    max_duration = API_MAX_DURATION
+    remote = True
+    
+    def response_format(self, model_name, with_timestamps):
+        return response_format_for(model_name, with_timestamps)
+    
+    def transcribe(self, source, model_name, with_timestamps, prompt=""):
+        return request_transcription(source, model_name, with_timestamps, prompt)
+
+class FasterWhisperEngine(TranscriptionEngine):
+    """faster-whisper（CTranslate2）でローカルのCPUを使って文字起こしする
+    
+    モデルはプロセスで1回だけ読み込み、すべてのスレッドで共有する。複数のパートを同時に
+    渡すと LOCAL_WORKERS 個まで並列に推論し、CPUのコアを分け合う（1つの推論が使うスレッド数は
+    コア数 / LOCAL_WORKERS）。faster-whisperが対応していれば、1つのパートの中の区間も
+    LOCAL_BATCH_SIZE 個ずつまとめて推論する。
+    """
+    name = "faster-whisper"
+    models = LOCAL_MODELS
+    
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+    
+    def available(self):
+        return importlib.util.find_spec("faster_whisper") is not None
+    
+    def load_model(self, model_name):
+        """モデルを読み込む（読み込み済みなら同じものを返す）"""
+        with self._lock:
+            if model_name not in self._models:
+                try:
+                    import faster_whisper
+                except ImportError:
+                    raise RuntimeError(
+                        "ローカルで文字起こしするには faster-whisper をインストールしてください（pip install faster-whisper）"
+                    )
+                
+                with span("load_model", model=model_name):
+                    model = faster_whisper.WhisperModel(
+                        model_name[len(LOCAL_MODEL_PREFIX):],
+                        device=LOCAL_DEVICE,
+                        compute_type=LOCAL_COMPUTE_TYPE,
+                        cpu_threads=max(1, (os.cpu_count() or 1) // LOCAL_WORKERS),
+                        num_workers=LOCAL_WORKERS
+                    )
+                    batched = None
+                    if LOCAL_BATCH_SIZE > 1 and hasattr(faster_whisper, "BatchedInferencePipeline"):
+                        batched = faster_whisper.BatchedInferencePipeline(model=model)
+                self._models[model_name] = (model, batched)
+            return self._models[model_name]
+    
+    def transcribe(self, source, model_name, with_timestamps, prompt=""):
+        model, batched = self.load_model(model_name)
+        audio = io.BytesIO(source[1]) if isinstance(source, tuple) else source
+        
+        with span("local", model=model_name) as record:
+            if batched is not None:
+                segments, info = batched.transcribe(
+                    audio,
+                    beam_size=LOCAL_BEAM_SIZE,
+                    initial_prompt=prompt or None,
+                    batch_size=LOCAL_BATCH_SIZE,
+                    without_timestamps=not with_timestamps
+                )
+            else:
+                segments, info = model.transcribe(
+                    audio,
+                    beam_size=LOCAL_BEAM_SIZE,
+                    initial_prompt=prompt or None,
+                    without_timestamps=not with_timestamps
+                )
+            # segments はジェネレーターで、読み進めたときに推論が行われる
+            segments = [{"start": segment.start, "end": segment.end, "text": segment.text} for segment in segments]
+            record["audio_seconds"] = info.duration
+        
+        text = "".join(segment["text"] for segment in segments).strip()
+        if not with_timestamps:
+            return text
+        return {"text": text, "segments": segments}
+
+ENGINES = (OpenAIEngine(), FasterWhisperEngine())
+
+def get_engine(model_name):
+    """モデル名から文字起こしエンジンを選ぶ"""
+    for engine in ENGINES:
+        if model_name in engine.models:
+            return engine
+    if model_name.startswith(LOCAL_MODEL_PREFIX):
+        return ENGINES[1]
+    return ENGINES[0]
+
+def available_models():
+    """使えるエンジンのモデル名の一覧（faster-whisperが無ければOpenAI APIのモデルのみ）"""
+    return [model_name for engine in ENGINES if engine.available() for model_name in engine.models]
+
+def all_models():
+    """すべてのエンジンのモデル名の一覧"""
+    return [model_name for engine in ENGINES for model_name in engine.models]
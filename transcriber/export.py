@@ -0,0 +1,149 @@
+"""文字起こし結果の書き出し（テキスト・タイムスタンプ付きテキスト・SRT・WebVTT・JSON）
+
+セグメントは開始・終了時刻を array、テキストをリストで持つ Transcript にまとめ、
+各形式の文字列は join でまとめて作る。作った結果は Transcript ごとに保存するため、
+同じ形式を何度ダウンロードしても作るのは最初の1回だけ。
+"""
+import json
+from array import array
+from .metrics import span
+
+# 書き出せる形式: 形式 → (表示名, 拡張子, MIMEタイプ)
+EXPORT_FORMATS = {
+    "txt": ("テキストのみ", ".txt", "text/plain"),
+    "timestamps": ("タイムスタンプ付きテキスト", ".txt", "text/plain"),
+    "srt": ("字幕ファイル (SRT)", ".srt", "text/plain"),
+    "vtt": ("字幕ファイル (WebVTT)", ".vtt", "text/vtt"),
+    "json": ("JSON", ".json", "application/json")
+}
+
+# セグメントが必要な形式
+SEGMENT_FORMATS = ("timestamps", "srt", "vtt")
+
+def format_timestamp(seconds):
+    """秒数を MM:SS.MS 形式に変換"""
+    minutes = int(seconds // 60)
+    secs = int(seconds % 60)
+    millisecs = int((seconds % 1) * 1000)
+    return f"{minutes:02}:{secs:02}.{millisecs:03}"
+
+def srt_timestamp(seconds):
+    """秒数をSRT形式のタイムスタンプに変換 (HH:MM:SS,MS)"""
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    millisecs = int((seconds % 1) * 1000)
+    
+    return f"{hours:02}:{minutes:02}:{secs:02},{millisecs:03}"
+
+def vtt_timestamp(seconds):
+    """秒数をWebVTT形式のタイムスタンプに変換 (HH:MM:SS.MS)"""
+    return srt_timestamp(seconds).replace(",", ".")
+
+class Transcript:
+    """1つの文字起こし結果（テキストとセグメント）と、書き出した結果の保存先
+    
+    セグメントは辞書のリストではなく、開始・終了時刻の array とテキストのリストで持つ。
+    """
+    __slots__ = ("text", "starts", "ends", "texts", "_exports", "_table")
+    
+    def __init__(self, text="", starts=(), ends=(), texts=()):
+        self.text = text
+        self.starts = array("d", starts)
+        self.ends = array("d", ends)
+        self.texts = list(texts)
+        self._exports = {}
+        self._table = None
+    
+    @classmethod
+    def from_segments(cls, text, segments, time_offset=0):
+        """APIの結果のセグメント（属性を持つオブジェクトまたは辞書）から作る（不明な形式は除く）"""
+        transcript = cls(text)
+        for segment in segments:
+            if hasattr(segment, 'start') and hasattr(segment, 'end') and hasattr(segment, 'text'):
+                start, end, segment_text = segment.start, segment.end, segment.text
+            elif isinstance(segment, dict):
+                start, end, segment_text = segment.get('start', 0), segment.get('end', 0), segment.get('text', '')
+            else:
+                continue
+            transcript.starts.append(start + time_offset)
+            transcript.ends.append(end + time_offset)
+            transcript.texts.append(segment_text)
+        return transcript
+    
+    def __len__(self):
+        return len(self.texts)
+    
+    @property
+    def has_segments(self):
+        return bool(self.texts)
+    
+    def formats(self):
+        """この結果で書き出せる形式（セグメントが無ければテキストとJSONのみ）"""
+        return [name for name in EXPORT_FORMATS if self.has_segments or name not in SEGMENT_FORMATS]
+    
+    def segments(self):
+        """セグメントを辞書のリストで返す"""
+        return [
+            {"start": start, "end": end, "text": text}
+            for start, end, text in zip(self.starts, self.ends, self.texts)
+        ]
+    
+    def to_dict(self):
+        return {"text": self.text, "segments": self.segments()}
+    
+    def table(self):
+        """セグメントを表示用の表（"start"・"end"・"text" の列ごとのリスト）にする（初回だけ作る）
+        
+        セグメントごとに要素を並べるのではなく、表として一度に渡して表示するために使う。
+        """
+        if self._table is None:
+            self._table = {
+                "start": [format_timestamp(start) for start in self.starts],
+                "end": [format_timestamp(end) for end in self.ends],
+                "text": [text.strip() for text in self.texts]
+            }
+        return self._table
+    
+    def export(self, name):
+        """指定した形式の文字列を返す（初回だけ作り、以降は保存した結果を返す）"""
+        if name not in self._exports:
+            with span("export", format=name) as record:
+                self._exports[name] = getattr(self, f"_write_{name}")()
+                record["bytes"] = len(self._exports[name].encode("utf-8"))
+        return self._exports[name]
+    
+    def _rows(self):
+        return zip(self.starts, self.ends, self.texts)
+    
+    def _write_txt(self):
+        return self.text
+    
+    def _write_timestamps(self):
+        return "".join(
+            f"[{format_timestamp(start)} → {format_timestamp(end)}] {text}\n\n"
+            for start, end, text in self._rows()
+        )
+    
+    def _write_srt(self):
+        return "".join(
+            f"{i}\n{srt_timestamp(start)} --> {srt_timestamp(end)}\n{text}\n\n"
+            for i, (start, end, text) in enumerate(self._rows(), start=1)
+        )
+    
+    def _write_vtt(self):
+        return "WEBVTT\n\n" + "".join(
+            f"{vtt_timestamp(start)} --> {vtt_timestamp(end)}\n{text.strip()}\n\n"
+            for start, end, text in self._rows()
+        )
+    
+    def _write_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+
+def create_timestamped_text(segments, time_offset=0):
+    """タイムスタンプ付きテキストを作成（オフセット付き）"""
+    return Transcript.from_segments("", segments, time_offset).export("timestamps")
+
+def convert_to_srt(segments, time_offset=0):
+    """Whisper APIの結果をSRT形式に変換（オフセット付き）"""
+    return Transcript.from_segments("", segments, time_offset).export("srt")
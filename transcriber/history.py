@@ -0,0 +1,166 @@
+"""文字起こし履歴の保存（SQLite、本文とセグメントは圧縮して保存し、上限を超えたら古いものから削除）
+
+履歴は持ち主（アプリではブラウザーのURLに保存したトークン）ごとに分け、読み書きは持ち主が一致する行だけに行う。
+"""
+import os
+import json
+import zlib
+import sqlite3
+import contextlib
+from datetime import datetime
+from .cache import CACHE_DIR
+
+# 履歴の保存場所と上限
+HISTORY_DB_PATH = os.path.join(CACHE_DIR, "history.sqlite3")
+HISTORY_MAX_ITEMS = 500              # 持ち主ごとに保存する件数の上限
+HISTORY_MAX_BYTES = 50 * 1024 * 1024  # 持ち主ごとに保存する本文・セグメントの合計（圧縮後）の上限
+HISTORY_TOTAL_MAX_BYTES = int(os.environ.get("WHISPER_HISTORY_TOTAL_MB", "500")) * 1024 * 1024  # 全体の上限
+HISTORY_PREVIEW_CHARS = 200          # 一覧に表示する本文の先頭の文字数
+
+@contextlib.contextmanager
+def _open_history():
+    """履歴のデータベースに接続する（抜けるときにコミットし、例外ならロールバックして、接続を閉じる）"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with contextlib.closing(sqlite3.connect(HISTORY_DB_PATH, timeout=30)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created TEXT NOT NULL, filename TEXT NOT NULL, "
+            "preview TEXT NOT NULL, chars INTEGER NOT NULL, num_segments INTEGER NOT NULL, "
+            "text BLOB NOT NULL, segments BLOB NOT NULL, size INTEGER NOT NULL, owner TEXT NOT NULL DEFAULT '')"
+        )
+        # 持ち主の列が無い以前の形式の履歴に列を追加する
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE history ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_owner ON history (owner, id)")
+        yield conn
+
+def _pack_segments(segments):
+    """セグメントを [開始, 終了, テキスト] の配列にして圧縮する（時刻はミリ秒単位に丸める）"""
+    rows = [[round(segment["start"], 3), round(segment["end"], 3), segment["text"]] for segment in segments]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+def _unpack_segments(data):
+    return [{"start": start, "end": end, "text": text} for start, end, text in json.loads(zlib.decompress(data))]
+
+def add_history(filename, text, segments, owner=""):
+    """結果を履歴に追加し、件数・サイズの上限を超えた分を古い順に削除する
+    
+    件数・サイズの上限は持ち主ごとに数え、他の持ち主の履歴は削除しない。
+    ただし全体の合計が HISTORY_TOTAL_MAX_BYTES を超えた場合は、持ち主によらず古いものから削除する
+    （使われなくなった持ち主の履歴が残り続けないように）。
+    
+    Returns:
+        追加した履歴のID（保存できなかった場合はNone）
+    """
+    packed_text = zlib.compress(text.encode("utf-8"))
+    packed_segments = _pack_segments(segments)
+    try:
+        with _open_history() as conn:
+            cursor = conn.execute(
+                "INSERT INTO history (created, filename, preview, chars, num_segments, text, segments, size, owner) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), filename, text[:HISTORY_PREVIEW_CHARS], len(text),
+                 len(segments), packed_text, packed_segments, len(packed_text) + len(packed_segments), owner)
+            )
+            history_id = cursor.lastrowid
+            
+            # 持ち主の履歴を新しいものから数えて上限を超えた分を削除
+            rows = conn.execute("SELECT id, size FROM history WHERE owner = ? ORDER BY id DESC", (owner,)).fetchall()
+            total = 0
+            for count, (old_id, size) in enumerate(rows, start=1):
+                total += size
+                if old_id != history_id and (count > HISTORY_MAX_ITEMS or total > HISTORY_MAX_BYTES):
+                    conn.execute("DELETE FROM history WHERE id = ?", (old_id,))
+            
+            # 全体の上限を超えた分を、持ち主によらず古い順に削除
+            rows = conn.execute("SELECT id, size FROM history ORDER BY id DESC").fetchall()
+            total = 0
+            for old_id, size in rows:
+                total += size
+                if old_id != history_id and total > HISTORY_TOTAL_MAX_BYTES:
+                    conn.execute("DELETE FROM history WHERE id = ?", (old_id,))
+        return history_id
+    except sqlite3.Error:
+        return None
+
+def update_history(history_id, text, segments, owner=""):
+    """履歴の本文とセグメントを書き換える（ライブ文字起こしで結果が伸びるたびに呼ぶ）
+    
+    Returns:
+        書き換えたか（削除済みなどで見つからなかった場合はFalse）
+    """
+    packed_text = zlib.compress(text.encode("utf-8"))
+    packed_segments = _pack_segments(segments)
+    try:
+        with _open_history() as conn:
+            cursor = conn.execute(
+                "UPDATE history SET preview = ?, chars = ?, num_segments = ?, text = ?, segments = ?, size = ? "
+                "WHERE id = ? AND owner = ?",
+                (text[:HISTORY_PREVIEW_CHARS], len(text), len(segments), packed_text, packed_segments,
+                 len(packed_text) + len(packed_segments), history_id, owner)
+            )
+            return cursor.rowcount > 0
+    except sqlite3.Error:
+        return False
+
+def count_history(owner=""):
+    """持ち主の履歴の件数"""
+    try:
+        with _open_history() as conn:
+            return conn.execute("SELECT COUNT(*) FROM history WHERE owner = ?", (owner,)).fetchone()[0]
+    except sqlite3.Error:
+        return 0
+
+def list_history(offset=0, limit=10, owner=""):
+    """持ち主の履歴を新しい順に返す（本文は先頭だけで、セグメントは読み込まない）"""
+    try:
+        with _open_history() as conn:
+            rows = conn.execute(
+                "SELECT id, created, filename, preview, chars, num_segments FROM history "
+                "WHERE owner = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (owner, limit, offset)
+            ).fetchall()
+    except sqlite3.Error:
+        return []
+    return [
+        {"id": row[0], "timestamp": row[1], "filename": row[2], "preview": row[3], "chars": row[4],
+         "has_timestamps": row[5] > 0}
+        for row in rows
+    ]
+
+def load_history(history_id, owner=""):
+    """持ち主の1件の履歴の本文とセグメントを読み込む（無い・持ち主が異なる場合はNone）"""
+    try:
+        with _open_history() as conn:
+            row = conn.execute(
+                "SELECT created, filename, text, segments FROM history WHERE id = ? AND owner = ?", (history_id, owner)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    segments = _unpack_segments(row[3])
+    return {
+        "id": history_id,
+        "timestamp": row[0],
+        "filename": row[1],
+        "text": zlib.decompress(row[2]).decode("utf-8"),
+        "has_timestamps": bool(segments),
+        "segments": segments
+    }
+
+def delete_history(history_id, owner=""):
+    try:
+        with _open_history() as conn:
+            conn.execute("DELETE FROM history WHERE id = ? AND owner = ?", (history_id, owner))
+    except sqlite3.Error:
+        pass
+
+def clear_history(owner=""):
+    """持ち主の履歴をすべて削除する"""
+    try:
+        with _open_history() as conn:
+            conn.execute("DELETE FROM history WHERE owner = ?", (owner,))
+    except sqlite3.Error:
+        pass
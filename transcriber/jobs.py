@@ -0,0 +1,169 @@
+"""長い音声の処理状況（分割計画と完了したパートの結果）の保存と再開
+
+ジョブのIDは音声と設定だけから決める（同じ音声を持っていれば誰でも再開できる）。
+一覧には持ち主（アプリではブラウザーのURLに保存したトークン）のジョブだけを返す。
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import contextlib
+from datetime import datetime
+from .audio import AudioChunk
+from .cache import CACHE_DIR
+
+# ジョブの保存場所
+JOBS_DIR = os.path.join(CACHE_DIR, "jobs")
+
+# 再開されないまま残ったジョブを削除するまでの日数
+JOBS_MAX_AGE_DAYS = float(os.environ.get("WHISPER_JOBS_MAX_AGE_DAYS", "7"))
+
+# このプロセスで実行中のジョブのID（同じジョブを同時に2回実行しないため）
+_active_jobs = set()
+_active_lock = threading.Lock()
+
+def make_job_id(audio_hash, settings):
+    """音声の内容と処理設定から長い音声の処理（ジョブ）のIDを作る"""
+    payload = json.dumps([audio_hash, settings], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+@contextlib.contextmanager
+def claim_job(job_id):
+    """ジョブを実行中として登録する（既に実行中なら RuntimeError）"""
+    with _active_lock:
+        if job_id in _active_jobs:
+            raise RuntimeError("同じ音声・設定の処理が実行中です。完了するか停止するまでお待ちください。")
+        _active_jobs.add(job_id)
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+
+def is_job_active(job_id):
+    """ジョブがこのプロセスで実行中か"""
+    with _active_lock:
+        return job_id in _active_jobs
+
+def _job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+def _write_json_atomic(path, value):
+    """書き込み途中で中断されても壊れたファイルが残らないようにJSONを保存する"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def create_job(job_id, source_path, filename, settings, plan, move_source=True, owner=""):
+    """分割計画と送信用の音声をジョブとして保存する
+    
+    source_path のファイルはジョブのディレクトリへ移動し、
+    中断後もアップロードし直さずに残りのパートを処理できるようにする。
+    move_source が False の場合は移動せず、元の場所のファイルを参照する
+    （コマンドラインから実行する場合など、入力ファイルが残る場合）。
+    owner は一覧に表示する持ち主（list_jobs を参照）。
+    """
+    job_dir = _job_dir(job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    
+    if move_source:
+        source = os.path.join(job_dir, "source" + os.path.splitext(source_path)[1])
+        shutil.move(source_path, source)
+    else:
+        source = os.path.abspath(source_path)
+    
+    job = {
+        "id": job_id,
+        "filename": filename,
+        "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "source": source,
+        "owner": owner,
+        "settings": settings,
+        "chunks": [chunk.to_dict() for chunk in plan]
+    }
+    _write_json_atomic(os.path.join(job_dir, "job.json"), job)
+    return dict(job, chunks=plan)
+
+def load_job(job_id):
+    """保存されたジョブを読み込む（存在しない・読めなければNone）"""
+    try:
+        with open(os.path.join(_job_dir(job_id), "job.json"), encoding="utf-8") as f:
+            job = json.load(f)
+        job["chunks"] = [AudioChunk.from_dict(chunk) for chunk in job["chunks"]]
+        return job
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def set_job_owner(job_id, owner):
+    """ジョブの持ち主を変える（同じ音声を別の持ち主がアップロードして再開した場合）"""
+    job_path = os.path.join(_job_dir(job_id), "job.json")
+    with open(job_path, encoding="utf-8") as f:
+        job = json.load(f)
+    job["owner"] = owner
+    _write_json_atomic(job_path, job)
+
+def list_jobs(owner=""):
+    """持ち主の未完了のジョブを作成日時の新しい順に返す
+    
+    実行中のジョブは含めない（再開すると同じジョブが2つ同時に動くため）。
+    JOBS_MAX_AGE_DAYS 日より前に作られたジョブは、持ち主によらず削除する。
+    """
+    if not os.path.isdir(JOBS_DIR):
+        return []
+    jobs = []
+    expire = time.time() - JOBS_MAX_AGE_DAYS * 24 * 3600
+    for job_id in os.listdir(JOBS_DIR):
+        try:
+            if os.path.getmtime(_job_dir(job_id)) < expire and not is_job_active(job_id):
+                delete_job(job_id)
+                continue
+        except OSError:
+            continue
+        job = load_job(job_id)
+        if job and job.get("owner", "") == owner and not is_job_active(job_id):
+            jobs.append(job)
+    return sorted(jobs, key=lambda job: job["created"], reverse=True)
+
+def save_chunk_result(job_id, index, text, segments):
+    """完了したパートの結果を保存する（前回の失敗の記録は消す）"""
+    path = os.path.join(_job_dir(job_id), f"chunk_{index:04d}.json")
+    _write_json_atomic(path, {"text": text, "segments": segments})
+    try:
+        os.unlink(os.path.join(_job_dir(job_id), f"chunk_{index:04d}.error.json"))
+    except OSError:
+        pass
+
+def save_chunk_error(job_id, index, error):
+    """失敗したパートのエラーを保存する（再開するまで、どの区間が欠けているかを表示するため）"""
+    path = os.path.join(_job_dir(job_id), f"chunk_{index:04d}.error.json")
+    _write_json_atomic(path, {"error": error, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+def load_chunk_results(job_id, num_chunks):
+    """保存済みのパートの結果を {index: (テキスト, セグメント)} で返す"""
+    results = {}
+    for index in range(num_chunks):
+        try:
+            with open(os.path.join(_job_dir(job_id), f"chunk_{index:04d}.json"), encoding="utf-8") as f:
+                value = json.load(f)
+            results[index] = (value["text"], value["segments"])
+        except (OSError, ValueError, KeyError):
+            continue
+    return results
+
+def load_chunk_errors(job_id, num_chunks):
+    """保存済みのパートのエラーを {index: エラーメッセージ} で返す（その後に完了したパートは含まない）"""
+    errors = {}
+    for index in range(num_chunks):
+        try:
+            with open(os.path.join(_job_dir(job_id), f"chunk_{index:04d}.error.json"), encoding="utf-8") as f:
+                errors[index] = json.load(f)["error"]
+        except (OSError, ValueError, KeyError):
+            continue
+    return errors
+
+def delete_job(job_id):
+    """ジョブと保存した音声・結果を削除する"""
+    shutil.rmtree(_job_dir(job_id), ignore_errors=True)
@@ -0,0 +1,420 @@
+"""録音中の音声の逐次文字起こし（ライブモード）
+
+音声をモノラルのPCMとして受け取りながら、発話の切れ目（無音）で区切った短いウィンドウが
+そろうたびにAPIへ送り、結果を順につないでいく。録音の終了を待たずに数秒遅れで結果が得られる。
+入力は次の2通り。
+- follow_file: 録音ソフトなどが書き込み中のファイルを、伸びた分だけ読み続ける
+- feed_file: 録音済みの短い音声（Streamlitの st.audio_input で録音したものなど）を続けて追加する
+
+st.* を使わないため、バックグラウンドのスレッドやコマンドラインから実行できる。
+アプリから書き込み中のファイルを指定できるのは、LIVE_WATCH_DIR のディレクトリの中のファイルだけ。
+"""
+import os
+import time
+import queue
+import threading
+import numpy as np
+from .audio import (
+    VAD_FRAME_SEC, frame_energy_db, silence_threshold, plan_chunks_by_silence,
+    decode_pcm, open_pcm_decoder, encode_pcm
+)
+from .api import carryover_prompt, extract_text_and_segments
+from .cache import cached_transcription
+from .engines import get_engine
+from .history import add_history, update_history
+from .pipeline import (
+    CHUNK_MAX_ATTEMPTS, STITCH_MIN_MATCH, gap_line, gap_segment, preceding_text, stitch_segments, stitch_text
+)
+from .metrics import span
+
+LIVE_SAMPLE_RATE = 16000      # デコードするサンプルレート
+LIVE_MIN_WINDOW = 5           # 送信するウィンドウの最短の長さ（秒）
+LIVE_MAX_WINDOW = 30          # ウィンドウの最大長（発話の切れ目が無くてもこの長さで送る）
+LIVE_PAUSE = 0.5              # ウィンドウの区切りとみなす無音の長さ（秒）
+LIVE_NOISE_HISTORY = 600      # 無音の閾値を決めるために覚えておく音量の長さ（秒）
+LIVE_POLL_INTERVAL = 0.5      # 書き込み中のファイルの伸びを確認する間隔（秒）
+LIVE_IDLE_TIMEOUT = 15        # ファイルが伸びなくなってから録音の終了とみなすまでの秒数
+LIVE_READ_BYTES = 64 * 1024   # ファイルやffmpegの出力を1回に読むバイト数
+
+# アプリから書き込み中のファイルとして指定できるディレクトリ（未設定ならアプリからは指定できない）
+LIVE_WATCH_DIR = os.environ.get("WHISPER_LIVE_DIR") or None
+
+def resolve_live_path(name, base_dir=LIVE_WATCH_DIR):
+    """アプリで指定されたファイル名を base_dir の中の実際のパスに解決する
+    
+    base_dir が無い場合、またはシンボリックリンクや ".." で base_dir の外を指す場合は ValueError。
+    """
+    if not base_dir:
+        raise ValueError("書き込み中のファイルを置くディレクトリ（WHISPER_LIVE_DIR）が設定されていません。")
+    base = os.path.realpath(base_dir)
+    path = os.path.realpath(os.path.join(base, name))
+    if os.path.commonpath([base, path]) != base or path == base:
+        raise ValueError("指定できるのは録音用のディレクトリの中のファイルだけです。")
+    return path
+
+class LiveTranscriber:
+    """受け取った音声をウィンドウに区切って順に文字起こしし、結果をつないでいく
+    
+    feed_pcm で音声を追加すると、送信できるウィンドウがそろうたびに（呼び出したスレッドで）
+    APIを呼び出す。flush で残りの音声もすべて送る。ウィンドウの位置はサンプル数で管理するため、
+    セグメントの時刻は録音の先頭からの位置になる。
+    """
+    
+    def __init__(self, settings, history_filename=None, on_update=None, report=None, history_owner=""):
+        """
+        Args:
+            settings: model, with_timestamps, prompt, compress, use_vad, drop_silence, overlap, context_mode を持つ設定
+            history_filename: 結果が伸びるたびに履歴にも保存する際のファイル名（None の場合は保存しない）
+            on_update: ウィンドウの結果をつなぐたびに result() の値で呼ばれる関数
+            report: 進捗を (message=None, progress=None) で受け取る関数
+            history_owner: 履歴の持ち主（アプリではセッションのID）
+        """
+        self.settings = settings
+        self.history_filename = history_filename
+        self.history_owner = history_owner
+        self.history_id = None
+        self.on_update = on_update
+        self.report = report or _ignore_report
+        self.sample_rate = LIVE_SAMPLE_RATE
+        self.frame_len = int(LIVE_SAMPLE_RATE * VAD_FRAME_SEC)
+        self.text = ""
+        self.segments = []
+        self.windows = 0         # 送信したウィンドウの数
+        self.failed = 0          # 文字起こしに失敗したウィンドウの数
+        self.gaps = []           # 文字起こしに失敗したウィンドウの区間と理由
+        self.received = 0        # 受け取った音声の長さ（サンプル数）
+        self._pending = np.zeros(0, dtype=np.int16)        # まだ送っていない音声
+        self._pending_start = 0                             # _pending の先頭の位置（サンプル数）
+        self._overlap_end = None                            # 前のウィンドウと重ねている場合の前のウィンドウの終了位置
+        self._noise = np.zeros(0, dtype=np.float32)         # 最近のフレームごとの音量（無音の閾値に使う）
+        self._lock = threading.Lock()
+        self._turns = threading.Condition()   # 録音を追加する順番（reserve_turn で受け取る）
+        self._next_turn = 0                    # 次に渡す順番
+        self._current_turn = 0                 # 追加できる順番
+    
+    def feed_pcm(self, samples):
+        """モノラル・LIVE_SAMPLE_RATE の16bit PCM（NumPy配列）を追加し、そろったウィンドウを送る"""
+        with self._lock:
+            self._pending = np.concatenate([self._pending, samples])
+            self.received += len(samples)
+            self._send_ready(final=False)
+    
+    def flush(self):
+        """まだ送っていない音声をすべて送る（録音の終わりや、録音のかたまりの区切りで呼ぶ）"""
+        with self._lock:
+            self._send_ready(final=True)
+            self._overlap_end = None
+    
+    def reserve_turn(self):
+        """録音を追加する順番を受け取る（feed_file を別々のスレッドで呼ぶ場合に、受け取った順に追加する）"""
+        with self._turns:
+            turn = self._next_turn
+            self._next_turn += 1
+            return turn
+    
+    def feed_file(self, file_path, turn=None):
+        """録音済みの音声を、これまでの音声の続きとして文字起こしする
+        
+        turn（reserve_turn の値）を渡すと、デコードした後、それより前の順番の録音を追加し終えるまで待つ。
+        失敗した場合も順番は次へ進める。
+        """
+        try:
+            samples = decode_pcm(file_path, self.sample_rate)
+            self._wait_turn(turn)
+            self.feed_pcm(samples)
+            self.flush()
+        finally:
+            if turn is not None:
+                self._wait_turn(turn)
+                with self._turns:
+                    self._current_turn += 1
+                    self._turns.notify_all()
+    
+    def _wait_turn(self, turn):
+        # turn の順番が来るまで待つ（None なら待たない）
+        if turn is None:
+            return
+        with self._turns:
+            self._turns.wait_for(lambda: self._current_turn == turn)
+    
+    def follow_file(self, file_path, stop=None, idle_timeout=LIVE_IDLE_TIMEOUT):
+        """書き込み中のファイルを、伸びた分だけffmpegに渡してデコードしながら文字起こしする
+        
+        ファイルが idle_timeout 秒伸びなかったとき、または stop（threading.Event）が
+        セットされたときに録音の終了とみなし、残りの音声を送って戻る。
+        """
+        process = open_pcm_decoder(self.sample_rate)
+        outputs = queue.Queue()
+        
+        def read_output():
+            # ffmpegの出力が詰まって書き込みが止まらないよう、別スレッドで読み続ける
+            while True:
+                data = process.stdout.read1(LIVE_READ_BYTES)
+                if not data:
+                    break
+                outputs.put(data)
+            outputs.put(None)
+        
+        errors = []
+        
+        def read_errors():
+            # ffmpegのエラー出力も別スレッドで集める（パイプが詰まってffmpegが止まらないように）
+            errors.append(process.stderr.read())
+        
+        reader = threading.Thread(target=read_output, daemon=True)
+        reader.start()
+        error_reader = threading.Thread(target=read_errors, daemon=True)
+        error_reader.start()
+        
+        remainder = b""
+        
+        def feed_outputs(block):
+            # デコード済みのPCMを受け取って送る（終わりに達したらFalse）
+            nonlocal remainder
+            while True:
+                try:
+                    data = outputs.get(block)
+                except queue.Empty:
+                    return True
+                if data is None:
+                    return False
+                data = remainder + data
+                usable = len(data) - len(data) % 2
+                remainder = data[usable:]
+                self.feed_pcm(np.frombuffer(data[:usable], dtype=np.int16))
+        
+        broken = False
+        try:
+            with open(file_path, "rb") as f:
+                last_growth = time.monotonic()
+                while not (stop is not None and stop.is_set()):
+                    data = f.read(LIVE_READ_BYTES)
+                    if data:
+                        try:
+                            process.stdin.write(data)
+                            process.stdin.flush()
+                        except BrokenPipeError:
+                            # ffmpegが途中で終了した（読めない形式など）。渡すのをやめて、デコード済みの分だけ送る
+                            broken = True
+                            break
+                        last_growth = time.monotonic()
+                    elif time.monotonic() - last_growth > idle_timeout:
+                        break
+                    else:
+                        time.sleep(LIVE_POLL_INTERVAL)
+                    feed_outputs(block=False)
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                broken = True
+        
+        # 書き込みを終えた後にデコードされた残りを受け取る
+        while feed_outputs(block=True):
+            pass
+        reader.join()
+        error_reader.join()
+        process.stderr.close()
+        stderr = b"".join(errors).decode(errors="ignore")
+        if process.wait() != 0 and (broken or self.received == 0):
+            self.flush()
+            raise RuntimeError(f"ffmpegによる音声のデコードに失敗しました: {stderr}")
+        self.flush()
+    
+    def result(self):
+        """これまでの結果（{"text", "segments", "parts", "missing", "gaps", "duration", "history_id"}）
+        
+        失敗したウィンドウは再開できないため "missing" には数えず、区間を "gaps" に入れる。
+        """
+        return {
+            "text": self.text,
+            "segments": list(self.segments),
+            "parts": self.windows,
+            "missing": 0,
+            "gaps": list(self.gaps),
+            "duration": self.received / self.sample_rate,
+            "history_id": self.history_id
+        }
+    
+    def _send_ready(self, final):
+        """区切れるところまでのウィンドウを順に送る"""
+        while len(self._pending):
+            cut, forced = self._find_cut(final)
+            if cut is None:
+                break
+            start = self._pending_start
+            self._send_window(self._pending[:cut], start)
+            
+            # 発話の途中で区切った場合は、次のウィンドウの先頭を前に広げて重ねる
+            overlap = 0
+            if forced and not final:
+                overlap = min(round(self.settings.get("overlap", 0) * self.sample_rate), cut // 2)
+            self._overlap_end = start + cut if overlap else None
+            self._pending = self._pending[cut - overlap:]
+            self._pending_start = start + cut - overlap
+    
+    def _find_cut(self, final):
+        """次のウィンドウの終わりの位置を (_pending 内のサンプル数, 発話の途中で区切ったか) で返す
+        
+        まだ送れない場合は (None, False)。LIVE_MIN_WINDOW 秒から LIVE_MAX_WINDOW 秒までの間に
+        LIVE_PAUSE 秒以上の無音があれば最後の無音の中央で区切り、無いまま LIVE_MAX_WINDOW 秒に達したら
+        ファイルの分割と同じ方法で最も静かな位置を探して区切る。
+        """
+        length = len(self._pending)
+        if final:
+            return length, False
+        
+        sample_rate = self.sample_rate
+        head = self._overlap_end - self._pending_start if self._overlap_end is not None else 0
+        if length < head + LIVE_MIN_WINDOW * sample_rate:
+            return None, False
+        
+        use_vad = self.settings.get("use_vad", True)
+        energy_db = frame_energy_db(self._pending, self.frame_len)
+        if use_vad:
+            silent = energy_db < silence_threshold(np.concatenate([self._noise, energy_db]))
+            first = (head + LIVE_MIN_WINDOW * sample_rate) // self.frame_len
+            last = (head + LIVE_MAX_WINDOW * sample_rate) // self.frame_len
+            quiet = np.flatnonzero(silent[first:last]) + first
+            if len(quiet):
+                # 無音のフレームを連続した区間に分け、十分に長い最後の区間の中央で区切る
+                breaks = np.flatnonzero(np.diff(quiet) > 1)
+                starts = np.concatenate([quiet[:1], quiet[breaks + 1]])
+                ends = np.concatenate([quiet[breaks], quiet[-1:]]) + 1
+                long_runs = np.flatnonzero(ends - starts >= int(LIVE_PAUSE / VAD_FRAME_SEC))
+                if len(long_runs):
+                    k = long_runs[-1]
+                    return int(starts[k] + ends[k]) // 2 * self.frame_len, False
+        
+        if length < head + LIVE_MAX_WINDOW * sample_rate:
+            return None, False
+        if use_vad:
+            plan = plan_chunks_by_silence(
+                energy_db, length, sample_rate, LIVE_MAX_WINDOW, search_window=LIVE_MAX_WINDOW - LIVE_MIN_WINDOW
+            )
+            return plan[0].end_sample, True
+        return head + LIVE_MAX_WINDOW * sample_rate, True
+    
+    def _send_window(self, window, start):
+        """1つのウィンドウを文字起こしして結果につなぐ
+        
+        失敗したウィンドウは CHUNK_MAX_ATTEMPTS 回まで送り直し、それでも失敗した場合は
+        その区間に文字起こしできなかったことを示す目印を入れて続ける。
+        """
+        self.windows += 1
+        offset = start / self.sample_rate
+        
+        energy_db = frame_energy_db(window, self.frame_len)
+        noise = np.concatenate([self._noise, energy_db])
+        self._noise = noise[-int(LIVE_NOISE_HISTORY / VAD_FRAME_SEC):]
+        if self.settings.get("drop_silence") and len(energy_db) and not (energy_db >= silence_threshold(noise)).any():
+            return  # 全体が無音のウィンドウは送信しない
+        
+        compress = self.settings.get("compress", True) and get_engine(self.settings["model"]).remote
+        # ウィンドウは1つずつ順に送るため、前のウィンドウまでのテキストを待たずに引き継げる
+        prompt = self.settings["prompt"]
+        if self.settings.get("context_mode", "none") != "none":
+            prompt = carryover_prompt(prompt, preceding_text(self.text, self.segments, offset))
+        
+        for attempt in range(1, CHUNK_MAX_ATTEMPTS + 1):
+            try:
+                source = encode_pcm(window, self.sample_rate, compress, name=f"live{self.windows}")
+                result = cached_transcription(
+                    source, self.settings["model"], self.settings["with_timestamps"], prompt
+                )
+                text, segments = extract_text_and_segments(result, offset)
+                break
+            except Exception as e:
+                error = e
+                self.report(f"ウィンドウ {self.windows}（{offset:.1f}秒〜）でエラーが発生しました（{attempt}回目）: {str(e)}")
+        else:
+            # 失敗した区間は目印を入れて、結果の中で分かるようにする
+            self.failed += 1
+            end = (start + len(window)) / self.sample_rate
+            self.gaps.append({"part": self.windows, "start": offset, "end": end, "error": str(error)})
+            text = gap_line(offset, end)
+            segments = []
+            if self.segments or (not self.text and self._returns_segments()):
+                segments = [gap_segment(offset, end)]
+        
+        with span("merge", parts=1):
+            self._append(text, segments, start, len(window))
+        self.report(f"{(start + len(window)) / self.sample_rate:.1f}秒まで文字起こししました")
+        
+        if self.history_filename is not None:
+            if self.history_id is None:
+                self.history_id = add_history(self.history_filename, self.text, self.segments, self.history_owner)
+            else:
+                update_history(self.history_id, self.text, self.segments, self.history_owner)
+        if self.on_update:
+            self.on_update(self.result())
+    
+    def _returns_segments(self):
+        """設定したモデル・タイムスタンプの設定で、結果にセグメントが含まれるか"""
+        model_name = self.settings["model"]
+        return get_engine(model_name).response_format(model_name, self.settings["with_timestamps"]) == "verbose_json"
+    
+    def _append(self, text, segments, start, length):
+        """ウィンドウの結果をつなぐ（前のウィンドウと重ねた場合は重複を取り除く）"""
+        sample_rate = self.sample_rate
+        overlapping = self._overlap_end is not None and start < self._overlap_end
+        if segments or self.segments:
+            if overlapping:
+                segments = stitch_segments(self.segments, segments, start / sample_rate, self._overlap_end / sample_rate)
+            self.segments.extend(segments)
+            self.text = "".join(segment["text"] for segment in self.segments).strip()
+            return
+        
+        text = text.strip()
+        if not text:
+            return
+        if not self.text:
+            self.text = text
+        elif overlapping:
+            # 重なりに含まれる程度の文字数の範囲で一致を探す
+            chars_per_second = len(text) * sample_rate / max(length, 1)
+            window = int(chars_per_second * (self._overlap_end - start) / sample_rate * 1.5) + STITCH_MIN_MATCH
+            self.text = stitch_text(self.text, text, window)
+        else:
+            self.text += "\n" + text
+
+def run_live_transcription(file_path, filename, settings, report=None, update=None, stop=None,
+                           idle_timeout=LIVE_IDLE_TIMEOUT, owner=""):
+    """書き込み中のファイルを追いかけて文字起こしし、結果を履歴（持ち主 owner）にも逐次保存する
+    
+    JobQueue から incremental=True で実行すると、途中の結果が update に、
+    停止の合図が stop に渡される。
+    
+    Returns:
+        LiveTranscriber.result() の値（"history_id" に保存した履歴のID）
+    """
+    report = report or _ignore_report
+    live = LiveTranscriber(settings, history_filename=filename, on_update=update, report=report, history_owner=owner)
+    report("ファイルへの書き込みを待ちながら文字起こしします...")
+    live.follow_file(file_path, stop, idle_timeout)
+    if stop is not None and stop.is_set():
+        report(f"停止しました（{live.received / live.sample_rate:.1f}秒）")
+    else:
+        report(f"ファイルが{idle_timeout}秒間更新されなかったため終了しました（{live.received / live.sample_rate:.1f}秒）")
+    return live.result()
+
+def transcribe_recording(live, file_path, turn=None, report=None):
+    """録音済みの一時ファイルを live の続きとして文字起こしし、ファイルを削除する
+    
+    アプリのマイク録音を JobQueue で実行するために使う（スクリプトのスレッドを塞がない）。
+    turn には録音を受け取ったときに live.reserve_turn() で受け取った順番を渡す。
+    
+    Returns:
+        live.result() の値
+    """
+    report = report or _ignore_report
+    try:
+        report("録音を文字起こししています...")
+        live.feed_file(file_path, turn)
+    finally:
+        os.unlink(file_path)
+    report(f"録音を追加しました（{live.received / live.sample_rate:.1f}秒）")
+    return live.result()
+
+def _ignore_report(message=None, progress=None):
+    pass
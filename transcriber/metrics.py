@@ -0,0 +1,150 @@
+"""処理の段階（probe・decode・split・encode・upload・api・local・merge・export・render など）ごとの計測
+
+span で囲んだ処理の時間・バイト数・メモリ使用量の変化を記録する。記録は
+- 実行中の処理の Trace（trace_to で設定。ジョブごとの診断情報の表示に使う）
+- プロセス全体の集計（prometheus_text でPrometheusのテキスト形式にする）
+- JSONログ（1行に1スパン。環境変数 WHISPER_METRICS_LOG または set_json_log で出力先を指定）
+に送られる。
+"""
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import contextvars
+
+# 実行中の処理の記録先（ワーカースレッドへは contextvars.copy_context で引き継ぐ）
+_current_trace = contextvars.ContextVar("transcriber_trace", default=None)
+
+# プロセス全体の集計: 段階 → {"count", "seconds", "bytes", "errors"}
+_totals = {}
+_totals_lock = threading.Lock()
+
+# JSONログの出力先
+_json_log = None
+_json_log_lock = threading.Lock()
+
+def current_rss():
+    """現在のメモリ使用量（バイト、取得できなければNone）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Trace:
+    """1つの処理で記録したスパンの一覧（複数のスレッドから追加される）"""
+    
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+    
+    def add(self, record):
+        with self._lock:
+            self.spans.append(record)
+    
+    def summary(self):
+        """段階ごとに回数・合計時間・合計バイト数・メモリ使用量の変化の合計をまとめる（記録順）"""
+        rows = {}
+        with self._lock:
+            spans = list(self.spans)
+        for record in spans:
+            row = rows.setdefault(record["stage"], {
+                "stage": record["stage"], "count": 0, "seconds": 0.0, "bytes": 0, "rss_delta_mb": 0.0, "errors": 0
+            })
+            row["count"] += 1
+            row["seconds"] += record["seconds"]
+            row["bytes"] += record.get("bytes") or 0
+            row["rss_delta_mb"] += (record.get("rss_delta") or 0) / (1024 * 1024)
+            row["errors"] += "error" in record
+        return list(rows.values())
+
+@contextlib.contextmanager
+def trace_to(trace):
+    """この中で記録したスパンを trace に追加する"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextlib.contextmanager
+def span(stage, **attrs):
+    """処理の1段階を計測する
+    
+    with span("encode", part=1) as record: のように使い、バイト数などは
+    record["bytes"] = ... のように中で追加できる。例外は記録したうえでそのまま送出する。
+    """
+    record = dict(attrs, stage=stage)
+    rss_before = current_rss()
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - started
+        rss_after = current_rss()
+        if rss_before is not None and rss_after is not None:
+            record["rss_delta"] = rss_after - rss_before
+        _record(record)
+
+def _record(record):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(record)
+    
+    with _totals_lock:
+        total = _totals.setdefault(record["stage"], {"count": 0, "seconds": 0.0, "bytes": 0, "errors": 0})
+        total["count"] += 1
+        total["seconds"] += record["seconds"]
+        total["bytes"] += record.get("bytes") or 0
+        total["errors"] += "error" in record
+    
+    if _json_log is not None:
+        line = json.dumps(dict(record, time=time.time()), ensure_ascii=False, default=str)
+        with _json_log_lock:
+            # 出力先が差し替えられた直後でも閉じたファイルには書かない
+            if _json_log is not None:
+                _json_log.write(line + "\n")
+                _json_log.flush()
+
+def set_json_log(destination):
+    """スパンをJSONログとして出力する先を設定する（"stderr"・ファイルのパス・None で出力しない）
+    
+    前に開いたログファイルは閉じる（stderr は閉じない）。
+    """
+    global _json_log
+    if destination in (None, ""):
+        log = None
+    elif destination == "stderr":
+        log = sys.stderr
+    else:
+        log = open(destination, "a", encoding="utf-8")
+    
+    with _json_log_lock:
+        previous, _json_log = _json_log, log
+        if previous is not None and previous is not sys.stderr:
+            previous.close()
+
+def prometheus_text():
+    """プロセス全体の集計をPrometheusのテキスト形式で返す"""
+    with _totals_lock:
+        totals = {stage: dict(total) for stage, total in _totals.items()}
+    
+    metrics = [
+        ("transcriber_stage_seconds_total", "counter", "Total time spent in each pipeline stage.", "seconds"),
+        ("transcriber_stage_calls_total", "counter", "Number of spans recorded for each pipeline stage.", "count"),
+        ("transcriber_stage_bytes_total", "counter", "Bytes processed in each pipeline stage.", "bytes"),
+        ("transcriber_stage_errors_total", "counter", "Spans that ended with an exception.", "errors")
+    ]
+    lines = []
+    for name, metric_type, help_text, key in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(f'{name}{{stage="{stage}"}} {total[key]}' for stage, total in sorted(totals.items()))
+    return "\n".join(lines) + "\n"
+
+set_json_log(os.environ.get("WHISPER_METRICS_LOG"))
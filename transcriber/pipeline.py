@@ -0,0 +1,884 @@
+"""音声の変換・分割・並列の文字起こし・結果の統合を行う一連の処理
+
+st.* を使わないため、Streamlitのバックグラウンドのスレッドやコマンドラインから実行できる。
+"""
+import os
+import re
+import difflib
+import collections
+import functools
+import contextlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .audio import (
+    SPEECH_PROFILE_BYTES_PER_SEC, LOSSLESS_RATIO, probe_audio, transcode_for_speech, plan_audio_chunks, split_audio_file
+)
+from .api import carryover_prompt, extract_text_and_segments
+from .cache import file_sha256, cached_transcription
+from .engines import get_engine
+from .export import format_timestamp
+from .history import add_history
+from .jobs import (
+    make_job_id, claim_job, create_job, load_job, set_job_owner, save_chunk_result, save_chunk_error,
+    load_chunk_results, delete_job
+)
+from .metrics import span
+
+# 長い音声を分割した際の同時API呼び出し数のデフォルト値
+DEFAULT_MAX_WORKERS = 4
+
+# パートを重ねて分割した場合のつなぎ合わせの設定
+STITCH_SIMILARITY = 0.6     # 重複とみなすセグメントのテキストの類似度
+STITCH_MIN_MATCH = 6        # テキストだけでつなぐ際に一致とみなす最小の文字数
+
+# 前のパートのテキストをプロンプトに引き継ぐ方法（transcribe_chunks_parallel を参照）
+CONTEXT_MODES = ("none", "refine", "chain")
+
+# 文の終わりとみなす文字（これで終わらないパートの次のパートは、文の途中から始まる）
+SENTENCE_ENDINGS = tuple("。．.！!？?」』")
+
+# 失敗したパートを送り直す回数を含めた、1つのパートを送る最大の回数
+# （API呼び出しごとの再試行は call_with_retries で行い、ここでは切り出しの失敗なども含めて他のパートの後に送り直す）
+CHUNK_MAX_ATTEMPTS = 2
+
+# 文字起こしできなかった区間の結果に入れる目印
+GAP_TEXT = "[文字起こしできませんでした]"
+STOPPED_GAP_ERROR = "停止したため未処理"
+
+class TranscriptionStopped(Exception):
+    """停止を求められたため、パートの文字起こしを始めなかった"""
+
+def _needs_context(text):
+    """パートのテキストが文の途中で終わっているか（次のパートは文の続きから始まる）"""
+    text = text.rstrip()
+    return bool(text) and not text.endswith(SENTENCE_ENDINGS)
+
+def preceding_text(text, segments, offset):
+    """offset 秒より前に始まる部分のテキスト（重なった区間を次のパートのプロンプトに含めないため）"""
+    if not segments:
+        return text
+    return "".join(segment["text"] for segment in segments if segment["start"] < offset)
+
+def _chain_depths(previous):
+    """各パートが、このリストの中の前のパートを何個たどった位置にあるか"""
+    depths = [None] * len(previous)
+    for k in range(len(previous)):
+        chain = []
+        j = k
+        while depths[j] is None and isinstance(previous[j], int):
+            chain.append(j)
+            j = previous[j]
+        depth = depths[j] if depths[j] is not None else 0
+        depths[j] = depth
+        for j in reversed(chain):
+            depth += 1
+            depths[j] = depth
+    return depths
+
+def transcribe_chunks_parallel(part_sources, offsets, model_name, with_timestamps, prompt="",
+                               max_workers=DEFAULT_MAX_WORKERS, on_chunk_done=None, stop=None,
+                               context_mode="none", previous=None, max_attempts=CHUNK_MAX_ATTEMPTS, on_retry=None,
+                               files=None):
+    """分割された各パートをスレッドプールで並列に文字起こしする
+    
+    失敗したパートは max_attempts 回まで、キューの最後に入れ直して送り直す。
+    context_mode で、前のパートのテキストの末尾をプロンプトに引き継ぐかを選ぶ（CONTEXT_MODES）。
+    
+    - "none": すべてのパートを共通のプロンプトで並列に送る（最速）
+    - "refine": まず共通のプロンプトで並列に送り、前のパートが文の途中で終わっていたパートだけを
+      前のパートの末尾を引き継いで送り直す（前後の2パートがそろい次第、残りと並行して送る）
+    - "chain": ファイルごとに連続したパートを max_workers 個のグループに分け、グループの中では前のパートの
+      完了を待って末尾を引き継ぎ、グループどうしは並列に送る（グループの先頭のみ引き継がない）
+    
+    Args:
+        part_sources: 各パートの音声のリスト。ファイルのパス、(ファイル名, バイト列)、
+            またはそれらを返す引数なしの関数（ワーカー内で呼ばれ、切り出しも並列に行われる）
+        offsets: 各パートの開始位置（秒）のリスト
+        model_name: 使用するモデル
+        with_timestamps: タイムスタンプ付きで取得するか
+        prompt: 全パート共通のプロンプト
+        max_workers: 同時に実行するAPI呼び出しの上限
+        on_chunk_done: パート完了ごとに (index, 完了数, 総数, 結果, 例外またはNone) で呼ばれる関数。
+            呼び出し元のスレッドで実行されるため st.* を使ってよい
+        stop: セットされるとまだ始めていないパートを TranscriptionStopped で終える threading.Event
+        context_mode: 前のパートのテキストの引き継ぎ方
+        previous: 各パートの直前のパート。このリストの中の番号、完了済みのパートの
+            (テキスト, セグメント)、または None（先頭のパート）。省略するとリストの順につながっているとみなす
+        max_attempts: 1つのパートを送る最大の回数（送り直しを含む）
+        on_retry: パートを送り直すときに (index, 失敗した回数, 例外) で呼ばれる関数
+        files: 各パートのファイルの番号（"chain" のグループの大きさをファイルごとのパート数から決める）。
+            省略するとすべて同じファイルのパートとみなす
+    
+    Returns:
+        part_sources と同じ順序のリスト。各要素は (テキスト, セグメント) のタプルで、
+        失敗したパートは None
+    """
+    def transcribe_part(source, part_prompt):
+        if stop is not None and stop.is_set():
+            raise TranscriptionStopped()
+        if callable(source):
+            source = source()
+        return cached_transcription(source, model_name, with_timestamps, part_prompt)
+    
+    total = len(part_sources)
+    results = [None] * total
+    if total == 0:
+        return results
+    if previous is None:
+        previous = [None] + list(range(total - 1))
+    
+    workers = max(1, min(max_workers, total))
+    followers = [[] for _ in range(total)]
+    for k, prev in enumerate(previous):
+        if isinstance(prev, int):
+            followers[prev].append(k)
+    
+    first = [None] * total          # "refine" の1回目の結果（失敗・未完了は None）
+    first_done = [False] * total
+    attempts = [0] * total
+    done = 0
+    futures = {}
+    
+    def prompt_after(k, prev_result):
+        # 前のパートの結果があれば、その末尾を引き継いだプロンプト
+        if prev_result is None:
+            return prompt
+        return carryover_prompt(prompt, preceding_text(*prev_result, offsets[k]))
+    
+    def submit(k, part_prompt, stage):
+        # 計測の記録先を引き継ぐため、呼び出し元のコンテキストの中で実行する
+        attempts[k] += 1
+        future = executor.submit(contextvars.copy_context().run, transcribe_part, part_sources[k], part_prompt)
+        futures[future] = (k, stage, part_prompt)
+    
+    def finish(k, result, error):
+        nonlocal done
+        done += 1
+        results[k] = result
+        if on_chunk_done:
+            on_chunk_done(k, done, total, result, error)
+    
+    def decide(k, error=None):
+        # "refine" で、1回目が終わったパートを送り直すかどうかを決める
+        prev = previous[k]
+        if first[k] is None:
+            finish(k, None, error)
+            return
+        if isinstance(prev, int):
+            if not first_done[prev]:
+                return  # 前のパートの1回目を待つ
+            prev = first[prev]
+        if prev is not None and _needs_context(prev[0]):
+            submit(k, prompt_after(k, prev), "final")
+        else:
+            finish(k, first[k], None)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if context_mode == "refine":
+            for k in range(total):
+                submit(k, prompt, "first")
+        elif context_mode == "chain":
+            # ファイルごとに同じくらいの長さのグループに分け、グループの先頭から送る
+            files = files if files is not None else [0] * total
+            counts = collections.Counter(files)
+            group_size = [-(-counts[file] // workers) for file in files]
+            depths = _chain_depths(previous)
+            heads = [k for k in range(total) if not isinstance(previous[k], int) or depths[k] % group_size[k] == 0]
+            for k in heads:
+                submit(k, prompt_after(k, previous[k] if isinstance(previous[k], tuple) else None), "final")
+        else:
+            for k in range(total):
+                submit(k, prompt, "final")
+        
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                k, stage, part_prompt = futures.pop(future)
+                result = None
+                error = None
+                try:
+                    result = extract_text_and_segments(future.result(), offsets[k])
+                except Exception as e:
+                    error = e
+                
+                # 失敗したパートは、他のパートの後に同じプロンプトで送り直す
+                # （"refine" の送り直しが失敗した場合は1回目の結果があるため送り直さない）
+                if (error is not None and not isinstance(error, TranscriptionStopped)
+                        and attempts[k] < max_attempts and not (stage == "final" and context_mode == "refine")):
+                    if on_retry:
+                        on_retry(k, attempts[k], error)
+                    submit(k, part_prompt, stage)
+                    continue
+                
+                if stage == "first":
+                    first[k] = result
+                    first_done[k] = True
+                    decide(k, error)
+                    for j in followers[k]:
+                        if first_done[j] and first[j] is not None:
+                            decide(j)
+                elif context_mode == "refine":
+                    # 送り直しに失敗した場合は1回目の結果を使う
+                    finish(k, result if error is None else first[k], None)
+                else:
+                    finish(k, result, error)
+                    if context_mode == "chain":
+                        for j in followers[k]:
+                            if depths[j] % group_size[j] != 0:
+                                submit(j, prompt_after(j, result), "final")
+    
+    return results
+
+def _normalize_for_match(text):
+    """比較用に空白・記号を除き小文字にする"""
+    return re.sub(r"[\W_]+", "", text).lower()
+
+def _is_duplicate_text(a, b):
+    """2つのテキストが同じ発話を書き起こしたものとみなせるか"""
+    a, b = _normalize_for_match(a), _normalize_for_match(b)
+    if not a or not b:
+        return not a and not b
+    return a in b or b in a or difflib.SequenceMatcher(None, a, b).ratio() >= STITCH_SIMILARITY
+
+def _segment_middle(segment):
+    return (segment["start"] + segment["end"]) / 2
+
+def stitch_segments(segments, next_segments, overlap_start, overlap_end):
+    """重なった区間で前後のパートのセグメントをつなぎ、重複を取り除く
+    
+    重なりの中央より前は前のパートのセグメントを使い、次のパートからはその続きだけを使う
+    （どちらも重なりの端は前後の文脈が不足していて精度が落ちやすいため）。
+    境界をまたいで両方に残った同じ発話はテキストの類似度で判定し、より長い（途中で
+    切れていない）方を1つだけ残す。
+    
+    Args:
+        segments: それまでにつないだセグメント（重なりの後半にあるものはこのリストから取り除く）
+        next_segments: 次のパートのセグメント
+        overlap_start: 重なりの開始位置（次のパートの開始、秒）
+        overlap_end: 重なりの終了位置（前のパートの終了、秒）
+    
+    Returns:
+        segments の後ろに追加する次のパートのセグメント
+    """
+    middle = (overlap_start + overlap_end) / 2
+    while segments and _segment_middle(segments[-1]) >= middle:
+        segments.pop()
+    
+    if segments:
+        boundary = segments[-1]["end"]
+        next_segments = [segment for segment in next_segments if segment["end"] > boundary]
+    else:
+        next_segments = [segment for segment in next_segments if _segment_middle(segment) >= middle]
+    
+    while (segments and next_segments
+           and next_segments[0]["start"] < segments[-1]["end"]
+           and _is_duplicate_text(segments[-1]["text"], next_segments[0]["text"])):
+        duplicate = next_segments.pop(0)
+        if len(_normalize_for_match(duplicate["text"])) > len(_normalize_for_match(segments[-1]["text"])):
+            segments[-1] = duplicate
+    return next_segments
+
+def stitch_text(text, next_text, window):
+    """セグメントが無い場合に、前のテキストの末尾と次のテキストの先頭の一致部分でつなぐ
+    
+    Args:
+        text: それまでにつないだテキスト
+        next_text: 次のパートのテキスト
+        window: 一致を探す文字数（重なりの長さに相当する文字数）
+    """
+    tail = text[-window:]
+    head = next_text[:window]
+    match = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(0, len(tail), 0, len(head))
+    if match.size < STITCH_MIN_MATCH:
+        # 一致が見つからなければ改行でつなぐ
+        return text + "\n" + next_text
+    return text[:len(text) - len(tail) + match.a + match.size] + next_text[match.b + match.size:]
+
+def gap_segment(start, end):
+    """文字起こしできなかった区間を表すセグメント
+    
+    セグメントのテキストは区切らずにつなぐため、前後の文とくっつかないように空白で挟む。
+    """
+    return {"start": start, "end": end, "text": f" {GAP_TEXT} "}
+
+def gap_line(start, end):
+    """文字起こしできなかった区間を表すテキストの行"""
+    return f"[{format_timestamp(start)}〜{format_timestamp(end)} は文字起こしできませんでした]"
+
+def chunk_gaps(chunks, results, errors):
+    """未完了のパートの区間と理由のリスト
+    
+    Args:
+        chunks: 分割計画（AudioChunk のリスト）
+        results: パート番号 → (テキスト, セグメント) の辞書
+        errors: パート番号 → エラーメッセージの辞書（含まれないパートは停止したため未処理とする）
+    
+    Returns:
+        {"part": パート番号（1から）, "start": 開始秒, "end": 終了秒, "error": 理由} のリスト
+    """
+    return [
+        {"part": i + 1, "start": chunk.start, "end": chunk.end, "error": errors.get(i, STOPPED_GAP_ERROR)}
+        for i, chunk in enumerate(chunks) if i not in results
+    ]
+
+def stitch_chunk_results(chunks, results, gaps=()):
+    """重ねて分割したパートの結果を1つの連続したテキストとセグメントにまとめる
+    
+    Args:
+        chunks: 分割計画（AudioChunk のリスト）
+        results: パート番号 → (テキスト, セグメント) の辞書（未完了のパートは含まない）
+        gaps: 文字起こしできなかった区間として目印を入れる、未完了のパートの番号
+    
+    Returns:
+        (テキスト, セグメント) のタプル
+    """
+    use_segments = any(results[i][1] for i in results)
+    text = ""
+    segments = []
+    prev = None
+    for i, chunk in enumerate(chunks):
+        if i not in results:
+            prev = None
+            if i in gaps:
+                if use_segments:
+                    segments.append(gap_segment(chunk.start, chunk.end))
+                else:
+                    text = (text + "\n" if text else "") + gap_line(chunk.start, chunk.end)
+            continue
+        part_text, part_segments = results[i]
+        overlapping = prev is not None and chunk.start_sample < prev.end_sample
+        
+        if use_segments:
+            if overlapping:
+                part_segments = stitch_segments(segments, part_segments, chunk.start, prev.end)
+            segments.extend(part_segments)
+        elif not text:
+            text = part_text.strip()
+        elif overlapping:
+            # 重なりに含まれる程度の文字数の範囲で一致を探す
+            chars_per_second = len(part_text) / max(chunk.duration, 1e-3)
+            window = int(chars_per_second * (prev.end - chunk.start) * 1.5) + STITCH_MIN_MATCH
+            text = stitch_text(text, part_text.strip(), window)
+        else:
+            text += "\n" + part_text.strip()
+        prev = chunk
+    
+    if use_segments:
+        text = "".join(segment["text"] for segment in segments).strip()
+    return text, segments
+
+def merge_chunk_results(chunks, results, overlap=False, gaps=()):
+    """完了したパートの結果をパート順に1つのテキストとセグメントにまとめる
+    
+    未完了のパートは飛ばし、gaps に含まれるパートの区間には文字起こしできなかったことを示す目印を入れる
+    （処理中の途中の結果では、まだ順番が来ていないパートには目印を入れない）。
+    
+    Args:
+        chunks: 分割計画（AudioChunk のリスト）
+        results: パート番号 → (テキスト, セグメント) の辞書
+        overlap: パートを重ねて分割したか（重複を取り除いて1つの文章につなぐ）
+        gaps: 文字起こしできなかった区間として目印を入れる、未完了のパートの番号
+    
+    Returns:
+        (テキスト, セグメント) のタプル
+    """
+    with span("merge", parts=len(chunks)):
+        if overlap:
+            return stitch_chunk_results(chunks, results, gaps)
+        
+        use_segments = any(results[i][1] for i in results)
+        all_text = ""
+        all_segments = []
+        for i, chunk in enumerate(chunks):
+            if i in results:
+                part_text, part_segments = results[i]
+                all_text += f"\n--- パート {i+1} ---\n\n" + part_text
+                all_segments.extend(part_segments)
+            elif i in gaps:
+                all_text += f"\n--- パート {i+1} ---\n\n" + gap_line(chunk.start, chunk.end)
+                if use_segments:
+                    all_segments.append(gap_segment(chunk.start, chunk.end))
+        return all_text, all_segments
+
+class _ChunkedJobRun:
+    """1つのジョブの未完了のパートの切り出し・結果の保存・統合（run_chunked_job と process_audio_files で共通）
+    
+    呼び出す前に claim_job でジョブを実行中として登録しておくこと。
+    """
+    
+    def __init__(self, job, report):
+        self.job = job
+        self.report = report
+        self.chunks = job["chunks"]
+        self.results = load_chunk_results(job["id"], len(self.chunks))
+        self.pending = [i for i in range(len(self.chunks)) if i not in self.results]
+        self.errors = {}  # 今回失敗したパート → エラーメッセージ
+    
+    def split(self, compress):
+        """未完了のパートを、送信する直前にメモリ上で切り出す（pending と同じ順序のパートのリスト）"""
+        if not self.pending:
+            return []
+        return split_audio_file(
+            self.job["source"],
+            plan=[self.chunks[i] for i in self.pending],
+            log=self.report,
+            in_memory=True,
+            compress=compress
+        )
+    
+    def previous(self, i, position):
+        """パート i の直前のパート（今回送るなら position(i - 1) の番号、完了済みならその結果）"""
+        if i == 0:
+            return None
+        k = position(i - 1)
+        return k if k is not None else self.results.get(i - 1)
+    
+    def retry(self, i, attempt, error):
+        self.report(f"パート {i+1} でエラーが発生したため、後で送り直します（{attempt}回目）: {str(error)}")
+    
+    def done(self, i, result, error):
+        """パート i の結果を保存する（失敗した場合はエラーを保存して区間を報告する）"""
+        if error is None:
+            save_chunk_result(self.job["id"], i, *result)
+            self.results[i] = result
+            return
+        chunk = self.chunks[i]
+        self.errors[i] = str(error)
+        save_chunk_error(self.job["id"], i, str(error))
+        self.report(
+            f"パート {i+1}（{format_timestamp(chunk.start)}〜{format_timestamp(chunk.end)}）を"
+            f"文字起こしできませんでした: {str(error)}"
+        )
+    
+    def result(self, final=False):
+        """完了したパートを統合した結果（処理中は失敗したパートだけに、終わったら未完了のすべてのパートに目印を入れる）"""
+        gaps = chunk_gaps(self.chunks, self.results, self.errors)
+        if not final:
+            gaps = [gap for gap in gaps if gap["part"] - 1 in self.errors]
+        text, segments = merge_chunk_results(
+            self.chunks, self.results, self.job["settings"].get("overlap"), [gap["part"] - 1 for gap in gaps]
+        )
+        return {
+            "text": text, "segments": segments, "parts": len(self.chunks),
+            "missing": len(self.chunks) - len(self.results), "gaps": gaps
+        }
+    
+    def finish(self, stopped):
+        """最終的な結果を返す。全パートが完了していればジョブを削除し、未完了のパートがあれば報告する"""
+        result = self.result(final=True)
+        if not result["missing"]:
+            delete_job(self.job["id"])
+        elif stopped:
+            self.report("停止しました。残りのパートは「中断された処理」から再開できます。")
+        elif self.errors:
+            self.report(
+                f"{len(self.errors)}個のパートを文字起こしできませんでした。"
+                "「中断された処理」から失敗したパートだけを再実行できます。"
+            )
+        return result
+
+def _save_history(result, filename, history_owner):
+    """結果を履歴に保存し、"history_id" を加えた結果を返す（history_owner が None なら保存しない）"""
+    if history_owner is None:
+        return result
+    return dict(result, history_id=add_history(filename, result["text"], result["segments"], history_owner))
+
+def run_chunked_job(job, max_workers=DEFAULT_MAX_WORKERS, report=None, update=None, stop=None, history_owner=None):
+    """ジョブの未完了のパートを並列に文字起こしし、全パートの結果を統合して返す
+    
+    完了したパートは1つずつ保存するため、途中で中断しても次回は未完了のパートから再開できる。
+    失敗したパートは他のパートの後に送り直し、それでも失敗したパートはエラーを保存して、
+    結果のその区間に文字起こしできなかったことを示す目印を入れる。全パートが完了したらジョブを削除する。
+    
+    Args:
+        job: create_job / load_job で得たジョブ
+        max_workers: 同時に実行するAPI呼び出しの上限
+        report: 進捗を (message=None, progress=None) で受け取る関数
+        update: パートが完了するたびに、それまでに完了したパートを統合した途中の結果で呼ばれる関数
+        stop: セットされるとまだ始めていないパートを残して終える threading.Event（後で再開できる）
+        history_owner: 結果を履歴に保存する際の持ち主（None の場合は保存しない）
+    
+    Returns:
+        {"text": テキスト, "segments": セグメント, "parts": パート数, "missing": 未完了のパート数,
+         "gaps": 未完了のパートの区間と理由（chunk_gaps を参照）}。履歴に保存した場合は "history_id" も持つ
+    
+    Raises:
+        RuntimeError: 同じジョブを既に実行中の場合
+    """
+    report = report or _ignore_report
+    settings = job["settings"]
+    # 同じジョブを別のスレッドで同時に実行しない（一方が完了してジョブを削除すると、もう一方の保存先が無くなるため）
+    with claim_job(job["id"]):
+        run = _ChunkedJobRun(job, report)
+        
+        def publish():
+            # 完了したパートまでの結果を表示できるように渡す（失敗したパートには目印を入れる）
+            if update:
+                update(run.result())
+        
+        if run.pending:
+            publish()
+            if settings["prompt"]:
+                report(f"使用するプロンプト: {settings['prompt']}")
+            
+            # ローカルのエンジンには圧縮せずに渡す
+            parts = run.split(settings["compress"] and get_engine(settings["model"]).remote)
+            
+            # 各パートを並列に処理（進捗は前回までに完了したパートも含めた、終わったパートの割合）
+            total_parts = len(run.chunks)
+            finished_before = total_parts - len(run.pending)
+            report(f"{len(run.pending)}個のパートを最大{max_workers}並列で処理します...", finished_before / total_parts)
+            
+            def on_retry(k, attempt, error):
+                run.retry(run.pending[k], attempt, error)
+            
+            def on_chunk_done(k, done, total, result, error):
+                if isinstance(error, TranscriptionStopped):
+                    return
+                run.done(run.pending[k], result, error)
+                publish()
+                report(f"{done}/{total} パート完了", (finished_before + done) / total_parts)
+            
+            # 各パートの直前のパート（前回までに完了していればその結果を引き継ぐ）
+            positions = {i: k for k, i in enumerate(run.pending)}
+            
+            transcribe_chunks_parallel(
+                [part.source for part in parts],
+                [part.start for part in parts],
+                model_name=settings["model"],
+                with_timestamps=settings["with_timestamps"],
+                prompt=settings["prompt"],
+                max_workers=max_workers,
+                on_chunk_done=on_chunk_done,
+                stop=stop,
+                context_mode=settings.get("context_mode", "none"),
+                previous=[run.previous(i, positions.get) for i in run.pending],
+                on_retry=on_retry
+            )
+        
+        # 結果をパート順に統合（未完了のパートの区間には目印を入れる）
+        # 画面に表示されるのを待たずに、処理したスレッドで履歴に保存する
+        return _save_history(run.finish(stop is not None and stop.is_set()), job["filename"], history_owner)
+
+def prepare_audio_file(file_path, filename, settings, report=None, keep_source=False, owner=""):
+    """音声の長さとサイズを調べ、1回で送信できない音声は分割計画をジョブとして保存する
+    
+    同じ音声・設定で中断した処理があれば、新しく分割せずにそのジョブを返す。
+    ジョブを作った場合、file_path のファイルはジョブのディレクトリへ移動する（keep_source が True の場合は残す）。
+    ジョブのIDは音声と設定だけから決めるため、別の持ち主が中断したジョブも再開する
+    （同じ音声を持っていれば再開してよい）。その場合、ジョブの持ち主を owner に変える。
+    
+    Returns:
+        (音声の情報, ジョブ) のタプル。音声の情報は長さが取得できなければ None、
+        ジョブは1回で送信できる場合は None
+    """
+    report = report or _ignore_report
+    engine = get_engine(settings["model"])
+    compress = settings["compress"] and engine.remote
+    
+    # 音声の長さを取得して確認
+    try:
+        info = probe_audio(file_path)
+        duration_seconds = info["duration"]
+        report(f"音声の長さ: {duration_seconds:.1f}秒（約{int(duration_seconds/60)}分{int(duration_seconds%60)}秒）")
+    except Exception as e:
+        # 長さが取得できなくても通常処理を試みる
+        report(f"音声ファイルの長さを取得できませんでしたが、処理を続行します: {str(e)}")
+        return None, None
+    
+    # 送信するサイズの見積もり（圧縮する場合は送信用プロファイルのビットレートから求める）
+    if compress:
+        part_bytes_per_second = SPEECH_PROFILE_BYTES_PER_SEC
+        send_size = duration_seconds * part_bytes_per_second
+    else:
+        send_size = os.path.getsize(file_path)
+        part_bytes_per_second = info["sample_rate"] * info["channels"] * 2 * LOSSLESS_RATIO
+    
+    # 1パートの最大長（設定値、ただしエンジンの制限（APIは1500秒 = 25分）を上限とする）を超えるか、
+    # APIの制限（25MB）を超える場合は分割処理（短いパートに分けるほど並列に処理できる）
+    max_part_duration = min(settings["max_duration"], engine.max_duration or settings["max_duration"])
+    too_large = engine.max_bytes is not None and send_size > engine.max_bytes
+    if not (duration_seconds > max_part_duration or too_large):
+        return info, None
+    
+    if too_large:
+        report("⚠️ ファイルサイズがOpenAI APIの制限（25MB）を超えています。自動分割処理を行います。")
+    elif engine.max_duration is not None and duration_seconds > engine.max_duration:
+        report("⚠️ 音声ファイルの長さがOpenAI APIの制限（25分）を超えています。自動分割処理を行います。")
+    else:
+        report(f"音声を{max_part_duration / 60:g}分以内のパートに分割して、並列に文字起こしします。")
+    
+    # 同じ音声・設定で中断した処理があれば再開する
+    job_id = make_job_id(file_sha256(file_path), settings)
+    job = load_job(job_id)
+    
+    if job:
+        if job.get("owner", "") != owner:
+            set_job_owner(job_id, owner)
+            job["owner"] = owner
+        done_count = len(load_chunk_results(job_id, len(job["chunks"])))
+        report(f"前回中断した処理を再開します（{done_count}/{len(job['chunks'])} パート完了済み）")
+        return info, job
+    
+    # 分割計画を作成し、元の音声と一緒にジョブとして保存
+    # （各パートは元の音声から直接、送信用の形式で切り出すので変換は1回で済む）
+    report("音声ファイルの分割を準備中...")
+    plan = plan_audio_chunks(
+        file_path,
+        max_duration=max_part_duration,
+        use_vad=settings["use_vad"],
+        drop_silence=settings["drop_silence"],
+        max_bytes=engine.max_bytes,
+        bytes_per_second=part_bytes_per_second,
+        overlap=settings["overlap"],
+        log=report
+    )
+    return info, create_job(job_id, file_path, filename, settings, plan, move_source=not keep_source, owner=owner)
+
+def process_audio_file(file_path, filename, settings, max_workers=DEFAULT_MAX_WORKERS, report=None, keep_source=False,
+                       update=None, stop=None, owner="", history_owner=None):
+    """アップロードされた音声を変換・分割・文字起こしする一連の処理
+    
+    st.* を使わないため、バックグラウンドのスレッドから実行できる。
+    APIの制限を超える音声はジョブとして保存しながら分割して処理する。
+    file_path のファイルは処理後に削除する（keep_source が True の場合は残す）。
+    
+    Args:
+        file_path: アップロードされた音声を保存した一時ファイル
+        filename: 元のファイル名
+        settings: model, with_timestamps, prompt, compress, max_duration, use_vad, drop_silence, overlap,
+            context_mode（前のパートのテキストの引き継ぎ方、CONTEXT_MODES）を持つ設定
+        max_workers: 分割したパートを同時に処理する数
+        report: 進捗を (message=None, progress=None) で受け取る関数
+        keep_source: 入力ファイルを削除せずに残すか
+        update: 分割して処理する場合に、パートが完了するたびに途中の結果で呼ばれる関数
+        stop: 分割して処理する場合に、セットされると残りのパートを後で再開できるように残して終える threading.Event
+        owner: 分割して処理する場合のジョブの持ち主（list_jobs を参照）
+        history_owner: 結果を履歴に保存する際の持ち主（None の場合は保存しない）
+    
+    Returns:
+        {"text": テキスト, "segments": セグメント, "parts": パート数, "missing": 未完了のパート数,
+         "gaps": 未完了のパートの区間と理由}。履歴に保存した場合は "history_id" も持つ
+    """
+    report = report or _ignore_report
+    engine = get_engine(settings["model"])
+    # 圧縮はアップロードするエンジンの場合のみ（ローカルのエンジンには元の音声を渡す）
+    compress = settings["compress"] and engine.remote
+    
+    # 送信に使うファイル（圧縮する場合は変換後のファイル）
+    work_file_path = file_path
+    try:
+        info, job = prepare_audio_file(file_path, filename, settings, report, keep_source, owner)
+        if job:
+            return run_chunked_job(job, max_workers, report, update, stop, history_owner)
+        
+        # APIの制限内の場合は通常処理
+        # 送信用のコンパクトな形式に変換
+        if compress:
+            report("音声を送信用に変換中...")
+            work_file_path = transcode_for_speech(file_path)
+            report(f"送信用に変換しました: {os.path.getsize(file_path)} bytes → {os.path.getsize(work_file_path)} bytes")
+        
+        if settings["prompt"]:
+            report(f"使用するプロンプト: {settings['prompt']}")
+        report("OpenAI APIに送信中..." if engine.remote else "ローカルのモデルで文字起こし中...")
+        result = cached_transcription(work_file_path, settings["model"], settings["with_timestamps"], settings["prompt"])
+        if result["cached"]:
+            report("同じ音声・設定の結果をキャッシュから取得しました（API呼び出しなし）")
+        
+        return _save_history(
+            {"text": result["text"], "segments": result["segments"], "parts": 1, "missing": 0, "gaps": []},
+            filename,
+            history_owner
+        )
+    
+    finally:
+        # 一時ファイルを削除（分割処理の場合、元の音声はジョブ側で管理）
+        for path in {file_path, work_file_path}:
+            if keep_source and path == file_path:
+                continue
+            if os.path.exists(path):
+                os.unlink(path)
+
+def _whole_file_source(file_path, compress):
+    """1回で送信する音声（圧縮する場合は変換してメモリに読み込み、変換後のファイルは削除する）"""
+    if not compress:
+        return file_path
+    work_file_path = transcode_for_speech(file_path)
+    try:
+        with open(work_file_path, "rb") as f:
+            return (os.path.basename(work_file_path), f.read())
+    finally:
+        os.unlink(work_file_path)
+
+def process_audio_files(files, settings, max_workers=DEFAULT_MAX_WORKERS, report=None, keep_source=False,
+                        update=None, stop=None, owner="", history_owner=None):
+    """複数の音声をまとめて文字起こしし、結果をファイルごとに返す
+    
+    各ファイルを分割計画まで準備したら、全ファイルのパートを1つのキューに入れて
+    max_workers 個のスレッドで処理する。キューは長いパートから順に並べるため、短いファイルは
+    長いファイルのパートの後ろに詰めて処理され、ファイルの長さがまちまちでも最後まで
+    同時に実行するAPI呼び出しの数が max_workers に近いまま保たれる。
+    分割したファイルは process_audio_file と同じくジョブとして保存するため、
+    未完了のパートは「中断された処理」から再開できる。
+    
+    Args:
+        files: (アップロードされた音声を保存した一時ファイル, 元のファイル名) のリスト
+        settings: process_audio_file と同じ設定（全ファイルで共通）
+        max_workers: 全ファイルで同時に処理するパートの数
+        report: 進捗を (message=None, progress=None) で受け取る関数（メッセージにはファイル名が付く）
+        keep_source: 入力ファイルを削除せずに残すか
+        update: パートが完了するたびに、途中の結果 {"files": [ファイルごとの結果]} で呼ばれる関数
+        stop: セットされるとまだ始めていないパートを残して終える threading.Event
+        owner: 分割したファイルのジョブの持ち主（list_jobs を参照）
+        history_owner: 結果を履歴に保存する際の持ち主（None の場合は保存しない）
+    
+    Returns:
+        {"files": [ファイルごとの結果]}。各要素は process_audio_file の結果（"gaps" を含む）に
+        "filename"、"error"（準備・文字起こしに失敗した場合のメッセージ、成功した場合は None）、
+        "stopped"（分割しないファイルを停止したため文字起こししなかった場合に True）を加えたもの。
+        失敗・停止したファイル以外は履歴に保存し、"history_id" も持つ
+    """
+    report = report or _ignore_report
+    compress = settings["compress"] and get_engine(settings["model"]).remote
+    # run は分割したファイルのジョブの処理（_ChunkedJobRun）、result は分割しないファイルの結果
+    entries = [
+        {"filename": filename, "info": None, "job": None, "run": None, "result": None, "error": None, "stopped": False}
+        for _, filename in files
+    ]
+    
+    def file_report(n):
+        def report_file(message=None, progress=None):
+            if message is not None:
+                report(f"[{entries[n]['filename']}] {message}")
+        return report_file
+    
+    def prepare(n):
+        file_path, filename = files[n]
+        try:
+            entries[n]["info"], entries[n]["job"] = prepare_audio_file(
+                file_path, filename, settings, file_report(n), keep_source, owner
+            )
+        except Exception as e:
+            entries[n]["error"] = str(e)
+            file_report(n)(f"エラーが発生しました: {str(e)}")
+    
+    def file_result(entry, final=False, stopped=False):
+        if entry["run"]:
+            result = entry["run"].finish(stopped) if final else entry["run"].result()
+        else:
+            # 再開できるジョブが無いため、失敗したファイルは未完了ではなく失敗として扱う
+            text, segments = entry["result"] or ("", [])
+            result = {"text": text, "segments": segments, "parts": 1, "missing": 0, "gaps": []}
+        return dict(result, filename=entry["filename"], error=entry["error"], stopped=entry["stopped"])
+    
+    def publish():
+        if update:
+            update({"files": [file_result(entry) for entry in entries]})
+    
+    claims = contextlib.ExitStack()  # 処理中のジョブの実行中の登録（claim_job を参照）
+    try:
+        # 長さの確認・分割計画の作成（ffmpegでの読み込みが中心のため、ファイルごとに並列に行う）
+        report(f"{len(files)}個のファイルを準備中...", 0.0)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+            list(executor.map(lambda n: contextvars.copy_context().run(prepare, n), range(len(files))))
+        
+        # 全ファイルの未完了のパートを (ファイル番号, パート番号, 音声, 開始位置, 長さ) として集める
+        units = []
+        for n, entry in enumerate(entries):
+            if entry["error"] is not None:
+                continue
+            job = entry["job"]
+            if job is None:
+                info = entry["info"]
+                duration = info["duration"] if info else settings["max_duration"]
+                units.append((n, 0, functools.partial(_whole_file_source, files[n][0], compress), 0.0, duration))
+                continue
+            
+            # 同じジョブを別の処理（または同じ内容の別のファイル）が実行中なら、このファイルは処理しない
+            try:
+                claims.enter_context(claim_job(job["id"]))
+            except RuntimeError as e:
+                entry["error"] = str(e)
+                file_report(n)(str(e))
+                continue
+            run = entry["run"] = _ChunkedJobRun(job, file_report(n))
+            units.extend((n, i, part.source, part.start, part.duration) for i, part in zip(run.pending, run.split(compress)))
+        
+        # 長いパートから順に処理（短いファイルは最後の空いたスレッドに詰める）
+        units.sort(key=lambda unit: unit[4], reverse=True)
+        finished_before = sum(len(entry["run"].results) for entry in entries if entry["run"])
+        total_parts = finished_before + len(units)
+        publish()
+        if settings["prompt"]:
+            report(f"使用するプロンプト: {settings['prompt']}")
+        report(
+            f"{len(files)}個のファイルの{len(units)}個のパートを最大{max_workers}並列で処理します...",
+            finished_before / max(total_parts, 1)
+        )
+        
+        def on_chunk_done(k, done, total, result, error):
+            n, i = units[k][0], units[k][1]
+            entry = entries[n]
+            if isinstance(error, TranscriptionStopped):
+                # 分割したファイルは後で再開できるが、分割しないファイルは結果が無いまま終わる
+                entry["stopped"] = entry["run"] is None
+                return
+            if entry["run"]:
+                entry["run"].done(i, result, error)
+            elif error is not None:
+                entry["error"] = str(error)
+                file_report(n)(f"エラーが発生しました: {str(error)}")
+            else:
+                entry["result"] = result
+            publish()
+            report(f"{done}/{total} パート完了", (finished_before + done) / total_parts)
+        
+        def on_retry(k, attempt, error):
+            n, i = units[k][0], units[k][1]
+            if entries[n]["run"]:
+                entries[n]["run"].retry(i, attempt, error)
+            else:
+                file_report(n)(f"エラーが発生したため、後で送り直します（{attempt}回目）: {str(error)}")
+        
+        # 各パートの直前のパート（同じファイルの前のパート、完了済みならその結果）
+        positions = {(unit[0], unit[1]): k for k, unit in enumerate(units)}
+        previous = [
+            entries[n]["run"].previous(i, lambda j, n=n: positions.get((n, j))) if entries[n]["run"] else None
+            for n, i, *_ in units
+        ]
+        
+        transcribe_chunks_parallel(
+            [unit[2] for unit in units],
+            [unit[3] for unit in units],
+            model_name=settings["model"],
+            with_timestamps=settings["with_timestamps"],
+            prompt=settings["prompt"],
+            max_workers=max_workers,
+            on_chunk_done=on_chunk_done,
+            stop=stop,
+            context_mode=settings.get("context_mode", "none"),
+            previous=previous,
+            on_retry=on_retry,
+            files=[unit[0] for unit in units]
+        )
+        
+        # 完了したファイルのジョブは削除し、未完了のパートがあるファイルはその旨を報告する
+        stopped = stop is not None and stop.is_set()
+        results = [file_result(entry, final=True, stopped=stopped) for entry in entries]
+        return {"files": [
+            result if result["error"] is not None or result["stopped"]
+            else _save_history(result, result["filename"], history_owner)
+            for result in results
+        ]}
+    
+    finally:
+        claims.close()
+        # 一時ファイルを削除（分割処理の場合、元の音声はジョブ側で管理）
+        if not keep_source:
+            for file_path, _ in files:
+                if os.path.exists(file_path):
+                    os.unlink(file_path)
+
+def _ignore_report(message=None, progress=None):
+    pass